@@ -10,21 +10,120 @@ data.  These include:
 """
 
 import os
-import sys
+import argparse
 import numpy as np
-from casacore.tables import table
+from multiprocessing import Pool
+from casacore.tables import table, makecoldesc, maketabdesc
 from scipy.interpolate import interp1d
 
+from msutils import get_frequencies, get_block_size
+
+
+# Per-process state for the measurement set workers
+_WORKER = {}
+
+
+def _init_worker(fee, imf, arx):
+    """
+    Initialize a measurement set worker by building the interpolators for
+    the antenna independent corrections.
+    """
+    
+    _WORKER['fee'] = interp1d(fee[:,0], fee[:,1])
+    _WORKER['imf'] = interp1d(imf[:,0], imf[:,1])
+    _WORKER['arx'] = interp1d(arx[:,0], arx[:,1])
+
+
+def add_corrected_data(tb):
+    """
+    Add a CORRECTED_DATA column to an open measurement set with the same
+    description and storage manager settings as DATA.
+    """
+    
+    desc = tb.getcoldesc('DATA')
+    desc.pop('name', None)
+    dminfo = tb.getdminfo('DATA')
+    dminfo['NAME'] = 'CorrectedData'
+    tb.addcols(maketabdesc(makecoldesc('CORRECTED_DATA', desc)), dminfo)
+
+
+def apply_corrections(filename, rows=None, corrected=False, max_memory=512*1024**2):
+    """
+    Apply the bandpass corrections to the DATA column of a measurement set,
+    working through it `rows` rows at a time.  If `rows` is None the number of
+    rows is set so that each block of data is at most `max_memory` bytes.  If
+    `corrected` is True the corrected data are written to CORRECTED_DATA, which
+    is created if needed, rather than back to DATA.  Returns the number of rows
+    processed.
+    """
+    
+    ## Load in the observation-based gain correction
+    corrname = os.path.basename(filename)
+    corrname, _ = os.path.splitext(corrname)
+    corrname += '_gain_corr.txt'
+    if os.path.exists(corrname):
+        with open(corrname, 'r') as fh:
+            corr = float(fh.read())
+    else:
+        print("No temperature-based gain correction for %s" % filename)
+        corr = 1.0
+        
+    ## Get the frequency range of the file
+    freq = get_frequencies(filename)
+    
+    ## Get the total per-channel correction for the data
+    corr = corr / _WORKER['fee'](freq) / _WORKER['imf'](freq) / _WORKER['arx'](freq)
+    corr.shape = (1,)+corr.shape+(1,)
+    
+    ## Load in the actual data in blocks of rows and apply the corrections
+    tb = table(filename, readonly=False, ack=False)
+    outcol = 'DATA'
+    if corrected:
+        outcol = 'CORRECTED_DATA'
+        if outcol not in tb.colnames():
+            add_corrected_data(tb)
+            
+    if rows is None:
+        rows = get_block_size(tb, max_memory)
+    nrows = tb.nrows()
+    for startrow in range(0, nrows, rows):
+        nrow = min([rows, nrows-startrow])
+        data = tb.getcol('DATA', startrow=startrow, nrow=nrow)
+        data *= corr.astype(data.real.dtype)
+        tb.putcol(outcol, data, startrow=startrow, nrow=nrow)
+        del data
+    tb.close()
+    
+    return nrows
+
+
+def _apply_corrections(task):
+    """
+    Wrapper around apply_corrections() for the worker pool that returns a 
+    three-element tuple of the filename, the number of rows processed, and
+    any error message (None if there was not one).
+    """
+    
+    filename, rows, corrected, max_memory = task
+    try:
+        nrows = apply_corrections(filename, rows=rows, corrected=corrected, max_memory=max_memory)
+        error = None
+    except Exception as e:
+        nrows = 0
+        error = str(e)
+    return filename, nrows, error
+
 
 def main(args):
     # Initial file type check
-    if args[0][-4:] == '.txt':
-        ## File list - load and replace args
-        with open(args[0], 'r') as fh:
+    filenames = args.filename
+    if filenames[0][-4:] == '.txt':
+        ## File list - load and replace filenames
+        with open(filenames[0], 'r') as fh:
             filelist = fh.read()
-        args = filelist.split('\n')
-        if args[-1] == '':
-            args = args[:-1]
+        filenames = filelist.split('\n')
+        if filenames[-1] == '':
+            filenames = filenames[:-1]
             
     # Load in the antenna independent corrections...
     fee = np.loadtxt('mean_fee_gain.txt')
@@ -32,43 +131,46 @@ def main(args):
     arx = np.loadtxt('mean_arx_gain.txt')
     
     # And convert them to interpolators
-    fee = interp1d(fee[:,0], fee[:,1])
-    imf = interp1d(imf[:,0], imf[:,1])
-    arx = interp1d(arx[:,0], arx[:,1])
+    _init_worker(fee, imf, arx)
     
     # Load the data
-    for filename in args:
-        ## Load in the observation-based gain correction
-        corrname = os.path.basename(filename)
-        corrname, _ = corrname.splitext(corrname)
-        corrname += '_gain_corr.txt'
-        if os.path.exists(corrname):
-            with open(corrname, 'r') as fh:
-                corr = float(fh.read())
+    max_memory = int(args.max_memory*1024**3)
+    tasks = [(filename, args.rows, args.corrected, max_memory) for filename in filenames]
+    if args.workers > 1:
+        pool = Pool(processes=min([args.workers, len(tasks)]), initializer=_init_worker, initargs=(fee, imf, arx))
+        results = pool.imap_unordered(_apply_corrections, tasks)
+    else:
+        pool = None
+        results = map(_apply_corrections, tasks)
+        
+    nFailed = 0
+    for i,(filename,nrows,error) in enumerate(results):
+        if error is None:
+            print("[%i/%i] %s: corrected %i rows" % (i+1, len(tasks), filename, nrows))
         else:
-            print("No temperature-based gain correction for %s" % filename)
-            corr = 1.0
+            nFailed += 1
+            print("[%i/%i] %s FAILED: %s" % (i+1, len(tasks), filename, error))
             
-        ## Get the frequency range of the file
-        tb = table(os.path.join(filename, 'SPECTRAL_WINDOW'), ack=False)
-        freq = np.array([], dtype=np.float64)
-        for freqIF in tb.col('CHAN_FREQ'):
-            freq = np.concatenate([freq, freqIF])
-        tb.close()
-        
-        ## Get the total per-channel correction for the data
-        corr = corr / fee(freq) / imf(freq) / arx(freq)
-        corr.shape = (1,)+corr.shape+(1,)
-        
-        ## Load in the actual data and apply the corrections
-        tb = table(filename, readonly=False, ack=False)
-        data = tb.getcol('DATA')
-        data *= corr
-        
-        ## Save back to DATA
-        tb.putcol('DATA', data)
-        tb.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("Corrected %i of %i measurement sets" % (len(tasks)-nFailed, len(tasks)))
 
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    parser = argparse.ArgumentParser(
+        description='apply bandpass corrections to a collection of measurement sets',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str, nargs='+',
+                        help='measurement set(s) to correct or a .txt file list')
+    parser.add_argument('-r', '--rows', type=int,
+                        help='number of rows to correct at a time; the default is set by --max-memory')
+    parser.add_argument('-M', '--max-memory', type=float, default=0.5,
+                        help='memory budget in GB for each block of rows')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of measurement sets to correct at once')
+    parser.add_argument('-c', '--corrected', action='store_true',
+                        help='write to CORRECTED_DATA instead of replacing DATA')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+"""
+Given a collection of CASA measurement sets, apply all of the calibration and
+flagging in a single pass through each measurement set.  This combines:
+ * the bandpass corrections of apply_bandpass_corrs.py (FEE gain, FEE-antenna
+   mismatch factor, ARX response, and temperature-dependent gain),
+ * the delay (and, optionally, gain) calibration of apply_two_point_selfcal.py,
+   and
+ * the channel and baseline flags of apply_channel_baseline_flags.py.
+The corrections are combined into a per-channel bandpass, a per-antenna delay
+and gain, and a channel x baseline flag mask that are applied to each block of
+rows as it is read.
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from casacore.tables import table
+from scipy.interpolate import interp1d
+
+from apply_bandpass_corrs import add_corrected_data
+from msutils import get_frequencies, get_corr_products, get_block_size, load_baseline_flags, get_flag_masks
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'selfcal'))
+from apply_two_point_selfcal import load_dcal, load_gcal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import flag_store
+
+
+# Per-process state for the measurement set workers
+_WORKER = {}
+
+
+def load_gain_corr(filename):
+    """
+    Load the temperature-based gain correction from get_connected_gain.py for a
+    measurement set.  Returns 1.0 if there is not one.
+    """
+    
+    corrname = os.path.basename(filename)
+    corrname, _ = os.path.splitext(corrname)
+    corrname += '_gain_corr.txt'
+    if os.path.exists(corrname):
+        with open(corrname, 'r') as fh:
+            corr = float(fh.read())
+    else:
+        print("No temperature-based gain correction for %s" % filename)
+        corr = 1.0
+    return corr
+
+
+def get_antenna_solutions(ant, values, nant, fill):
+    """
+    Given the antennas and antenna x 1 x polarization values from load_dcal() or
+    load_gcal(), return an antenna x polarization array for `nant` antennas with
+    antennas that are missing a solution set to `fill`.
+    """
+    
+    out = np.full((nant, values.shape[-1]), fill, dtype=values.dtype)
+    valid = (ant >= 0) & (ant < nant)
+    out[ant[valid]] = values[valid,0,:]
+    return out
+
+
+def build_calibration(filename, config):
+    """
+    Build the calibration for a measurement set and return it as a dictionary
+    with:
+     * bandpass - per-channel multiplicative correction (or None),
+     * delay - antenna x polarization delays in ns (or None),
+     * gain - antenna x polarization gain amplitudes (or None),
+     * chan_flags - per-channel flag mask (or None),
+     * bl_flags - antenna x antenna baseline flag mask (or None), and
+     * freq, products - channel frequencies and correlation products.
+    """
+    
+    freq = get_frequencies(filename)
+    products = get_corr_products(filename)
+    
+    tb = table(os.path.join(filename, 'ANTENNA'), ack=False)
+    nant = tb.nrows()
+    tb.close()
+    
+    cal = {'freq': freq, 'products': products, 'bandpass': None, 'delay': None,
+           'gain': None, 'chan_flags': None, 'bl_flags': None}
+    if config['bandpass'] is not None:
+        fee, imf, arx = config['bandpass']
+        corr = load_gain_corr(filename)
+        cal['bandpass'] = corr / fee(freq) / imf(freq) / arx(freq)
+    if config['dcal'] is not None:
+        cal['delay'] = get_antenna_solutions(*config['dcal'], nant, 0.0)
+    if config['gcal'] is not None:
+        cal['gain'] = get_antenna_solutions(*config['gcal'], nant, 1.0)
+    if config['flag']:
+        cal['chan_flags'], cal['bl_flags'] = get_flag_masks(filename, freq.size, bl_flags=config['bl_flags'],
+                                                            store=config.get('flag_store', None))
+    return cal
+
+
+def apply_block(data, flags, ant1, ant2, cal):
+    """
+    Apply the calibration from build_calibration() in place to a row x channel
+    x correlation block of data and/or flags for the baselines given by `ant1`
+    and `ant2`.  Either `data` or `flags` can be None to skip them.
+    """
+    
+    p, q = cal['products'][:,0], cal['products'][:,1]
+    if data is not None:
+        if cal['bandpass'] is not None:
+            data *= cal['bandpass'].astype(data.real.dtype)[None,:,None]
+        if cal['delay'] is not None:
+            dly = cal['delay'][ant1][:,p] - cal['delay'][ant2][:,q]
+            data *= np.exp(-2j*np.pi*(cal['freq']/1e9)[None,:,None]*dly[:,None,:]).astype(data.dtype)
+        if cal['gain'] is not None:
+            data /= (cal['gain'][ant1][:,p]*cal['gain'][ant2][:,q]).astype(data.real.dtype)[:,None,:]
+    if flags is not None:
+        if cal['chan_flags'] is not None:
+            flags |= cal['chan_flags'][None,:,None]
+        if cal['bl_flags'] is not None:
+            flags |= cal['bl_flags'][ant1,ant2][:,None,None]
+
+
+def calibrate(filename, config, rows=None, corrected=False, max_memory=512*1024**2):
+    """
+    Calibrate and flag a measurement set in a single pass, working through it
+    `rows` rows at a time.  If `rows` is None the number of rows is set so 
+    that each block, including the temporary phases for the delays, is at most
+    `max_memory` bytes.  If `corrected` is True the calibrated data are
+    written to CORRECTED_DATA, which is created if needed, rather than back to
+    DATA.  Returns the number of rows processed.
+    """
+    
+    cal = build_calibration(filename, config)
+    apply_data = corrected or any([cal[key] is not None for key in ('bandpass', 'delay', 'gain')])
+    apply_flags = any([cal[key] is not None for key in ('chan_flags', 'bl_flags')])
+    
+    tb = table(filename, readonly=False, ack=False)
+    outcol = 'DATA'
+    if corrected:
+        outcol = 'CORRECTED_DATA'
+        if outcol not in tb.colnames():
+            add_corrected_data(tb)
+            
+    if rows is None:
+        rows = get_block_size(tb, max_memory, columns=('DATA', 'FLAG'), copies=2)
+    nrows = tb.nrows()
+    for startrow in range(0, nrows, rows):
+        nrow = min([rows, nrows-startrow])
+        ant1 = tb.getcol('ANTENNA1', startrow=startrow, nrow=nrow)
+        ant2 = tb.getcol('ANTENNA2', startrow=startrow, nrow=nrow)
+        data, flags = None, None
+        if apply_data:
+            data = tb.getcol('DATA', startrow=startrow, nrow=nrow)
+        if apply_flags:
+            flags = tb.getcol('FLAG', startrow=startrow, nrow=nrow)
+            
+        apply_block(data, flags, ant1, ant2, cal)
+        
+        if data is not None:
+            tb.putcol(outcol, data, startrow=startrow, nrow=nrow)
+        if flags is not None:
+            tb.putcol('FLAG', flags, startrow=startrow, nrow=nrow)
+        del data, flags
+    tb.close()
+    
+    return nrows
+
+
+def _init_worker(args):
+    """
+    Initialize a measurement set worker by loading the calibration tables and
+    flags that are common to all measurement sets.
+    """
+    
+    config = {'bandpass': None, 'dcal': None, 'gcal': None, 'flag': not args.no_flags, 'bl_flags': None,
+              'flag_store': None}
+    if not args.no_bandpass:
+        bandpass = []
+        for name in ('mean_fee_gain.txt', 'mean_fee_ant_imf.txt', 'mean_arx_gain.txt'):
+            corr = np.loadtxt(name)
+            bandpass.append(interp1d(corr[:,0], corr[:,1]))
+        config['bandpass'] = tuple(bandpass)
+    if args.cal is not None:
+        config['dcal'] = load_dcal(args.cal.replace('.gcal', '.dcal'))
+        if args.gains:
+            config['gcal'] = load_gcal(args.cal.replace('.dcal', '.gcal'))
+    if not args.no_flags and args.flag_store is not None:
+        config['flag_store'] = flag_store.FlagStore(args.flag_store)
+    elif not args.no_flags and os.path.exists(args.baseline_flags):
+        config['bl_flags'] = load_baseline_flags(args.baseline_flags)
+    elif not args.no_flags:
+        print("No baselines flags in %s" % args.baseline_flags)
+        
+    _WORKER['config'] = config
+    _WORKER['args'] = args
+
+
+def _calibrate(filename):
+    """
+    Wrapper around calibrate() for the worker pool that returns a three-element
+    tuple of the filename, the number of rows processed, and any error message
+    (None if there was not one).
+    """
+    
+    args = _WORKER['args']
+    try:
+        nrows = calibrate(filename, _WORKER['config'], rows=args.rows, corrected=args.corrected,
+                          max_memory=int(args.max_memory*1024**3))
+        error = None
+    except Exception as e:
+        nrows = 0
+        error = str(e)
+    return filename, nrows, error
+
+
+def main(args):
+    # Initial file type check
+    filenames = args.filename
+    if filenames[0][-4:] == '.txt':
+        ## File list - load and replace filenames
+        with open(filenames[0], 'r') as fh:
+            filelist = fh.read()
+        filenames = filelist.split('\n')
+        if filenames[-1] == '':
+            filenames = filenames[:-1]
+    filenames = [filename.rstrip('/') for filename in filenames]
+    
+    # Load in the calibration tables and flags
+    _init_worker(args)
+    
+    # Calibrate
+    if args.workers > 1:
+        pool = Pool(processes=min([args.workers, len(filenames)]), initializer=_init_worker, initargs=(args,))
+        results = pool.imap_unordered(_calibrate, filenames)
+    else:
+        pool = None
+        results = map(_calibrate, filenames)
+        
+    nFailed = 0
+    for i,(filename,nrows,error) in enumerate(results):
+        if error is None:
+            print("[%i/%i] %s: calibrated %i rows" % (i+1, len(filenames), filename, nrows))
+        else:
+            nFailed += 1
+            print("[%i/%i] %s FAILED: %s" % (i+1, len(filenames), filename, error))
+            
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("Calibrated %i of %i measurement sets" % (len(filenames)-nFailed, len(filenames)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='apply the bandpass, delay/gain, and flag calibration to a collection of measurement sets in one pass',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str, nargs='+',
+                        help='measurement set(s) to calibrate or a .txt file list')
+    parser.add_argument('-c', '--cal', type=str,
+                        help='.dcal or .gcal table from two_point_selfcal.py to apply')
+    parser.add_argument('-g', '--gains', action='store_true',
+                        help='apply the gain amplitudes from the .gcal table as well as the delays')
+    parser.add_argument('-b', '--baseline-flags', type=str, default='baseline_flags.txt',
+                        help='baseline flag file from get_baseline_flags.py')
+    parser.add_argument('-s', '--flag-store', type=str,
+                        help='flag store from flag_store.py to use instead of the flag files')
+    parser.add_argument('--no-bandpass', action='store_true',
+                        help='do not apply the FEE/IMF/ARX and temperature-based bandpass corrections')
+    parser.add_argument('--no-flags', action='store_true',
+                        help='do not apply the channel and baseline flags')
+    parser.add_argument('-r', '--rows', type=int,
+                        help='number of rows to calibrate at a time; the default is set by --max-memory')
+    parser.add_argument('-M', '--max-memory', type=float, default=0.5,
+                        help='memory budget in GB for each block of rows')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of measurement sets to calibrate at once')
+    parser.add_argument('--corrected', action='store_true',
+                        help='write to CORRECTED_DATA instead of replacing DATA')
+    args = parser.parse_args()
+    main(args)
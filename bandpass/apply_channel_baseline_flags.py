@@ -1,41 +1,166 @@
-#!/usr/bin/env casa
+#!/usr/bin/env python3
 
 """
 Given a collection of CASA measurement sets, apply flags from get_channel_flags.py
-and get_baseline_flags.py to the data using CASA's `flagdata` task.
+and get_baseline_flags.py to the data.  The flag files are converted into a
+channel mask and an antenna x antenna baseline mask that are OR'd into the FLAG
+column a block of rows at a time so that a CASA session is not needed.
+
+Each 'LWAxxx~LWAyyy' entry in the baseline flag file flags only the baseline
+between those two stands.  The CASA flagdata() call that this replaces read it
+as the range of antennas from LWAxxx to LWAyyy, which flagged many more
+baselines than the same-connector pairs that get_baseline_flags.py finds.
 """
 
 import os
 import sys
+import argparse
+from multiprocessing import Pool
+from casacore.tables import table
+
+from msutils import get_frequencies, get_block_size, load_baseline_flags, get_flag_masks
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import flag_store
+
+
+# Per-process state for the measurement set workers
+_WORKER = {}
+
+
+def _init_worker(bl_flags, store=None):
+    """
+    Initialize a measurement set worker with the baseline flags and, if given,
+    a flag store.
+    """
+    
+    _WORKER['bl_flags'] = bl_flags
+    _WORKER['store'] = None
+    if store is not None:
+        _WORKER['store'] = flag_store.FlagStore(store)
+
 
-args = sys.argv[1:]
-if args[0][-4:] == '.txt':
-    ## File list - load and replace args
-    with open(args[0], 'r') as fh:
-        filelist = fh.read()
-    args = filelist.split('\n')
-    if args[-1] == '':
-        args = args[:-1]
+def apply_flags(filename, bl_flags=None, rows=None, store=None, max_memory=512*1024**2):
+    """
+    Apply the channel flags for a measurement set and, optionally, a list of
+    (name, name) baseline flags to its FLAG column, working through it `rows`
+    rows at a time.  If `rows` is None the number of rows is set so that each
+    block of flags is at most `max_memory` bytes.  If a flag_store.FlagStore
+    instance is given as `store` the flags are taken from it instead.  Returns
+    a two-element tuple of the number of rows and the number of newly flagged
+    visibilities.
+    """
+    
+    nchan = get_frequencies(filename).size
+    chan_mask, bl_mask = get_flag_masks(filename, nchan, bl_flags=bl_flags, store=store)
+    if chan_mask is None and bl_mask is None:
+        return 0, 0
         
-for filename in args:
-    if filename[-1] == '/':
-        filename = filename[:-1]
-    if filename[-3:] != '.ms':
-        continue
-    flagname = os.path.basename(filename)
-    flagname, _ = os.path.splitext(flagname)
-    flagname = flagname+'_channel_flags.txt'
-    if os.path.exists(flagname):
-        with open(flagname, 'r') as fh:
-            flagcmd = fh.read()
-        flagdata(vis=filename, mode='manual', spw=flagcmd)
-    else:
-        print("No channel flags for %s" % filename)
+    tb = table(filename, readonly=False, ack=False)
+    if rows is None:
+        rows = get_block_size(tb, max_memory, columns=('FLAG',))
+    nrows = tb.nrows()
+    nflagged = 0
+    for startrow in range(0, nrows, rows):
+        nrow = min([rows, nrows-startrow])
+        flags = tb.getcol('FLAG', startrow=startrow, nrow=nrow)
+        orig = flags.sum()
         
-    flagname = 'baseline_flags.txt'
-    if os.path.exists(flagname):
-        with open(flagname, 'r') as fh:
-            flagcmd = fh.read()
-        flagdata(vis=filename, mode='manual', antenna=flagcmd)
+        if chan_mask is not None:
+            flags |= chan_mask[None,:,None]
+        if bl_mask is not None:
+            ant1 = tb.getcol('ANTENNA1', startrow=startrow, nrow=nrow)
+            ant2 = tb.getcol('ANTENNA2', startrow=startrow, nrow=nrow)
+            flags |= bl_mask[ant1,ant2][:,None,None]
+            
+        nflagged += flags.sum() - orig
+        tb.putcol('FLAG', flags, startrow=startrow, nrow=nrow)
+    tb.close()
+    
+    return nrows, int(nflagged)
+
+
+def _apply_flags(task):
+    """
+    Wrapper around apply_flags() for the worker pool that returns a
+    four-element tuple of the filename, the number of rows processed, the
+    number of newly flagged visibilities, and any error message (None if there
+    was not one).
+    """
+    
+    filename, rows, max_memory = task
+    try:
+        nrows, nflagged = apply_flags(filename, bl_flags=_WORKER['bl_flags'], rows=rows, store=_WORKER['store'], 
+                                      max_memory=max_memory)
+        error = None
+    except Exception as e:
+        nrows, nflagged = 0, 0
+        error = str(e)
+    return filename, nrows, nflagged, error
+
+
+def main(args):
+    # Initial file type check
+    filenames = args.filename
+    if filenames[0][-4:] == '.txt':
+        ## File list - load and replace filenames
+        with open(filenames[0], 'r') as fh:
+            filelist = fh.read()
+        filenames = filelist.split('\n')
+        if filenames[-1] == '':
+            filenames = filenames[:-1]
+    filenames = [filename.rstrip('/') for filename in filenames]
+    filenames = [filename for filename in filenames if filename[-3:] == '.ms']
+    
+    # Load in the baseline flags if there is not a flag store
+    bl_flags = None
+    if args.flag_store is None:
+        if os.path.exists(args.baseline_flags):
+            bl_flags = load_baseline_flags(args.baseline_flags)
+        else:
+            print("No baselines flags in %s" % args.baseline_flags)
+    _init_worker(bl_flags, store=args.flag_store)
+    
+    # Flag
+    max_memory = int(args.max_memory*1024**3)
+    tasks = [(filename, args.rows, max_memory) for filename in filenames]
+    if args.workers > 1:
+        pool = Pool(processes=min([args.workers, len(tasks)]), initializer=_init_worker, initargs=(bl_flags, args.flag_store))
+        results = pool.imap_unordered(_apply_flags, tasks)
     else:
-        print("No baselines flags for %s" % filename)
+        pool = None
+        results = map(_apply_flags, tasks)
+        
+    nFailed = 0
+    for i,(filename,nrows,nflagged,error) in enumerate(results):
+        if error is None:
+            print("[%i/%i] %s: flagged %i new visibilities in %i rows" % (i+1, len(tasks), filename, nflagged, nrows))
+        else:
+            nFailed += 1
+            print("[%i/%i] %s FAILED: %s" % (i+1, len(tasks), filename, error))
+            
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("Flagged %i of %i measurement sets" % (len(tasks)-nFailed, len(tasks)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='apply channel and baseline flags to a collection of measurement sets',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str, nargs='+',
+                        help='measurement set(s) to flag or a .txt file list')
+    parser.add_argument('-b', '--baseline-flags', type=str, default='baseline_flags.txt',
+                        help='baseline flag file from get_baseline_flags.py')
+    parser.add_argument('-s', '--flag-store', type=str,
+                        help='flag store from flag_store.py to use instead of the flag files')
+    parser.add_argument('-r', '--rows', type=int,
+                        help='number of rows to flag at a time; the default is set by --max-memory')
+    parser.add_argument('-M', '--max-memory', type=float, default=0.5,
+                        help='memory budget in GB for each block of rows')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of measurement sets to flag at once')
+    args = parser.parse_args()
+    main(args)
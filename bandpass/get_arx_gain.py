@@ -9,21 +9,19 @@ import os
 import sys
 import numpy as np
 
-from lsl.common.stations import parse_ssmif
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import station_cache
 
 
 def main(args):
     # Load in the SSMIF
     ssmifname = args[0]
-    station = parse_ssmif(ssmifname)
+    station, info = station_cache.load_station_info(ssmifname)
     
     # Compute the mean ARX response for all good dipoles
     mean_resp = []
-    for a in station.antennas:
-        if a.combined_status != 33:
-            continue
-            
-        freq, resp = a.arx.response('full', dB=False)
+    for i in np.where(info['combined_status'] == 33)[0]:
+        freq, resp = station.antennas[i].arx.response('full', dB=False)
         mean_resp.append(resp)
     mean_resp = np.array(mean_resp)
     mean_resp = np.mean(mean_resp, axis=0)
@@ -2,35 +2,44 @@
 
 """
 Given a LWA1 SSMIF file, find all signals on the same output RJ45 connector and
-create a flag file containing those baselines.
+create a flag file containing those baselines.  If a flag store from 
+flag_store.py is also given the baselines are added to every capture in it.
 """
 
 import os
 import sys
-from lsl.common.stations import parse_ssmif
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import station_cache
+import flag_store
 
 
 def main(args):
     # Load the SSMIF
     ssmifname = args[0]
-    station = parse_ssmif(ssmifname)
-    nant = len(station.antennas) // 2
+    station, info = station_cache.load_station_info(ssmifname)
+    
+    # Find bad baselines - pairs of stands on the same ARX board and RJ45 
+    # connector (four channels per connector) - using the X polarization
+    arx_id = info['arx_id'][0::2]
+    rj45 = (info['arx_channel'][0::2] - 1) // 4
+    stand = info['stand'][0::2]
+    i, j = np.triu_indices(arx_id.size, k=1)
+    same = (arx_id[i] == arx_id[j]) & (rj45[i] == rj45[j])
+    
+    # Save by name
+    bad = [f"LWA{stand[a]:03d}~LWA{stand[b]:03d}" for a,b in zip(i[same], j[same])]
     
-    # Find bad baselines and save by name
-    bad = []
-    for i in range(nant):
-        a = station.antennas[2*i]
-        for j in range(i+1, nant):
-            b = station.antennas[2*j]
-            if a.arx.id != b.arx.id:
-                continue
-                
-            if (a.arx.channel-1)//4 == (b.arx.channel-1)//4:
-                bad.append(f"LWA{a.stand.id:03d}~LWA{b.stand.id:03d}")
-                
     # Write to disk
     with open('baseline_flags.txt', 'w') as fh:
         fh.write(','.join(bad))
+        
+    # Update the flag store
+    if len(args) > 1:
+        with flag_store.FlagStore(args[1], readonly=False) as store:
+            store.set_baseline_flags(None, zip(stand[i[same]], stand[j[same]]))
+        print(f"Added {same.sum()} baseline flags to '{args[1]}'")
 
 
 if __name__ == '__main__':
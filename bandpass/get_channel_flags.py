@@ -3,16 +3,24 @@
 """
 Given a collection of CASA measurement sets, create flags to each one.  Flags
 are created by smoothing the mean auto-correlation data and looking for peaks in
-the raw/smoothed ratio.
+the raw/smoothed ratio.  Only the parallel hand auto-correlations are read and
+the auto-correlation amplitudes are saved to *_autos.npz for later use.  If a
+flag store from flag_store.py is given the channel flags are also added to the
+capture for each measurement set in it.
 """
 
 import os
 import sys
+import argparse
 import numpy as np
+from multiprocessing import Pool
 from scipy.signal import savgol_filter
 from casacore.tables import table
 
-from matplotlib import pyplot as plt
+from msutils import get_frequencies, get_corr_products
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import flag_store
 
 
 def flag(spec, chan_win=19, grow=True):
@@ -38,52 +46,166 @@ def flag(spec, chan_win=19, grow=True):
     return bad
 
 
+def load_autos(filename, rows=4096):
+    """
+    Read the parallel hand auto-correlations from a measurement set, working
+    through them `rows` rows at a time, and return a three-element tuple of:
+     * the antenna index of each row,
+     * the time of each row, and
+     * the row x channel x polarization amplitudes of the auto-correlations.
+    CORRECTED_DATA is used if it exists, otherwise DATA.
+    """
+    
+    # Find the parallel hands, e.g., XX and YY
+    products = get_corr_products(filename)
+    pols = np.where(products[:,0] == products[:,1])[0]
+    if pols.size != 2:
+        raise RuntimeError(f"Expected two parallel hand products, found {pols.size}")
+    nchan = get_frequencies(filename).size
+    blc, trc, inc = [0, pols[0]], [nchan-1, pols[1]], [1, pols[1]-pols[0]]
+    
+    tb = table(filename, ack=False)
+    column = 'CORRECTED_DATA' if 'CORRECTED_DATA' in tb.colnames() else 'DATA'
+    autos = tb.query('ANTENNA1 == ANTENNA2', columns=f"ANTENNA1,TIME,{column}")
+    
+    nrows = autos.nrows()
+    ant = autos.getcol('ANTENNA1')
+    time = autos.getcol('TIME')
+    amp = np.zeros((nrows, nchan, 2), dtype=np.float32)
+    for startrow in range(0, nrows, rows):
+        nrow = min([rows, nrows-startrow])
+        data = autos.getcolslice(column, blc, trc, inc, startrow=startrow, nrow=nrow)
+        amp[startrow:startrow+nrow] = np.abs(data)
+    autos.close()
+    tb.close()
+    
+    return ant, time, amp
+
+
+def flag_file(filename, rows=4096):
+    """
+    Find the channel flags for a measurement set and write them to
+    *_channel_flags.txt.  The auto-correlation amplitudes, along with the
+    channel frequencies and median spectrum, are saved to *_autos.npz.
+    Returns the list of flagged channels.
+    """
+    
+    ant, time, amp = load_autos(filename, rows=rows)
+    
+    # power -> XX+YY -> median
+    data = amp[...,0] + amp[...,1]
+    data = np.median(data, axis=0)
+    
+    # Flag
+    bad = flag(data)
+    bad.extend(list(range(50)))
+    bad = sorted(set(bad))
+    
+    # # Plots
+    # from matplotlib import pyplot as plt
+    # fig = plt.figure()
+    # ax = fig.gca()
+    # ax.plot(10*np.log10(data))
+    # data[bad] = np.nan
+    # ax.plot(10*np.log10(data))
+    # plt.show()
+    
+    # Save
+    outname = os.path.basename(filename)
+    outname, _ = os.path.splitext(outname)
+    np.savez(outname+'_autos.npz', freq=get_frequencies(filename), antenna=ant, time=time,
+             autos=amp, median=data)
+    with open(outname+'_channel_flags.txt', 'w') as fh:
+        fh.write(','.join([f"0:{b}" for b in bad]))
+        
+    return bad
+
+
+def _flag_file(task):
+    """
+    Wrapper around flag_file() for the worker pool that returns a
+    three-element tuple of the filename, the list of flagged channels, and
+    any error message (None if there was not one).
+    """
+    
+    filename, rows = task
+    try:
+        bad = flag_file(filename, rows=rows)
+        error = None
+    except Exception as e:
+        bad = []
+        error = str(e)
+    return filename, bad, error
+
+
 def main(args):
     # Initial file type check
-    if args[0][-4:] == '.txt':
-        ## File list - load and replace args
-        with open(args[0], 'r') as fh:
+    filenames = args.filename
+    if filenames[0][-4:] == '.txt':
+        ## File list - load and replace filenames
+        with open(filenames[0], 'r') as fh:
             filelist = fh.read()
-        args = filelist.split('\n')
-        if args[-1] == '':
-            args = args[:-1]
-            
-    # Load the data
-    for filename in args:
-        tb = table(filename, ack=False)
-        autos = tb.query('ANTENNA1 == ANTENNA2')
-        try:
-            data = autos.getcol('CORRECTED_DATA')
-        except RuntimeError:
-            data = autos.getcol('DATA')
-            
-        # complex vis -> power -> XX+YY -> median
-        data = np.abs(data)
-        data = data[...,0] + data[...,1]
-        data = np.median(data, axis=0)
-        
-        # Flag
-        bad = flag(data)
-        bad.extend(list(range(50)))
-        bad.sort()
-        bad = list(set(bad))
+        filenames = filelist.split('\n')
+        if filenames[-1] == '':
+            filenames = filenames[:-1]
+    filenames = [filename.rstrip('/') for filename in filenames]
+    
+    # Open the flag store to update
+    store = None
+    if args.flag_store is not None:
+        store = flag_store.FlagStore(args.flag_store, readonly=False)
         
-        # # Plots
-        # fig = plt.figure()
-        # ax = fig.gca()
-        # ax.plot(10*np.log10(data))
-        # data[bad] = np.nan
-        # ax.plot(10*np.log10(data))
-        # plt.show()
+    # Flag
+    tasks = [(filename, args.rows) for filename in filenames]
+    if args.workers > 1:
+        pool = Pool(processes=min([args.workers, len(tasks)]))
+        results = pool.imap_unordered(_flag_file, tasks)
+    else:
+        pool = None
+        results = map(_flag_file, tasks)
         
-        # Save
-        outname = os.path.basename(filename)
-        outname, _ = os.path.splitext(outname)
-        outname += '_channel_flags.txt'
-        with open(outname, 'w') as fh:
-            fh.write(','.join([f"0:{b}" for b in bad]))
+    nFailed = 0
+    for i,(filename,bad,error) in enumerate(results):
+        if error is None and store is not None:
+            capture = flag_store.get_capture_name(filename)
+            try:
+                store.get_index(capture)
+            except KeyError:
+                error = f"{capture} is not in the flag store"
+            else:
+                if len(bad) > 0 and bad[-1] >= store.nchan:
+                    error = f"channel {bad[-1]} is beyond the {store.nchan} channels in the flag store"
+                else:
+                    store.set_channel_flags(capture, bad)
+                    
+        if error is None:
+            print(f"[{i+1}/{len(tasks)}] {filename}: flagged {len(bad)} channels")
+        else:
+            nFailed += 1
+            print(f"[{i+1}/{len(tasks)}] {filename} FAILED: {error}")
             
-        tb.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if store is not None:
+        store.close()
+    print(f"Flagged {len(tasks)-nFailed} of {len(tasks)} measurement sets")
+    if nFailed > 0:
+        sys.exit(1)
+
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    parser = argparse.ArgumentParser(
+        description='find channel flags from the auto-correlations in a collection of measurement sets',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str, nargs='+',
+                        help='measurement set(s) to flag or a .txt file list')
+    parser.add_argument('-s', '--flag-store', type=str,
+                        help='flag store from flag_store.py to add the channel flags to')
+    parser.add_argument('-r', '--rows', type=int, default=4096,
+                        help='number of auto-correlation rows to read at a time')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of measurement sets to flag at once')
+    args = parser.parse_args()
+    main(args)
@@ -3,6 +3,7 @@
 import os
 import sys
 import glob
+import argparse
 import gzip
 import numpy as np
 from scipy.optimize import minimize
@@ -11,7 +12,9 @@ from lsl import astro
 from lsl.common.stations import lwa1
 from lsl.common.progress import ProgressBarPlus
 
-from matplotlib import pyplot as plt
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import plotting
+import spectra_store
 
 
 def load_wx(filename):
@@ -83,16 +86,20 @@ def main(args):
     arx_dt = arx_dt[order]
     arx_temp = arx_temp[order]
     
+    # Open the store or, for .npz files, read them directly
+    store = spectra_store.open_store(args.filename)
+    filenames = list(store.filename)
+    freq_range = store.get_channels(40e6, 70e6)
+    
     # Load in the data
-    pb = ProgressBarPlus(max=len(args))
+    pb = ProgressBarPlus(max=store.ncapture)
     sys.stdout.write(pb.show()+'\r')
     sys.stdout.flush()
     
     mjd, temp_in, temp_out, lst, med_power = [], [], [], [], []
-    for filename in args:
-        ## Open the file and pull out the data - we'll save the MJD
-        data = np.load(filename)
-        obsdate = data['date'].item().decode().replace('-', '/')
+    for i in range(store.ncapture):
+        ## Pull out the date - we'll save the MJD
+        obsdate = store.date[i].replace('-', '/')
         mjd.append(obsdate.split(None, 1)[0])
         
         ## Compute the LST
@@ -109,18 +116,10 @@ def main(args):
         temp_in.append(arx_temp[closest])
         
         ## Pull out the median power
-        try:
-            freq_range
-        except NameError:
-            freq = data['freq']
-            freq_range = np.where((freq>40e6) & (freq<70e6))[0]
-        
-        power = data['masterSpectra'][0,...]
-        power = np.median(power[:,freq_range])
+        power = store.read(i, chans=freq_range)
+        power = np.median(power)
         med_power.append(power)
         
-        data.close()
-        
         pb.inc()
         sys.stdout.write(pb.show()+'\r')
         sys.stdout.flush()
@@ -128,6 +127,7 @@ def main(args):
     sys.stdout.write(pb.show()+'\r')
     sys.stdout.write('\n')
     sys.stdout.flush()
+    store.close()
     
     # Run the tempeture vs gain fit - joint indoor (ARX)/outdoor
     mjd = np.array(mjd)
@@ -227,7 +227,7 @@ def main(args):
         gain_corrs[valid] *= s
         
     # Save the gain corrections
-    for filename,gaincorr in zip(args, gain_corrs):
+    for filename,gaincorr in zip(filenames, gain_corrs):
         outname = os.path.basename(filename)
         outname, _ = os.path.splitext(outname)
         outname += '_gain_corr.txt'
@@ -238,7 +238,8 @@ def main(args):
     # in bulk and generating a plot
     fixed_power = orig_power*gain_corrs
     
-    fig = plt.figure()
+    plotter = plotting.Plotter(batch=args.batch, prefix='connected_gain_')
+    fig = plotter.figure('power_vs_lst')
     ax = fig.gca()
     unique_mjd = np.unique(mjd)
     for m in unique_mjd:
@@ -259,9 +260,17 @@ def main(args):
         ax.plot(sub_lst, sub_fixed)
     ax.set_xlabel('LST [hr]')
     ax.set_ylabel('Mean Power [arb]')
-    plt.draw()
-    plt.show()
+    plotter.show()
 
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    parser = argparse.ArgumentParser(
+        description='find the gain corrections between captures from stationMaster.py spectra and temperatures',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str, nargs='+',
+                        help='.npz file(s), a .txt file list, or a store from spectra_store.py')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='run without a display and save the plot to a PNG file')
+    args = parser.parse_args()
+    main(args)
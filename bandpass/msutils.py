@@ -0,0 +1,155 @@
+"""
+Small helpers for reading the metadata of a CASA measurement set and building
+its flag masks that are shared by the calibration and flagging scripts.  These
+only need python-casacore and flag_store.py so that the scripts that use them
+can be run in worker processes without pulling in the rest of the calibration
+code.
+"""
+
+import os
+import sys
+import numpy as np
+from casacore.tables import table
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import flag_store
+
+
+def get_frequencies(filename):
+    """
+    Return the frequencies in Hz of all channels in a measurement set.
+    """
+    
+    tb = table(os.path.join(filename, 'SPECTRAL_WINDOW'), ack=False)
+    freq = np.array([], dtype=np.float64)
+    for freqIF in tb.col('CHAN_FREQ'):
+        freq = np.concatenate([freq, freqIF])
+    tb.close()
+    return freq
+
+
+def get_corr_products(filename):
+    """
+    Return a correlation x 2 array of the receptor (polarization) indices that
+    make up each correlation in a measurement set.
+    """
+    
+    tb = table(os.path.join(filename, 'POLARIZATION'), ack=False)
+    products = tb.getcol('CORR_PRODUCT')[0]
+    tb.close()
+    return products
+
+
+def get_block_size(tb, max_memory, columns=('DATA',), copies=1):
+    """
+    Given an open table, return the number of rows to work on at a time so 
+    that `copies` copies of a block of rows of the given columns stay within
+    `max_memory` bytes.  The size of a row is taken from the first row.
+    """
+    
+    if tb.nrows() == 0:
+        return 1
+    size = copies*sum([tb.getcell(column, 0).nbytes for column in columns])
+    return max([1, int(max_memory // size)])
+
+
+def load_channel_flags(filename):
+    """
+    Load the *_channel_flags.txt file from get_channel_flags.py for a
+    measurement set and return a list of the flagged channel numbers.  Channel
+    ranges in the CASA 'spw:start~stop' form are expanded.  Returns an empty
+    list if there is not one.
+    """
+    
+    flagname = os.path.basename(filename)
+    flagname, _ = os.path.splitext(flagname)
+    flagname = flagname+'_channel_flags.txt'
+    if not os.path.exists(flagname):
+        print("No channel flags for %s" % filename)
+        return []
+    return flag_store.load_channel_flags(flagname)
+
+
+def load_baseline_flags(filename):
+    """
+    Load a baseline_flags.txt file from get_baseline_flags.py and return a list
+    of (name, name) antenna name pairs.
+    """
+    
+    return [tuple(f.split('~', 1)) for f in flag_store.load_text_flags(filename)]
+
+
+def get_antenna_stands(filename):
+    """
+    Return the stand IDs of the antennas in a measurement set from their
+    'LWAxxx' names.
+    """
+    
+    tb = table(os.path.join(filename, 'ANTENNA'), ack=False)
+    names = tb.getcol('NAME')
+    tb.close()
+    
+    return np.array([int(name.replace('LWA', ''), 10) for name in names], dtype=np.int32)
+
+
+def get_baseline_mask(filename, bl_flags):
+    """
+    Given a measurement set and a list of (name, name) antenna pairs, return an
+    antenna x antenna boolean array that is True for flagged baselines.
+    
+    Each 'LWAxxx~LWAyyy' entry in baseline_flags.txt is the single baseline
+    between those two stands, which is what get_baseline_flags.py writes for
+    stands that share a RJ45 connector.  Note that this is not the same as
+    passing it to CASA's flagdata(antenna=...), which treats it as a range of
+    antennas.
+    """
+    
+    tb = table(os.path.join(filename, 'ANTENNA'), ack=False)
+    names = tb.getcol('NAME')
+    tb.close()
+    
+    index = {name: i for i,name in enumerate(names)}
+    mask = np.zeros((len(names), len(names)), dtype=bool)
+    for name1,name2 in bl_flags:
+        try:
+            i, j = index[name1], index[name2]
+        except KeyError:
+            continue
+        mask[i,j] = mask[j,i] = True
+    return mask
+
+
+def get_flag_masks(filename, nchan, bl_flags=None, store=None):
+    """
+    Build the flags for a measurement set with `nchan` channels and return a
+    two-element tuple of the channel flag mask and the antenna x antenna
+    baseline flag mask.  Either is None if nothing is flagged.  If a
+    flag_store.FlagStore instance is given as `store` the flags are taken from
+    the store, otherwise from the *_channel_flags.txt file and the list of
+    (name, name) baseline flags in `bl_flags`.  Raises a RuntimeError if the
+    measurement set is not in the store.
+    """
+    
+    if store is not None:
+        capture = flag_store.get_capture_name(filename)
+        try:
+            store.get_index(capture)
+        except KeyError:
+            raise RuntimeError("No flags for %s in %s" % (filename, store.path))
+        chan_mask = store.get_channel_flags(capture, nchan=nchan)
+        bl_mask = store.get_baseline_flags(capture, stands=get_antenna_stands(filename))
+    else:
+        chan_mask = None
+        chans = [c for c in load_channel_flags(filename) if c < nchan]
+        if len(chans) > 0:
+            chan_mask = np.zeros(nchan, dtype=bool)
+            chan_mask[chans] = True
+        bl_mask = None
+        if bl_flags is not None and len(bl_flags) > 0:
+            bl_mask = get_baseline_mask(filename, bl_flags)
+            
+    if chan_mask is not None and not chan_mask.any():
+        chan_mask = None
+    if bl_mask is not None and not bl_mask.any():
+        bl_mask = None
+    return chan_mask, bl_mask
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""
+Given a collection of TBW files, cross-correlate them across a pool of worker
+processes.  Each worker parses the station metadata and loads the flags once
+and then re-uses them for every file it is given.  Finished files are recorded
+in a manifest so that re-running the same command after a crash only works on
+the files that were not completed.
+"""
+
+import os
+import sys
+import glob
+import shutil
+import argparse
+import traceback
+from multiprocessing import Pool
+
+from lsl.misc import parser as aph
+
+import correlateTBW
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import flag_store
+
+
+# Per-process state for the file workers
+_WORKER = {}
+
+
+def load_manifest(filename):
+    """
+    Load a manifest file and return a dictionary of the output filenames for
+    each input filename that has been completed.
+    """
+    
+    done = {}
+    if os.path.exists(filename):
+        with open(filename, 'r') as fh:
+            for line in fh:
+                line = line.rstrip('\n')
+                if line == '' or line[0] == '#':
+                    continue
+                name, outnames = line.split('\t', 1)
+                done[name] = outnames.split(',')
+    return done
+
+
+def update_manifest(filename, name, outnames):
+    """
+    Record that the input filename `name` has been completed and has written
+    the outputs in `outnames`.
+    """
+    
+    with open(filename, 'a') as fh:
+        fh.write("%s\t%s\n" % (name, ','.join(outnames)))
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def is_complete(name, done):
+    """
+    Return if the input filename `name` is in the manifest and all of its
+    outputs still exist.
+    """
+    
+    try:
+        outnames = done[name]
+    except KeyError:
+        return False
+    return all([os.path.exists(o) for o in outnames])
+
+
+def remove_partial_outputs(filename, casa=False):
+    """
+    Remove any outputs for the input filename that were left behind by an
+    incomplete run so that the writers can create them again.
+    """
+    
+    basename = os.path.split(filename)[1]
+    basename, ext = os.path.splitext(basename)
+    pattern = correlateTBW.get_output_format(casa=casa).replace('%s', basename).replace('%i', '*')
+    for partial in glob.glob(pattern):
+        print("Removing partial output '%s'" % partial)
+        if os.path.isdir(partial):
+            shutil.rmtree(partial)
+        else:
+            os.remove(partial)
+
+
+def _init_worker(args):
+    """
+    Initialize a file worker by loading the station information, the list of
+    good digitizers, the correlator configuration, and the flag store.
+    """
+    
+    station = correlateTBW.load_station(args.metadata)
+    
+    ant_flags = correlateTBW.get_antenna_flags(args)
+    good = correlateTBW.select_good(station, use_all=args.all, ant_flags=ant_flags)
+    
+    # Worker processes cannot start their own pools so correlate the sections
+    # of each file serially
+    args.workers = 1
+    config = correlateTBW.build_config(args)
+    
+    flags = None
+    if args.flag_store is not None:
+        flags = flag_store.FlagStore(args.flag_store)
+        
+    _WORKER['station'] = station
+    _WORKER['good'] = good
+    _WORKER['config'] = config
+    _WORKER['flags'] = flags
+    _WORKER['args'] = args
+
+
+def _correlate_file(filename):
+    """
+    Correlate a single TBW file and return a three-element tuple of the filename,
+    the list of outputs written, and the traceback of any error (None if there
+    was not one).  The output of the correlator is saved to <basename>.log.
+    """
+    
+    args = _WORKER['args']
+    
+    basename = os.path.split(filename)[1]
+    basename, ext = os.path.splitext(basename)
+    
+    stdout = sys.stdout
+    with open("%s.log" % basename, 'w') as log:
+        sys.stdout = log
+        try:
+            remove_partial_outputs(filename, casa=args.casa)
+            outnames = correlateTBW.correlate_file(filename, _WORKER['station'], _WORKER['good'], _WORKER['config'],
+                                                   stream=args.stream, casa=args.casa, 
+                                                   flags=_WORKER['flags'], flag_capture=args.flag_capture)
+            error = None
+        except Exception:
+            outnames = []
+            error = traceback.format_exc()
+            log.write(error)
+        finally:
+            sys.stdout = stdout
+            
+    return filename, outnames, error
+
+
+def main(args):
+    # Initial file type check
+    filenames = args.filename
+    if filenames[0][-4:] == '.txt':
+        ## File list - load and replace filenames
+        with open(filenames[0], 'r') as fh:
+            filelist = fh.read()
+        filenames = filelist.split('\n')
+        if filenames[-1] == '':
+            filenames = filenames[:-1]
+            
+    # Skip what has already been done
+    done = load_manifest(args.manifest)
+    todo = [f for f in filenames if not is_complete(f, done)]
+    print("Found %i files, %i of which are already complete" % (len(filenames), len(filenames)-len(todo)))
+    if len(todo) == 0:
+        return
+        
+    # Make sure that the station and flags load before starting the workers
+    _init_worker(args)
+
+    # Go
+    nFailed = 0
+    with Pool(processes=min([args.file_workers, len(todo)]), initializer=_init_worker, initargs=(args,)) as pool:
+        for i,(filename,outnames,error) in enumerate(pool.imap_unordered(_correlate_file, todo)):
+            if error is None:
+                update_manifest(args.manifest, filename, outnames)
+                print("[%i/%i] %s -> %s" % (i+1, len(todo), filename, ', '.join(outnames)))
+            else:
+                nFailed += 1
+                print("[%i/%i] %s FAILED:\n%s" % (i+1, len(todo), filename, error))
+                
+    print("Completed %i of %i files" % (len(todo)-nFailed, len(todo)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='cross-correlate a collection of TBW files with a pool of workers',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str, nargs='+',
+                        help='filename(s) to correlate or a .txt file list')
+    parser.add_argument('-n', '--file-workers', type=aph.positive_int, default=4,
+                        help='number of files to correlate at once')
+    parser.add_argument('--manifest', type=str, default='correlate_manifest.txt',
+                        help='name of the manifest used to track completed files')
+    correlateTBW.add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
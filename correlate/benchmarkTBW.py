@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the TBW correlator.  A synthetic TBW file is written with
+simulateTBW.py (or an existing file is used) and the time spent reading the
+capture, in the F-engine, in the X-engine, and writing the output is measured
+separately for each combination of FFT length, F-engine type, set of
+polarization products, and X-engine precision.  The end-to-end time for
+process_chunk() is also measured.  When both precisions are run the speedup
+and numerical error of single precision relative to double precision are
+reported.  The results are saved as JSON so that runs on different versions of
+the code can be compared.
+"""
+
+import os
+import json
+import time
+import numpy
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime
+
+from lsl.reader.ldp import LWA1DataFile
+from lsl.correlator import fx as fxc
+from lsl.misc import parser as aph
+
+import engine
+import simulateTBW
+import correlateTBW
+
+
+#: Polarization products for each --products setting
+PRODUCTS = {'x': ['xx',], 'y': ['yy',], '2': ['xx','yy'], '4': ['xx','yy','xy','yx']}
+
+
+def time_stages(filename, station, good, outname, LFFT=64, pfb=False, pols=['xx','yy'], freq_range=(5.0e6, 93.0e6), nsec=8, precision='single'):
+    """
+    Correlate the first capture in a TBW file in `nsec` sections and return a 
+    two-element tuple of a dictionary of the wall time in seconds spent in 
+    each stage:
+     * read - reading the capture from the file,
+     * fengine - channelizing the data,
+     * xengine - cross-multiplying the spectra, and
+     * write - writing the visibilities to `outname`,
+    and a dictionary of the visibilities, keyed by polarization product.
+    """
+    
+    antennas = station.antennas
+    toKeep = [antennas[i].digitizer-1 for i in good]
+    mapper = [antennas[i] for i in good]
+    
+    timings = {}
+    
+    # Read
+    t0 = time.time()
+    idf = LWA1DataFile(filename)
+    sample_rate = idf.get_info('sample_rate')
+    readT, t, data = idf.read()
+    idf.close()
+    timings['read'] = time.time() - t0
+    
+    freq = engine.get_frequencies(LFFT, sample_rate)
+    chans = numpy.where( (freq>=freq_range[0]) & (freq<=freq_range[1]) )[0]
+    
+    # F- and X-engines
+    timings['fengine'] = 0.0
+    timings['xengine'] = 0.0
+    secSize = data.shape[1] // nsec
+    tempVis = {}
+    for k in range(nsec):
+        t0 = time.time()
+        _, signalsF, validF = engine.fengine(data[toKeep,k*secSize:(k+1)*secSize], mapper, LFFT=LFFT, pfb=pfb, sample_rate=sample_rate, 
+                                             dtype=engine.PRECISIONS[precision])
+        t1 = time.time()
+        blList, vis = engine.xengine(signalsF, validF, mapper, pols=pols, chans=chans)
+        t2 = time.time()
+        
+        timings['fengine'] += t1 - t0
+        timings['xengine'] += t2 - t1
+        correlateTBW.accumulate(tempVis, vis)
+        del signalsF, validF, vis
+    del data
+    
+    # Write
+    t0 = time.time()
+    writer_class = correlateTBW.get_writer_class(outname, len(good)//2)
+    pol1, pol2 = fxc.pol_to_pols(pols[0])
+    fits = writer_class(outname, ref_time=t)
+    fits.set_stokes(pols)
+    fits.set_frequency(freq[chans])
+    fits.set_geometry(station, [a for a in mapper if a.pol == pol1])
+    for pol in pols:
+        tempVis[pol] /= float(nsec)
+        fits.add_data_set(t, readT, blList[pol], tempVis[pol], pol=pol)
+    fits.write()
+    fits.close()
+    timings['write'] = time.time() - t0
+    
+    return timings, tempVis
+
+
+def get_error(vis, ref):
+    """
+    Given two dictionaries of visibilities keyed by polarization product, 
+    return a two-element tuple of the maximum and RMS differences between them
+    relative to the RMS of `ref`.
+    """
+    
+    diff2, ref2, n = 0.0, 0.0, 0
+    maxDiff = 0.0
+    for pol in ref:
+        diff = numpy.abs(vis[pol].astype(ref[pol].dtype) - ref[pol])
+        maxDiff = max([maxDiff, diff.max()])
+        diff2 += (diff**2).sum()
+        ref2 += (numpy.abs(ref[pol])**2).sum()
+        n += ref[pol].size
+    rms = numpy.sqrt(ref2 / n)
+    return maxDiff / rms, numpy.sqrt(diff2 / n) / rms
+
+
+def time_process_chunk(filename, station, good, outname, **kwargs):
+    """
+    Return the wall time in seconds that process_chunk() takes to correlate the
+    first capture in a TBW file.  Any keywords are passed to process_chunk().
+    """
+    
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            t0 = time.time()
+            idf = LWA1DataFile(filename)
+            correlateTBW.process_chunk(idf, station, good, outname, **kwargs)
+            idf.close()
+            tElapsed = time.time() - t0
+    return tElapsed
+
+
+def _remove_output(outname):
+    """
+    Remove a FITS-IDI file or measurement set written by a benchmark.
+    """
+    
+    if os.path.isdir(outname):
+        shutil.rmtree(outname)
+    elif os.path.exists(outname):
+        os.remove(outname)
+
+
+def main(args):
+    # Setup the LWA station information
+    station = correlateTBW.load_station(args.metadata)
+    
+    tempdir = tempfile.mkdtemp(prefix='benchmarkTBW-')
+    try:
+        # Get the data to work on
+        if args.filename is None:
+            station = simulateTBW.get_station(station, args.nstand)
+            filename = os.path.join(tempdir, 'synthetic.dat')
+            print("Writing a synthetic TBW file with %i stands" % args.nstand)
+            simulateTBW.write_tbw(filename, args.nstand, ncapture=1, tones=[38e6, 74e6], seed=args.seed)
+            good = correlateTBW.select_good(station, use_all=True)
+        else:
+            filename = args.filename
+            good = correlateTBW.select_good(station, use_all=args.all)
+        print("Benchmarking with %i stands" % (len(good)//2,))
+        
+        outname = os.path.join(tempdir, correlateTBW.get_output_format(casa=args.casa) % ('benchmark', 1))
+        
+        results = []
+        for LFFT in args.fft_length:
+            for pfb in ([False, True] if args.pfb else [False,]):
+                for products in args.products:
+                    pols = PRODUCTS[products]
+                    
+                    entries, vis = {}, {}
+                    for precision in args.precision:
+                        best = {}
+                        for r in range(args.repeat):
+                            timings, vis[precision] = time_stages(filename, station, good, outname, LFFT=LFFT, pfb=pfb, pols=pols, precision=precision)
+                            _remove_output(outname)
+                            timings['process_chunk'] = time_process_chunk(filename, station, good, outname, LFFT=LFFT, pfb=pfb, pols=pols, 
+                                                                          workers=args.workers, precision=precision)
+                            _remove_output(outname)
+                            
+                            for stage in timings:
+                                best[stage] = min([best.get(stage, numpy.inf), timings[stage]])
+                                
+                        entry = {'fft_length': LFFT, 'pfb': pfb, 'products': pols, 'precision': precision}
+                        entry.update(best)
+                        entries[precision] = entry
+                        results.append(entry)
+                        
+                        print("LFFT=%5i  PFB=%-5s  %-11s  %-6s  read %7.3f s  F %7.3f s  X %7.3f s  write %7.3f s  process_chunk %7.3f s" % (LFFT, pfb, ','.join(pols), precision, best['read'], best['fengine'], best['xengine'], best['write'], best['process_chunk']))
+                        
+                    # Compare single precision to double precision
+                    if 'single' in entries and 'double' in entries:
+                        single, double = entries['single'], entries['double']
+                        single['speedup'] = (double['fengine'] + double['xengine']) / (single['fengine'] + single['xengine'])
+                        single['speedup_process_chunk'] = double['process_chunk'] / single['process_chunk']
+                        single['max_error'], single['rms_error'] = get_error(vis['single'], vis['double'])
+                        
+                        print("  single precision:  F+X %.2fx faster, process_chunk %.2fx faster, max error %.2e, RMS error %.2e" % (single['speedup'], single['speedup_process_chunk'], single['max_error'], single['rms_error']))
+                    del vis
+    finally:
+        shutil.rmtree(tempdir)
+        
+    # Save
+    output = {'date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+              'host': platform.node(), 'python': platform.python_version(), 'numpy': numpy.__version__,
+              'filename': args.filename, 'nstand': len(good)//2, 'workers': args.workers, 'repeat': args.repeat,
+              'results': results}
+    with open(args.output, 'w') as fh:
+        json.dump(output, fh, indent=2)
+    print("Saved benchmark results to '%s'" % args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='benchmark the TBW correlator on synthetic or real data',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('-m', '--metadata', type=str,
+                        help='name of SSMIF or metadata tarball file to use for mappings')
+    parser.add_argument('-f', '--filename', type=str,
+                        help='TBW file to benchmark with instead of a synthetic one')
+    parser.add_argument('-n', '--nstand', type=aph.positive_int, default=16,
+                        help='number of stands in the synthetic TBW file')
+    parser.add_argument('--seed', type=int,
+                        help='random number generator seed for the synthetic TBW file')
+    parser.add_argument('-l', '--fft-length', type=aph.positive_int, nargs='+', default=[64, 512, 3920],
+                        help='FFT length(s) to benchmark')
+    parser.add_argument('-p', '--pfb', action='store_true',
+                        help='benchmark the PFB F-engine as well as the FFT F-engine')
+    parser.add_argument('--products', type=str, nargs='+', choices=['x', 'y', '2', '4'], default=['2', '4'],
+                        help='polarization product set(s) to benchmark:  XX only, YY only, XX and YY, or all four')
+    parser.add_argument('--precision', type=str, nargs='+', choices=['single', 'double'], default=['single', 'double'], 
+                        help='X-engine precision(s) to benchmark; if both are given the speedup and error of single precision are reported')
+    parser.add_argument('-w', '--workers', type=aph.positive_int, default=1,
+                        help='number of processes for process_chunk() to use')
+    parser.add_argument('-r', '--repeat', type=aph.positive_int, default=1,
+                        help='number of times to repeat each benchmark; the best time is kept')
+    parser.add_argument('-a', '--all', action='store_true',
+                        help='correlated all dipoles regardless of their status when using --filename')
+    parser.add_argument('--casa', action='store_true',
+                        help='benchmark writing measurement sets instead of FITS-IDI files')
+    parser.add_argument('-o', '--output', type=str, default='benchmark.json',
+                        help='filename to save the results to')
+    args = parser.parse_args()
+    main(args)
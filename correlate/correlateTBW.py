@@ -1,37 +1,377 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """
 Example script that reads in TBW data and runs a cross-correlation on it.  
 The results are saved in the FITS IDI format.
 """
 
-# Python2 compatibility
-from __future__ import print_function, division, absolute_import
-import sys
-if sys.version_info < (3,):
-    range = xrange
-    
 import os
 import sys
 import time
 import numpy
 import argparse
+import threading
+from queue import Queue
+from multiprocessing import Pool, shared_memory
 
+from lsl.reader import errors
 from lsl.reader.ldp import LWA1DataFile, TBWFile
-from lsl.common import stations, metabundle
 from lsl.correlator import fx as fxc
-from lsl.writer import fitsidi, measurementset
+from lsl.writer import fitsidi
 from lsl.common.progress import ProgressBar
 from lsl.misc import parser as aph
 
+import engine
+import reader
+import mswriter
+import profiler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import station_cache
+import flag_store
+
 from lsl.misc import telemetry
 telemetry.track_script()
 
 
-def process_chunk(idf, site, good, filename, LFFT=64, overlap=1, pfb=False, pols=['xx','yy']):
+def get_antenna_flags(args):
+    """
+    Given the parsed command line arguments, load the antenna flags from the
+    antenna_flags.txt file and/or the flag store and return a list of the
+    flagged antenna indices.  The antenna flags are night-wide so, unless 
+    --flag-capture is given, those of all of the captures in the store are 
+    used.
+    """
+    
+    ant_flags = []
+    if args.antenna_flags is not None:
+        ant_flags = flag_store.load_antenna_flags(args.antenna_flags)
+        print("Loaded %i antenna flags from '%s'" % (len(ant_flags), os.path.basename(args.antenna_flags)))
+        
+    if args.flag_store is not None:
+        with flag_store.FlagStore(args.flag_store) as store:
+            flags = numpy.where(store.get_antenna_flags(args.flag_capture))[0]
+        ant_flags = sorted(set(ant_flags) | set(flags.tolist()))
+        print("Loaded %i antenna flags from '%s'" % (len(flags), os.path.basename(args.flag_store)))
+        
+    return ant_flags
+
+
+def load_delay_cal(filename, antennas):
+    """
+    Load the delays from a .dcal measurement set created by two_point_selfcal.py
+    and return an array of delays, in seconds, for each Antenna instance in 
+    `antennas`.  Antennas without a solution are given a delay of zero.
+    """
+    
+    from casacore.tables import table
+    
+    tb = table(os.path.join(filename, 'ANTENNA'), ack=False)
+    names = tb.getcol('NAME')
+    tb.close()
+    
+    tb = table(filename, ack=False)
+    ant = tb.getcol('ANTENNA1')[...]
+    dly = tb.getcol('FPARAM')[...]
+    tb.close()
+    
+    # Map stand ID to delays for both polarizations
+    solutions = {}
+    for a,d in zip(ant, dly):
+        stand = int(names[a].replace('LWA', ''), 10)
+        solutions[stand] = d[0,:]*1e-9
+        
+    delays = numpy.zeros(len(antennas), dtype=numpy.float64)
+    missing = 0
+    for i,ant in enumerate(antennas):
+        try:
+            delays[i] = solutions[ant.stand.id][ant.pol]
+        except KeyError:
+            missing += 1
+    if missing > 0:
+        print("WARNING: %i inputs do not have a delay solution in '%s'" % (missing, os.path.basename(filename)))
+        
+    return delays
+
+
+# Per-process state for the sub-integration workers
+_WORKER = {}
+
+
+def _init_worker(shm_name, shape, dtype, mapper, config):
+    """
+    Initialize a sub-integration worker by attaching to the shared memory block
+    that holds the data for the good digitizers.
+    """
+    
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _WORKER['shm'] = shm
+    _WORKER['data'] = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _WORKER['mapper'] = mapper
+    _WORKER['config'] = config
+
+
+def correlate_section(section, mapper, config, timer=None, index=-1, weight=1.0):
+    """
+    Correlate a section of data for the inputs in `mapper` using the engine 
+    settings in `config` and return a dictionary of arrays that can be summed
+    across sections.  If `timer` is a profiler.StageTimer instance the time 
+    spent in each engine is added to it for sub-integration `index`.  The 
+    dictionary contains:
+     * the visibilities for each polarization product, keyed by product,
+     * if spectral kurtosis flagging is enabled through config['sk_sigma'], the
+       number of times each baseline/channel was used, keyed by 'wgt_'+product,
+       and the number of times each input/channel was flagged, keyed by 'sk'.
+    The visibilities and the usage counts are scaled by `weight`, the length of
+    the section relative to a full one, so that a short final section counts
+    for less in the sums.
+    """
+    
+    fconfig = {}
+    for key in ('LFFT', 'overlap', 'pfb', 'sample_rate', 'gain_correct', 'delay_cal', 'dtype'):
+        fconfig[key] = config[key]
+    xconfig = {}
+    for key in ('pols', 'include_auto', 'chans', 'flagged'):
+        xconfig[key] = config[key]
+        
+    if timer is None:
+        timer = profiler.StageTimer()
+        
+    with timer.stage('fengine', index):
+        freq, signalsF, validF = engine.fengine(section, mapper, **fconfig)
+        
+    chan_valid = None
+    if config.get('sk_sigma', None) is not None:
+        with timer.stage('sk', index):
+            sk, M = engine.spectral_kurtosis(signalsF, validF)
+            skFlags = engine.get_sk_flags(sk, M, sigma=config['sk_sigma'])
+            chan_valid = ~skFlags
+            
+    with timer.stage('xengine', index):
+        _, output = engine.xengine(signalsF, validF, mapper, chan_valid=chan_valid, **xconfig)
+    del signalsF, validF
+    if weight != 1.0:
+        for pol in config['pols']:
+            output[pol] *= weight
+            
+    if chan_valid is not None:
+        for pol in config['pols']:
+            wgt = engine.get_baseline_weights(chan_valid, mapper, pol, include_auto=config['include_auto'], 
+                                              chans=config['chans'], flagged=config['flagged'])
+            output['wgt_'+pol] = wgt.astype(numpy.float32)*weight
+        output['sk'] = skFlags.astype(numpy.uint16)
+        
+    return output
+
+
+def accumulate(total, part):
+    """
+    Add the arrays in the dictionary `part` to those in `total`, adding any 
+    that are not already in `total`.
+    """
+    
+    for key in part:
+        try:
+            total[key] += part[key]
+        except KeyError:
+            total[key] = part[key]
+
+
+def _correlate_sections(sections):
+    """
+    Correlate a list of (index, (start, stop, weight)) sample ranges from the
+    shared data and return a three-element tuple of the summed output of 
+    correlate_section(), the number of sections processed, and the list of 
+    profiler records for the sections.
+    """
+    
+    data = _WORKER['data']
+    timer = profiler.StageTimer()
+    
+    partial = {}
+    for k,(start,stop,weight) in sections:
+        output = correlate_section(data[:,start:stop], _WORKER['mapper'], _WORKER['config'], timer=timer, index=k, weight=weight)
+        with timer.stage('accumulate', k):
+            accumulate(partial, output)
+        del output
+        
+    return partial, len(sections), timer.records
+
+
+def correlate_parallel(data, toKeep, mapper, sections, config, workers, pb=None, timer=None):
+    """
+    Correlate the sub-integrations given by `sections` on a pool of `workers`
+    processes.  The data for the good digitizers are copied once into a shared
+    memory block that all of the workers read from and each worker returns the 
+    sum of the visibilities for the sections it processed.  Returns the sum of
+    the correlate_section() output over all sections.  If `timer` is a
+    profiler.StageTimer instance the records from the workers are added to it.
+    """
+    
+    shape = (len(toKeep), data.shape[1])
+    shm = shared_memory.SharedMemory(create=True, size=int(numpy.prod(shape))*data.dtype.itemsize)
+    try:
+        shared = numpy.ndarray(shape, dtype=data.dtype, buffer=shm.buf)
+        numpy.take(data, toKeep, axis=0, out=shared)
+        
+        groups = [list(enumerate(sections))[i::workers] for i in range(workers)]
+        groups = [g for g in groups if len(g) > 0]
+        
+        total = {}
+        with Pool(processes=len(groups), initializer=_init_worker, 
+                  initargs=(shm.name, shape, data.dtype, mapper, config)) as pool:
+            for partial, nDone, records in pool.imap_unordered(_correlate_sections, groups):
+                accumulate(total, partial)
+                del partial
+                
+                if timer is not None:
+                    timer.extend(records)
+                
+                if pb is not None:
+                    pb.inc(amount=nDone)
+                    sys.stdout.write(pb.show()+'\r')
+                    sys.stdout.flush()
+                    
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+        
+    return total
+
+
+def prefetch_captures(idf, nSets):
+    """
+    Generator that yields the (readT, t, data) tuples for up to `nSets` captures
+    in an lsl.reader.ldp.TBWFile instance.  The next capture is read and decoded
+    in a background thread while the current one is being correlated so that at
+    most two captures are held in memory at once.
+    
+    If the generator is closed before it is exhausted, e.g., because a capture
+    failed to correlate, the reader thread is stopped and joined and any
+    capture that it had already read is dropped.
+    """
+    
+    queue = Queue()
+    slots = threading.Semaphore(2)
+    stop = threading.Event()
+    
+    def _reader():
+        try:
+            for s in range(nSets):
+                slots.acquire()
+                if stop.is_set():
+                    break
+                try:
+                    queue.put(idf.read())
+                except errors.EOFError:
+                    break
+        except Exception as e:
+            queue.put(e)
+        queue.put(None)
+        
+    thread = threading.Thread(target=_reader, name='TBWReader')
+    thread.daemon = True
+    thread.start()
+    
+    try:
+        while True:
+            capture = queue.get()
+            if capture is None:
+                break
+            elif isinstance(capture, Exception):
+                raise capture
+            yield capture
+            del capture
+            slots.release()
+    finally:
+        # Wake up the reader if it is waiting for a slot, wait for it to 
+        # finish, and then drop anything that it left behind
+        stop.set()
+        slots.release()
+        thread.join()
+        while not queue.empty():
+            queue.get()
+            
+            
+def get_writer_class(filename, nstand):
+    """
+    Given an output filename and the number of stands, return the writer class
+    to use for saving the visibilities.
+    """
+    
+    if os.path.splitext(filename)[1].find('.ms_') != -1:
+        writer_class = mswriter.TiledMs
+    else:
+        if nstand > 255:
+            writer_class = fitsidi.ExtendedIdi
+        else:
+            writer_class = fitsidi.Idi
+    return writer_class
+
+
+def process_chunk(idf, site, good, filename, LFFT=64, overlap=1, pfb=False, pols=['xx','yy'], workers=1, capture=None, ref_time=None, set_number=1, max_memory=None, freq_range=(5.0e6, 93.0e6), chan_flags=None, bl_flags=None, delay_cal=None, sk_sigma=None, precision='single', chan_average=1, max_smearing=None, profile=None, timer=None):
     """
     Given an lsl.reader.ldp.TBWFile instances and various parameters for the 
     cross-correlation, write cross-correlate the data and save it to a file.
+    
+    If `workers` is greater than one the sub-integrations are correlated in
+    parallel on a pool of that many processes.
+    
+    If `capture` is provided it is used as the (readT, t, data) tuple for the 
+    capture to correlate instead of reading the next one from `idf`.  This, 
+    along with `ref_time` and `set_number`, are used to correlate captures 
+    that come from prefetch_captures().
+    
+    If `max_memory` is provided the capture is not loaded in its entirety.  
+    Instead, the section size is chosen to keep the memory usage below that 
+    many bytes and each section is read from the file into a re-used buffer as
+    it is needed.  Sections are correlated serially in this mode.
+    
+    Only channels within `freq_range` (in Hz) are cross-multiplied and written
+    out.  `chan_flags` is an optional list of channel indices, relative to the
+    first channel in `freq_range` as in the *_channel_flags.txt files, that are 
+    also skipped.  These are written out as zeros, with a weight of zero so
+    that they are flagged, to keep the channels in the output evenly spaced.
+    
+    `bl_flags` is an optional list of (stand, stand) ID pairs whose baselines 
+    are skipped in the X-engine.  These are written out as zeros with a weight
+    of zero so that they are flagged in the output.  When it is given a packed 
+    baseline mask is also saved to <filename>_baseline_mask.npz.
+    
+    `delay_cal` is an optional .dcal table from two_point_selfcal.py whose delays
+    are removed from the spectra in the F-engine so that the output is already
+    delay calibrated.
+    
+    If `sk_sigma` is provided the spectral kurtosis of each input and channel 
+    is computed for every section from the F-engine output.  Spectra that
+    deviate from Gaussian noise by more than that many sigma are excluded from
+    the accumulation and the number of sections flagged for each input and 
+    channel is saved to <filename>_sk_flags.npz.  The output weights are the
+    fraction of the sections that were used for each baseline and channel so 
+    that partially excised visibilities are down weighted and those that were
+    completely excised are flagged.
+    
+    `precision` sets the precision of the X-engine and the accumulation to
+    either 'single' (complex64) or 'double' (complex128).  The F-engine always 
+    channelizes in single precision.
+    
+    `chan_average` is the number of adjacent channels to average together 
+    before the visibilities are written out.  Channels skipped with 
+    `chan_flags` do not contribute to the average and `chan_flags` are given 
+    in terms of the averaged channels.  If `max_smearing` is provided each 
+    cross-correlation is further averaged in frequency over as many of the 
+    output channels as possible while keeping the bandwidth smearing loss for 
+    a source on the horizon below that fraction.  The averaged values are 
+    repeated across the channels they cover so that all baselines share the 
+    same set of channels in the output.
+    
+    The wall time, CPU time, and peak RSS of reading the capture, of the F- 
+    and X-engines for each sub-integration, and of averaging and writing the 
+    output are recorded.  If `profile` is 'json' or 'csv' these are saved to 
+    <filename>_profile.json or <filename>_profile.csv.  `timer` is an optional
+    profiler.StageTimer instance to add the records to, e.g., one that already
+    holds the time spent waiting on prefetch_captures().
     """
     
     # Get antennas
@@ -51,115 +391,245 @@ def process_chunk(idf, site, good, filename, LFFT=64, overlap=1, pfb=False, pols
     stands = set( [antennas[i].stand.id for i in good] )
     
     # Figure out the output mode
-    if os.path.splitext(filename)[1].find('.ms_') != -1:
-        writer_class = measurementset.Ms
-    else:
-        if len(stands) > 255:
-            writer_class = fitsidi.ExtendedIdi
-        else:
-            writer_class = fitsidi.Idi
-            
+    writer_class = get_writer_class(filename, len(stands))
+    
+    if timer is None:
+        timer = profiler.StageTimer()
+        
     wallTime = time.time()
-    readT, t, data = idf.read()
+    with timer.stage('read'):
+        if max_memory is not None:
+            # Index the capture so that we can read sections from it as needed
+            t, spf, offsets = reader.index_capture(idf.fh, len(antennas)//2)
+            readT = reader.FRAMES_PER_CAPTURE*spf / sample_rate
+            endOfCapture = idf.fh.tell()
+            data = None
+            nSample = reader.FRAMES_PER_CAPTURE*spf
+        else:
+            if capture is None:
+                capture = idf.read()
+            readT, t, data = capture
+            del capture
+            nSample = data.shape[1]
+            spf, offsets = 400, None
     setTime = t
-    ref_time = t
-    
+    if ref_time is None:
+        ref_time = t
+        
     # Setup the set time as a python datetime instance so that it can be easily printed
     setDT = setTime.datetime
-    print("Working on set #1 (%.3f seconds after set #1 = %s)" % ((setTime-ref_time), setDT.strftime("%Y/%m/%d %H:%M:%S.%f")))
+    print("Working on set #%i (%.3f seconds after set #1 = %s)" % (set_number, (setTime-ref_time), setDT.strftime("%Y/%m/%d %H:%M:%S.%f")))
+    
+    # Figure out which channels to write out and which of those to correlate
+    freq = engine.get_frequencies(LFFT, sample_rate)
+    toUse = numpy.where( (freq>=freq_range[0]) & (freq<=freq_range[1]) )
+    toUse = toUse[0]
+    toUse = toUse[:(toUse.size//chan_average)*chan_average]
+    toCorrelate = numpy.arange(toUse.size)
+    if chan_flags is not None:
+        chan_flags = (numpy.array(chan_flags, dtype=numpy.int64)[:,None]*chan_average + numpy.arange(chan_average)).ravel()
+        toCorrelate = numpy.setdiff1d(toCorrelate, chan_flags)
+    print("Correlating %i of %i channels" % (toCorrelate.size, LFFT))
+    
+    # Figure out which baselines to skip
+    flagged = None
+    if bl_flags is not None:
+        flagged = engine.get_baseline_flags(mapper, bl_flags, include_auto=True)
+        print("Skipping %i of %i baselines" % (flagged.sum(), flagged.size))
+        
+    # Load in the delay calibration
+    delays = None
+    if delay_cal is not None:
+        delays = load_delay_cal(delay_cal, mapper)
     
     # In order for the TBW stuff to actaully run, we need to run in with sub-
     # integrations.  8 sub-integrations (61.2 ms / 8 = 7.7 ms per section) 
-    # seems to work ok with a "reasonable" number of channels.
-    nSec = 8
-    secSize = data.shape[1]//nSec
+    # seems to work ok with a "reasonable" number of channels.  If we have a 
+    # memory budget use that to set the section size instead.  The sections
+    # are a whole number of FFT windows with a shorter one at the end, if 
+    # needed, that is weighted by its length when they are averaged.
+    nSec, secSize = reader.get_section_size(len(toKeep), nSample, LFFT, npol=len(pols), nchan=toCorrelate.size, max_memory=max_memory, spf=spf, 
+                                            itemsize=numpy.dtype(engine.PRECISIONS[precision]).itemsize, 
+                                            index_size=0 if offsets is None else offsets.nbytes)
+    sections = [(start, stop, (stop-start)/float(secSize)) for start,stop in reader.get_sections(nSample, secSize, LFFT)]
+    nWeight = sum([weight for start,stop,weight in sections])
+    if max_memory is not None:
+        buffer = numpy.empty((len(toKeep), secSize), dtype=numpy.int16)
+        print("Using %i sections of %i samples to stay within %.1f MB" % (nSec, secSize, max_memory/1024.0**2))
+        
+    # Set up the progress bar so we can keep up with how the sub-integrations 
+    # are progressing
+    pb = ProgressBar(max=nSec)
+    sys.stdout.write(pb.show()+'\r')
+    sys.stdout.flush()
     
-    # Loop over polarizations (there should be only 1)
-    for pol in pols:
-        print("-> %s" % pol)
-        try:
-            tempVis *= 0    # pylint:disable=undefined-variable
-        except NameError:
-            pass
-            
-        # Set up the progress bar so we can keep up with how the sub-integrations 
-        # are progressing
-        pb = ProgressBar(max=nSec)
-        sys.stdout.write(pb.show()+'\r')
-        sys.stdout.flush()
-        
-        # Loop over sub-integrations (set by nSec)
-        for k in range(nSec):
-            blList, freq, vis = fxc.FXMaster(data[toKeep,k*secSize:(k+1)*secSize], mapper, LFFT=LFFT, overlap=overlap, pfb=pfb, include_auto=True, verbose=False, sample_rate=sample_rate, central_freq=0.0, pol=pol, return_baselines=True, gain_correct=True)
+    # Loop over sub-integrations (set by nSec).  Each section is channelized 
+    # once and all of the polarization products are formed from those spectra.
+    config = {'pols': pols, 'LFFT': LFFT, 'overlap': overlap, 'pfb': pfb, 
+              'sample_rate': sample_rate, 'include_auto': True, 'gain_correct': True, 
+              'chans': toUse[toCorrelate], 'flagged': flagged, 'delay_cal': delays, 
+              'sk_sigma': sk_sigma, 'dtype': engine.PRECISIONS[precision]}
+    if workers > 1 and max_memory is None:
+        with timer.stage('correlate'):
+            tempVis = correlate_parallel(data, toKeep, mapper, sections, config, min([workers, nSec]), pb=pb, timer=timer)
+    else:
+        tempVis = {}
+        for k,(start,stop,weight) in enumerate(sections):
+            if max_memory is not None:
+                with timer.stage('read', k):
+                    section = reader.read_section(idf.fh, offsets, toKeep, start, stop, spf, out=buffer)
+            else:
+                section = data[toKeep,start:stop]
+            output = correlate_section(section, mapper, config, timer=timer, index=k, weight=weight)
+            del section
             
-            toUse = numpy.where( (freq>=5.0e6) & (freq<=93.0e6) )
-            toUse = toUse[0]
+            with timer.stage('accumulate', k):
+                accumulate(tempVis, output)
+            del output
             
-            try:
-                tempVis += vis
-            except NameError:
-                tempVis = vis
-                
             pb.inc(amount=1)
             sys.stdout.write(pb.show()+'\r')
             sys.stdout.flush()
-            
-        # Average the sub-integrations together
-        vis = tempVis / float(nSec)
+    sys.stdout.write(pb.show()+'\r')
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+    
+    # Build the baseline lists
+    blList, outList = {}, {}
+    for pol in pols:
+        blList[pol] = engine.get_baseline_list(mapper, pol, include_auto=True, flagged=flagged)
+        outList[pol] = engine.get_baseline_list(mapper, pol, include_auto=True)
         
-        # Set up the FITS IDI file is we need to
-        if pol == pols[0]:
-            pol1, pol2 = fxc.pol_to_pols(pol)
+    # Figure out the output channels
+    outFreq = engine.average_frequencies(freq[toUse], chan_average)
+    chan_width = chan_average*(freq[1] - freq[0])
+    if chan_average > 1:
+        print("Averaging to %i channels of %.3f kHz" % (outFreq.size, chan_width/1e3))
+        
+    # Loop over polarizations
+    for pol in pols:
+        print("-> %s" % pol)
+        
+        # Average the sub-integrations together and fill in the channels that
+        # were not correlated.  The weights are the fraction of the sections,
+        # by length, that went into each visibility.
+        with timer.stage('average'):
+            vis = numpy.zeros((tempVis[pol].shape[0], toUse.size), dtype=tempVis[pol].dtype)
+            weights = numpy.zeros(vis.shape, dtype=numpy.float32)
+            if sk_sigma is not None:
+                wgt = tempVis['wgt_'+pol]
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    vis[:,toCorrelate] = numpy.where(wgt > 0, tempVis[pol] / wgt, 0)
+                weights[:,toCorrelate] = wgt / nWeight
+                del tempVis['wgt_'+pol], wgt
+            else:
+                vis[:,toCorrelate] = tempVis[pol] / nWeight
+                weights[:,toCorrelate] = 1.0
+            del tempVis[pol]
             
-            fits = writer_class(filename, ref_time=ref_time)
-            fits.set_stokes(pols)
-            fits.set_frequency(freq[toUse])
-            fits.set_geometry(site, [a for a in mapper if a.pol == pol1])
+            # Average in frequency.  The output weights are the fraction of
+            # the averaged channels that were correlated.
+            if chan_average > 1:
+                vis, weights = engine.average_channels(vis, chan_average, weights=weights)
+                weights /= chan_average
+            if max_smearing is not None:
+                lengths = engine.get_baseline_lengths(blList[pol])
+                factors = engine.get_smearing_factors(lengths, chan_width, max_smearing, vis.shape[1])
+                factors[[a1.stand.id == a2.stand.id for a1,a2 in blList[pol]]] = 1
+                vis = engine.smearing_average(vis, factors, weights=weights)
+                del lengths, factors
+                
+            # Put back the baselines that were skipped with zero weight
+            if flagged is not None:
+                vis = engine.fill_baselines(vis, flagged)
+                weights = engine.fill_baselines(weights, flagged)
+                
+        with timer.stage('write'):
+            # Set up the FITS IDI file is we need to
+            if pol == pols[0]:
+                pol1, pol2 = fxc.pol_to_pols(pol)
+                
+                fits = writer_class(filename, ref_time=ref_time)
+                fits.set_stokes(pols)
+                fits.set_frequency(outFreq)
+                fits.set_geometry(site, [a for a in mapper if a.pol == pol1])
+                
+            # Add the visibilities and their weights - the channels and 
+            # baselines that were not correlated have zero weight
+            fits.add_data_set(setTime, readT, outList[pol], vis, weights=weights, pol=pol)
+            del weights
             
-        # Add the visibilities
-        fits.add_data_set(setTime, readT, blList, vis[:,toUse], pol=pol)
-        sys.stdout.write(pb.show()+'\r')
-        sys.stdout.write('\n')
-        sys.stdout.flush()
-    print("->  Cummulative Wall Time: %.3f s (%.3f s per integration)" % ((time.time()-wallTime), (time.time()-wallTime)))
-    
-    fits.write()
-    fits.close()
-    del(fits)
+    with timer.stage('write'):
+        fits.write()
+        fits.close()
+        del(fits)
+        
+    # Report on where the time went
+    wallTime = time.time() - wallTime
+    print("->  Wall Time: %.3f s, Peak RSS: %.1f MB" % (wallTime, timer.get_peak_rss()/1024.0**2))
+    print("    read %.3f s, F-engine %.3f s, X-engine %.3f s, average %.3f s, write %.3f s" % tuple([timer.get_total(name) for name in ('read', 'fengine', 'xengine', 'average', 'write')]))
+    if workers > 1 and max_memory is None:
+        print("    F- and X-engine times are summed over %i workers" % min([workers, nSec]))
+        
+    # Save the timing information
+    if profile is not None:
+        info = {'filename': filename, 'set_number': set_number, 'wall': wallTime, 
+                'workers': workers, 'nsection': nSec, 'section_size': secSize, 
+                'LFFT': LFFT, 'nchan': int(toCorrelate.size), 'ninput': len(toKeep), 'pols': pols, 
+                'max_memory': max_memory, 'precision': precision}
+        timer.save("%s_profile.%s" % (filename, profile), info=info)
+        
+    # Save the baseline mask
+    if flagged is not None:
+        numpy.savez("%s_baseline_mask.npz" % filename, 
+                    stands=numpy.array([a.stand.id for a in mapper if a.pol == 0]), 
+                    nbaseline=flagged.size, mask=numpy.packbits(flagged))
+        
+    # Save the spectral kurtosis flag statistics
+    if sk_sigma is not None:
+        numpy.savez("%s_sk_flags.npz" % filename, 
+                    stands=numpy.array([a.stand.id for a in mapper]), pols=numpy.array([a.pol for a in mapper]), 
+                    freq=freq[toUse[toCorrelate]], nsection=nSec, sigma=sk_sigma, 
+                    flagged=tempVis['sk'][:,toUse[toCorrelate]])
+        print("Spectral kurtosis flagged %.1f%% of the input/channel/sections" % (100.0*tempVis['sk'][:,toUse[toCorrelate]].mean()/nSec,))
     del(data)
     del(vis)
+    
+    # Make sure that we are ready to read the next capture
+    if max_memory is not None:
+        idf.fh.seek(endOfCapture)
+        
     return True
 
 
-def main(args):
-    # Parse command line options
-    filename = args.filename
+def load_station(metadata=None):
+    """
+    Load the LWA station information from a SSMIF or metadata tarball.  If 
+    `metadata` is None, LWA1 is used.  The parsed station is cached by 
+    station_cache so that it only needs to be parsed once.
+    """
+    
+    return station_cache.load_station(metadata, apply_sdm=True)
 
-    # Setup the LWA station information
-    if args.metadata is not None:
-        try:
-            station = stations.parse_ssmif(args.metadata)
-        except ValueError:
-            station = metabundle.get_station(args.metadata, apply_sdm=True)
-    else:
-        station = stations.lwa1
-    antennas = station.antennas
+
+def select_good(station, use_all=False, ant_flags=[]):
+    """
+    Given a Station instance, return the list of good digitizers to correlate 
+    where both polarizations of a stand are good.  If `use_all` is True, the
+    antenna status is ignored.  `ant_flags` is a list of antenna indices to
+    exclude.
+    """
     
-    idf = LWA1DataFile(filename)
-    if not isinstance(idf, TBWFile):
-        raise RuntimeError("File '%s' does not appear to be a valid TBW file" % os.path.basename(filename))
-        
-    jd = idf.get_info('start_time').jd
-    date = idf.get_info('start_time').datetime
-    sample_rate = idf.get_info('sample_rate')
-    nInts = idf.get_info('nframe') // (30000 * len(antennas) // 2)
+    antennas = station.antennas
     
     # Get valid stands for both polarizations
     goodX = []
     goodY = []
     for i in range(len(antennas)):
         ant = antennas[i]
-        if ant.combined_status != 33 and not args.all:
+        if ant.combined_status != 33 and not use_all:
+            pass
+        elif i in ant_flags:
             pass
         else:
             if ant.pol == 0:
@@ -176,46 +646,207 @@ def main(args):
                 good.append(antY.digitizer-1)
                 break
                 
+    return good
+
+
+def build_config(args):
+    """
+    Given the parsed command line arguments, load any flag files and return a
+    dictionary of the keyword arguments for process_chunk() that are common to
+    all captures.
+    """
+    
+    max_memory = None
+    if args.max_memory is not None:
+        max_memory = int(args.max_memory*1024**3)
+        if args.workers > 1:
+            print("WARNING: --max-memory correlates sections serially, ignoring --workers")
+            
+    chan_flags = None
+    if args.channel_flags is not None:
+        chan_flags = flag_store.load_channel_flags(args.channel_flags)
+        print("Loaded %i channel flags from '%s'" % (len(chan_flags), os.path.basename(args.channel_flags)))
+        
+    bl_flags = None
+    if args.baseline_flags is not None:
+        bl_flags = flag_store.load_baseline_flags(args.baseline_flags)
+        print("Loaded %i baseline flags from '%s'" % (len(bl_flags), os.path.basename(args.baseline_flags)))
+        
+    config = {'LFFT': args.fft_length, 'overlap': 1, 'pfb': args.pfb, 'pols': args.products, 
+              'workers': args.workers, 'max_memory': max_memory, 
+              'freq_range': (args.freq_range[0]*1e6, args.freq_range[1]*1e6), 'chan_flags': chan_flags, 
+              'bl_flags': bl_flags, 'delay_cal': args.delay_cal, 'sk_sigma': args.sk_sigma, 
+              'precision': args.precision, 'chan_average': args.channel_average, 'max_smearing': args.max_smearing, 
+              'profile': args.profile}
+    return config
+
+
+def get_capture_config(config, store, capture):
+    """
+    Given the process_chunk() keyword arguments from build_config(), a 
+    flag_store.FlagStore instance, and the name of a capture in it, return a
+    copy of the keyword arguments with the channel and baseline flags of that
+    capture added.  Raises a RuntimeError if the capture is not in the store.
+    """
+    
+    try:
+        store.get_index(capture)
+    except KeyError:
+        raise RuntimeError("Capture '%s' is not in the flag store '%s'" % (capture, store.path))
+        
+    chans = numpy.where(store.get_channel_flags(capture))[0].tolist()
+    pairs = store.get_baseline_pairs(capture)
+    print("Loaded %i channel and %i baseline flags for '%s' from '%s'" % (len(chans), len(pairs), capture, os.path.basename(store.path)))
+    
+    config = dict(config)
+    config['chan_flags'] = sorted(set(config['chan_flags'] or []) | set(chans))
+    config['bl_flags'] = (config['bl_flags'] or []) + pairs
+    return config
+
+
+def get_output_format(casa=False):
+    """
+    Return the format string used to name the output for a given filename
+    base and capture number.
+    """
+    
+    if casa:
+        return "%s.ms_%i"
+    else:
+        return "%s.FITS_%i"
+
+
+def correlate_file(filename, station, good, config, stream=False, casa=False, flags=None, flag_capture=None):
+    """
+    Correlate a TBW file using the list of good digitizers and the process_chunk()
+    keyword arguments in `config`.  If `stream` is True, every capture in the 
+    file is correlated, otherwise only the first.  Returns a list of the output
+    filenames that were written.
+    
+    If a flag_store.FlagStore instance is given as `flags` the channel and 
+    baseline flags of each capture are added to `config`.  The capture in the
+    store is the one named after the output, e.g., 'name_1' for name.FITS_1,
+    unless `flag_capture` is given.
+    """
+    
+    antennas = station.antennas
+    
+    idf = LWA1DataFile(filename)
+    captures = None
+    try:
+        if not isinstance(idf, TBWFile):
+            raise RuntimeError("File '%s' does not appear to be a valid TBW file" % os.path.basename(filename))
+            
+        jd = idf.get_info('start_time').jd
+        date = idf.get_info('start_time').datetime
+        sample_rate = idf.get_info('sample_rate')
+        nInts = idf.get_info('nframe') // (30000 * len(antennas) // 2)
+        
+        # Number of frames to read in at once and average
+        nFrames = 30000
+        nSets = idf.get_info('nframe') // (30000*len(antennas)//2)
+        
+        print("Data type:  %s" % type(idf))
+        print("Captures in file: %i (%.3f s)" % (nInts, nInts*30000*400/sample_rate))
+        print("==")
+        print("Station: %s" % station.name)
+        print("Date observed: %s" % date)
+        print("Julian day: %.5f" % jd)
+        print("Integration Time: %.3f s" % (400*nFrames/sample_rate))
+        print("Number of integrations in file: %i" % nSets)
+        print("==")
+        
+        basename = os.path.split(filename)[1]
+        basename, ext = os.path.splitext(basename)
+        
+        fitsFormat = get_output_format(casa=casa)
+        
+        def _get_config(outname):
+            if flags is None:
+                return config
+            return get_capture_config(config, flags, flag_capture or flag_store.get_capture_name(outname))
+            
+        outnames = []
+        if stream and config.get('max_memory', None) is not None:
+            # Correlate every capture in the file, reading the sections of
+            # each as they are needed
+            ref_time = idf.get_info('start_time')
+            for s in range(nSets):
+                fitsFilename = fitsFormat % (basename, s+1)
+                process_chunk(idf, station, good, fitsFilename, ref_time=ref_time, set_number=s+1, **_get_config(fitsFilename))
+                outnames.append(fitsFilename)
+        elif stream:
+            # Correlate every capture in the file, reading the next one while
+            # the current one is being processed
+            ref_time = None
+            captures = prefetch_captures(idf, nSets)
+            for s in range(nSets):
+                # Time how long we wait on the reader thread
+                timer = profiler.StageTimer()
+                with timer.stage('read'):
+                    capture = next(captures, None)
+                if capture is None:
+                    break
+                    
+                if ref_time is None:
+                    ref_time = capture[1]
+                fitsFilename = fitsFormat % (basename, s+1)
+                process_chunk(idf, station, good, fitsFilename, capture=capture, ref_time=ref_time, set_number=s+1, timer=timer, **_get_config(fitsFilename))
+                outnames.append(fitsFilename)
+                del capture
+        else:
+            fitsFilename = fitsFormat % (basename, 1)
+            process_chunk(idf, station, good, fitsFilename, **_get_config(fitsFilename))
+            outnames.append(fitsFilename)
+    finally:
+        # Stop the reader thread, if there is one, before closing the file
+        if captures is not None:
+            captures.close()
+        idf.close()
+        
+    return outnames
+
+
+def main(args):
+    # Parse command line options
+    filename = args.filename
+    
+    # Setup the LWA station information
+    station = load_station(args.metadata)
+    antennas = station.antennas
+    
+    # Load in the antenna flags
+    ant_flags = get_antenna_flags(args)
+    
+    # Get valid stands for both polarizations
+    good = select_good(station, use_all=args.all, ant_flags=ant_flags)
+    
     # Report on the valid stands found.  This is a little verbose,
     # but nice to see.
     print("Found %i good stands to use" % (len(good)//2,))
     for i in good:
         print("%3i, %i" % (antennas[i].stand.id, antennas[i].pol))
         
-    # Number of frames to read in at once and average
-    nFrames = 30000
-    nSets = idf.get_info('nframe') // (30000*len(antennas)//2)
-    
-    print("Data type:  %s" % type(idf))
-    print("Captures in file: %i (%.3f s)" % (nInts, nInts*30000*400/sample_rate))
-    print("==")
-    print("Station: %s" % station.name)
-    print("Date observed: %s" % date)
-    print("Julian day: %.5f" % jd)
-    print("Integration Time: %.3f s" % (400*nFrames/sample_rate))
-    print("Number of integrations in file: %i" % nSets)
-    print("==")
-    
-    basename = os.path.split(filename)[1]
-    basename, ext = os.path.splitext(basename)
-    
-    if args.casa:
-        fitsFilename = "%s.ms_1" % (basename,)
-    else:
-        fitsFilename = "%s.FITS_1" % (basename,)
-        
-    process_chunk(idf, station, good, fitsFilename, LFFT=args.fft_length, overlap=1, pfb=args.pfb, pols=args.products)
+    # Correlator setup that is common to all captures
+    config = build_config(args)
     
-    idf.close()
+    # Flags that change from capture to capture
+    flags = None
+    if args.flag_store is not None:
+        flags = flag_store.FlagStore(args.flag_store)
+        
+    correlate_file(filename, station, good, config, stream=args.stream, casa=args.casa, 
+                   flags=flags, flag_capture=args.flag_capture)
+    if flags is not None:
+        flags.close()
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description='cross-correlate data in a TBW file', 
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
-        )
-    parser.add_argument('filename', type=str, 
-                        help='filename to correlate')
+def add_arguments(parser):
+    """
+    Add the correlator options, other than the filename(s) to correlate, to an
+    argparse.ArgumentParser instance.
+    """
+    
     parser.add_argument('-m', '--metadata', type=str, 
                         help='name of SSMIF or metadata tarball file to use for mappings')
     parser.add_argument('-l', '--fft-length', type=aph.positive_int, default=16, 
@@ -224,8 +855,38 @@ if __name__ == "__main__":
                         help='enabled the PFB on the F-engine')
     parser.add_argument('-q', '--quiet', dest='verbose', action='store_false', 
                         help='run %(prog)s in silent mode')
+    parser.add_argument('-w', '--workers', type=aph.positive_int, default=1, 
+                        help='number of processes to use for correlating sub-integrations')
+    parser.add_argument('-s', '--stream', action='store_true', 
+                        help='correlate every capture in the file instead of only the first')
+    parser.add_argument('-M', '--max-memory', type=aph.positive_float, 
+                        help='memory budget in GB; sections are read from the file as needed to stay within it')
+    parser.add_argument('-f', '--freq-range', type=aph.positive_float, nargs=2, default=[5.0, 93.0], 
+                        help='frequency range in MHz to correlate and write out')
+    parser.add_argument('-c', '--channel-flags', type=str, 
+                        help='name of a *_channel_flags.txt file of channels to skip')
+    parser.add_argument('-t', '--antenna-flags', type=str, 
+                        help='name of an antenna_flags.txt file of antennas to exclude')
+    parser.add_argument('-b', '--baseline-flags', type=str, 
+                        help='name of a baseline_flags.txt file of baselines to skip')
+    parser.add_argument('-g', '--flag-store', type=str, 
+                        help='name of a flag store from flag_store.py of antennas, baselines, and channels to skip')
+    parser.add_argument('--flag-capture', type=str, 
+                        help='capture in the flag store to use for every output; the default is the capture named after each output')
+    parser.add_argument('-d', '--delay-cal', type=str, 
+                        help='name of a .dcal table from two_point_selfcal.py to apply in the F-engine')
+    parser.add_argument('-k', '--sk-sigma', type=aph.positive_float, 
+                        help='enable spectral kurtosis RFI excision at this many sigma')
     parser.add_argument('-a', '--all', action='store_true', 
                         help='correlated all dipoles regardless of their status')
+    parser.add_argument('--precision', type=str, choices=['single', 'double'], default='single', 
+                        help='precision of the X-engine and the accumulation')
+    parser.add_argument('--channel-average', type=aph.positive_int, default=1, 
+                        help='number of channels to average together in the output')
+    parser.add_argument('--max-smearing', type=aph.positive_float, 
+                        help='also average each baseline in frequency up to this fractional bandwidth smearing loss on the horizon')
+    parser.add_argument('--profile', type=str, choices=['json', 'csv'], 
+                        help='save the per-stage and per-sub-integration timing and memory usage to a sidecar file in this format')
     pgroup = parser.add_mutually_exclusive_group(required=True)
     pgroup.add_argument('-x', '--xx', dest='products', action='store_const', const=['xx',], 
                         help='compute only the XX polarization product')
@@ -237,6 +898,15 @@ if __name__ == "__main__":
                         help='compute the XX, XY, YX, and YY polarization products')
     parser.add_argument('--casa', action='store_true',
                         help='write out measurement sets instead of FITS-IDI files')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='cross-correlate data in a TBW file', 
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str, 
+                        help='filename to correlate')
+    add_arguments(parser)
     args = parser.parse_args()
     main(args)
-    
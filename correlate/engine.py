@@ -0,0 +1,432 @@
+"""
+FX correlator engine for TBW data.  Unlike lsl.correlator.fx.FXMaster, which
+channelizes the signals once for every polarization product requested, this
+runs the F-engine a single time over all digitizers and then forms every
+product from that one set of spectra.  The X-engine is implemented as a batched
+complex matrix multiply (antenna x time for each channel) so that the cross-
+multiply is handled by a threaded BLAS.
+"""
+
+import numpy
+
+from lsl.common.constants import c as speedOfLight
+from lsl.correlator import _core
+from lsl.correlator.fx import pol_to_pols
+
+
+#: Complex types used by the X-engine for each precision setting
+PRECISIONS = {'single': numpy.complex64, 'double': numpy.complex128}
+
+
+def get_frequencies(LFFT, sample_rate):
+    """
+    Return the channel frequencies in Hz for real-valued (TBW) data channelized
+    into LFFT channels.
+    """
+    
+    freq = numpy.fft.fftfreq(2*LFFT, d=1.0/sample_rate)
+    return freq[:LFFT]
+
+
+def get_delays(antennas, freq):
+    """
+    Given a list of Antenna instances and an array of frequencies in Hz, return
+    a two-dimensional array of the cable plus geometric delays, in seconds,
+    needed to align the signals for a phase center at zenith.  These are the
+    same delays used by lsl.correlator.fx.FXMaster.
+    """
+    
+    delays = numpy.zeros((len(antennas), freq.size), dtype=numpy.float64)
+    for i,ant in enumerate(antennas):
+        delays[i,:] = ant.cable.delay(freq) - ant.stand.z / speedOfLight
+    if not numpy.isfinite(delays.max()):
+        delays[numpy.where(~numpy.isfinite(delays))] = delays[numpy.where(numpy.isfinite(delays))].max()
+        
+    delays -= delays[:,freq.size//2].min()
+    return delays
+
+
+def get_gains(antennas, freq):
+    """
+    Given a list of Antenna instances and an array of frequencies in Hz, return
+    a two-dimensional array of the cable gains for each antenna.
+    """
+    
+    gains = numpy.zeros((len(antennas), freq.size), dtype=numpy.float64)
+    for i,ant in enumerate(antennas):
+        gains[i,:] = ant.cable.gain(freq)
+    return gains
+
+
+def fengine(signals, antennas, LFFT=64, overlap=1, pfb=False, sample_rate=None, gain_correct=True, delay_cal=None, dtype=None):
+    """
+    Channelize all of the signals in a single pass.  Returns a three-element
+    tuple of:
+     * the channel frequencies in Hz,
+     * the channelized signals as a complex input x channel x window array, and
+     * the window validity flags as an input x window array.
+    
+    If `gain_correct` is True the spectra of each input are divided by the
+    square root of its cable gain so that the cross-products are corrected by
+    sqrt(gain1*gain2) as FXMaster does.
+    
+    If `delay_cal` is provided it is used as an array of per-input residual
+    delays, in seconds, whose phase ramps are removed from the spectra.  This
+    is equivalent to dividing each visibility by exp(2j*pi*freq*(d1-d2)) after
+    correlation.
+    
+    The channelization is always done in single precision.  If `dtype` is 
+    provided the spectra are converted to that complex type before the gain 
+    and delay corrections are applied, which also sets the precision that the
+    X-engine works in.
+    """
+    
+    freq = get_frequencies(LFFT, sample_rate)
+    delays = get_delays(antennas, freq)
+    
+    if pfb:
+        FEngine = _core.PFBEngine
+    else:
+        FEngine = _core.FEngine
+    signalsF, validF = FEngine(signals, freq, delays, LFFT=LFFT, overlap=overlap, sample_rate=sample_rate, clip_level=0)
+    if dtype is not None and signalsF.dtype != dtype:
+        signalsF = signalsF.astype(dtype)
+        
+    if gain_correct:
+        gains = numpy.sqrt(get_gains(antennas, freq)).astype(signalsF.real.dtype)
+        signalsF /= gains[:,:,None]
+        
+    if delay_cal is not None:
+        phase = numpy.exp(-2j*numpy.pi*freq[None,:]*numpy.asarray(delay_cal)[:,None])
+        signalsF *= phase.astype(signalsF.dtype)[:,:,None]
+        
+    return freq, signalsF, validF
+
+
+def autospec(signalsF, validF):
+    """
+    Given the output of fengine(), return the mean power spectrum of each input
+    as an input x channel array, averaging over only the valid windows.
+    """
+    
+    valid = validF.astype(signalsF.real.dtype)
+    power = numpy.einsum('icw,iw->ic', signalsF.real**2 + signalsF.imag**2, valid)
+    power /= numpy.maximum(valid.sum(axis=1), 1)[:,None]
+    return power
+
+
+def spectral_kurtosis(signalsF, validF):
+    """
+    Given the output of fengine(), return a two-element tuple of the spectral
+    kurtosis estimate for each input and channel (input x channel) and the
+    number of valid windows that went into each estimate (input).  For
+    Gaussian noise the estimate is one.
+    """
+    
+    valid = validF.astype(signalsF.real.dtype)
+    power = signalsF.real**2 + signalsF.imag**2
+    power *= valid[:,None,:]
+    
+    M = valid.sum(axis=1).astype(numpy.float64)
+    S1 = power.sum(axis=2, dtype=numpy.float64)
+    S2 = (power**2).sum(axis=2, dtype=numpy.float64)
+    del power
+    
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        sk = (M+1)[:,None]/(M-1)[:,None] * (M[:,None]*S2/S1**2 - 1)
+    return sk, M
+
+
+def get_sk_flags(sk, M, sigma=3.0):
+    """
+    Given the output of spectral_kurtosis(), return a boolean input x channel
+    array that is True where the estimate deviates from one by more than
+    `sigma` times its expected standard deviation of sqrt(4/M).
+    """
+    
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        flags = numpy.abs(sk - 1) > sigma*numpy.sqrt(4.0/M)[:,None]
+    return flags
+
+
+def get_baselines(nstand, include_auto=True):
+    """
+    Return the row/column indices of the baselines for nstand stands in the same
+    order that lsl.correlator.uvutils.get_baselines uses, i.e., (i,j) with j>=i.
+    """
+    
+    return numpy.triu_indices(nstand, k=0 if include_auto else 1)
+
+
+def get_baseline_flags(antennas, pairs, include_auto=True):
+    """
+    Given a list of Antenna instances and a collection of (stand, stand) ID
+    pairs, return a boolean array that is True for the baselines returned by
+    get_baselines() that connect any of those pairs of stands.
+    """
+    
+    stands = [a.stand.id for a in antennas if a.pol == 0]
+    rows, cols = get_baselines(len(stands), include_auto=include_auto)
+    
+    pairs = set([(min(p), max(p)) for p in pairs])
+    flagged = numpy.zeros(rows.size, dtype=bool)
+    for k,(i,j) in enumerate(zip(rows, cols)):
+        s1, s2 = stands[i], stands[j]
+        if (min([s1, s2]), max([s1, s2])) in pairs:
+            flagged[k] = True
+    return flagged
+
+
+def get_baseline_list(antennas, pol, include_auto=True, flagged=None):
+    """
+    Given a list of Antenna instances and a polarization product, return the
+    list of (Antenna, Antenna) baselines that xengine() produces for that
+    product.  If `flagged` is provided the baselines for which it is True are 
+    excluded.
+    """
+    
+    pol1, pol2 = pol_to_pols(pol)
+    ants1 = [a for a in antennas if a.pol == pol1]
+    ants2 = [a for a in antennas if a.pol == pol2]
+    rows, cols = get_baselines(len(ants1), include_auto=include_auto)
+    if flagged is not None:
+        rows, cols = rows[~flagged], cols[~flagged]
+    return [(ants1[i], ants2[j]) for i,j in zip(rows, cols)]
+
+
+def fill_baselines(values, flagged):
+    """
+    Given a baseline x channel array for the baselines that are not flagged 
+    and the boolean array of flagged baselines from get_baseline_flags(), 
+    return a baseline x channel array for all of the baselines with zeros for 
+    the flagged ones.
+    """
+    
+    out = numpy.zeros((flagged.size,)+values.shape[1:], dtype=values.dtype)
+    out[~flagged] = values
+    return out
+
+
+def get_baseline_weights(chan_valid, antennas, pol, include_auto=True, chans=None, flagged=None):
+    """
+    Given an input x channel boolean array of which spectra were used, return
+    a baseline x channel boolean array that is True where both inputs of the
+    baseline were used for the given polarization product.  The baselines and
+    channels follow the same selection as xengine().
+    """
+    
+    if chans is None:
+        chans = numpy.arange(chan_valid.shape[1])
+        
+    pol1, pol2 = pol_to_pols(pol)
+    v1 = chan_valid[[i for i,a in enumerate(antennas) if a.pol == pol1],:][:,chans]
+    v2 = chan_valid[[i for i,a in enumerate(antennas) if a.pol == pol2],:][:,chans]
+    rows, cols = get_baselines(v1.shape[0], include_auto=include_auto)
+    if flagged is not None:
+        rows, cols = rows[~flagged], cols[~flagged]
+    return v1[rows,:] & v2[cols,:]
+
+
+def xengine(signalsF, validF, antennas, pols=['xx','yy'], include_auto=True, chans=None, flagged=None, chan_valid=None, chunk_size=256):
+    """
+    Given the output of fengine() and the list of Antenna instances that it was
+    run on, cross-multiply the spectra for all of the requested polarization
+    products.  Returns a two-element tuple of:
+     * a dictionary of baseline lists, keyed by polarization product, and
+     * a dictionary of visibility arrays (baseline x channel), keyed by
+       polarization product.
+       
+    The cross-multiply is done channel-by-channel as a complex matrix multiply
+    in blocks of `chunk_size` channels.  The XY and YX products share a single
+    matrix multiply since YX is the conjugate transpose of XY.
+    
+    If `chans` is provided only those channels are cross-multiplied and the 
+    visibility arrays have len(chans) channels.  If `flagged` is provided, the
+    baselines for which it is True are neither extracted nor returned.  If
+    `chan_valid` is provided it is used as an input x channel boolean array of
+    which spectra to use; the others are zeroed before the cross-multiply.
+    """
+    
+    if chans is None:
+        chans = numpy.arange(signalsF.shape[1])
+    nchan = len(chans)
+    
+    # Split the inputs by polarization
+    inputs = {}
+    for p in (0, 1):
+        inputs[p] = [i for i,a in enumerate(antennas) if a.pol == p]
+        
+    # Group the products by which pair of polarizations they need
+    jobs = {}
+    for pol in pols:
+        pol1, pol2 = pol_to_pols(pol)
+        key = (min([pol1, pol2]), max([pol1, pol2]))
+        try:
+            jobs[key].append(pol)
+        except KeyError:
+            jobs[key] = [pol,]
+            
+    # Select the channels and re-order the spectra for each polarization that
+    # we need into channel x input x window and zero out the windows that the
+    # F-engine flagged
+    spectra, valid = {}, {}
+    for key in jobs:
+        for p in key:
+            if p in spectra:
+                continue
+            v = validF[inputs[p],:].astype(signalsF.real.dtype)
+            s = signalsF[numpy.ix_(inputs[p], chans)]
+            s *= v[:,None,:]
+            if chan_valid is not None:
+                s *= chan_valid[numpy.ix_(inputs[p], chans)].astype(s.real.dtype)[:,:,None]
+            spectra[p] = numpy.ascontiguousarray(s.transpose(1,0,2))
+            valid[p] = v
+            del s
+            
+    blList, vis = {}, {}
+    for (p1,p2),job in jobs.items():
+        s1, s2 = spectra[p1], spectra[p2]
+        rows, cols = get_baselines(s1.shape[1], include_auto=include_auto)
+        if flagged is not None:
+            rows, cols = rows[~flagged], cols[~flagged]
+        
+        # Number of windows that were valid for both inputs in each baseline
+        count = numpy.dot(valid[p1], valid[p2].T)
+        count = numpy.maximum(count, 1)
+        
+        for pol in job:
+            vis[pol] = numpy.zeros((rows.size, nchan), dtype=signalsF.dtype)
+            
+        for c in range(0, nchan, chunk_size):
+            cross = numpy.matmul(s1[c:c+chunk_size,:,:], s2[c:c+chunk_size,:,:].conj().transpose(0,2,1))
+            for pol in job:
+                if pol_to_pols(pol)[0] == p1:
+                    vis[pol][:,c:c+chunk_size] = cross[:,rows,cols].T
+                else:
+                    vis[pol][:,c:c+chunk_size] = cross[:,cols,rows].T.conj()
+            del cross
+            
+        for pol in job:
+            pol1, pol2 = pol_to_pols(pol)
+            if pol1 == p1:
+                vis[pol] /= count[rows,cols][:,None]
+            else:
+                vis[pol] /= count[cols,rows][:,None]
+            blList[pol] = get_baseline_list(antennas, pol, include_auto=include_auto, flagged=flagged)
+            
+    return blList, vis
+
+
+def average_channels(vis, factor, weights=None):
+    """
+    Average a baseline x channel visibility array in frequency by `factor`
+    channels.  Any channels left over at the end are dropped.  If `weights` is
+    provided it is used as a baseline x channel (or channel) array of weights
+    for the average, e.g., to exclude channels that were not correlated.
+    Returns a two-element tuple of the averaged visibilities and the sum of the
+    weights in each averaged channel.
+    """
+    
+    nbl = vis.shape[0]
+    nchan = (vis.shape[1] // factor) * factor
+    if weights is None:
+        weights = numpy.ones(nchan, dtype=numpy.float32)
+    weights = numpy.broadcast_to(weights[...,:nchan], (nbl, nchan))
+    
+    v = vis[:,:nchan].reshape(nbl, nchan//factor, factor)
+    w = weights.reshape(nbl, nchan//factor, factor)
+    wsum = w.sum(axis=2)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        avg = numpy.where(wsum > 0, (v*w).sum(axis=2) / wsum, 0)
+    return avg.astype(vis.dtype), wsum
+
+
+def average_frequencies(freq, factor):
+    """
+    Return the center frequencies of the channels produced by 
+    average_channels().
+    """
+    
+    nchan = (freq.size // factor) * factor
+    return freq[:nchan].reshape(-1, factor).mean(axis=1)
+
+
+def get_baseline_lengths(baselines):
+    """
+    Given a list of (Antenna, Antenna) baselines, return the length of each in
+    meters.
+    """
+    
+    xyz = numpy.array([(a1.stand.x-a2.stand.x, a1.stand.y-a2.stand.y, a1.stand.z-a2.stand.z) for a1,a2 in baselines])
+    return numpy.sqrt((xyz**2).sum(axis=1))
+
+
+def get_smearing_factors(lengths, chan_width, tolerance, max_factor):
+    """
+    Given an array of baseline lengths in meters and the channel width in Hz,
+    return how many channels can be averaged together for each baseline before
+    bandwidth smearing reduces the amplitude of a source on the horizon by 
+    more than the fractional `tolerance`.  The factors are between one and 
+    `max_factor`.
+    """
+    
+    k = numpy.arange(1, max_factor+1)
+    tau = numpy.asarray(lengths) / speedOfLight
+    loss = 1 - numpy.sinc(k[None,:]*chan_width*tau[:,None])
+    
+    factors = numpy.argmin(loss <= tolerance, axis=1)
+    factors[numpy.all(loss <= tolerance, axis=1)] = max_factor
+    return numpy.maximum(factors, 1)
+
+
+def smearing_average(vis, factors, weights=None):
+    """
+    Given a baseline x channel visibility array and the per-baseline factors
+    from get_smearing_factors(), average each baseline over blocks of that 
+    many channels and write the block average back to every channel in the
+    block so that all baselines share the same channels.  The last block of a
+    baseline may be shorter than its factor.  If `weights` is provided it is 
+    used as a baseline x channel array of weights for the average.  Returns the
+    averaged visibilities.
+    """
+    
+    nchan = vis.shape[1]
+    if weights is None:
+        weights = numpy.ones(vis.shape, dtype=numpy.float32)
+        
+    out = vis.copy()
+    for factor in numpy.unique(factors):
+        if factor <= 1:
+            continue
+        rows = numpy.where(factors == factor)[0]
+        for c in range(0, nchan, factor):
+            v = vis[rows,c:c+factor]
+            w = weights[rows,c:c+factor]
+            wsum = w.sum(axis=1)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                avg = numpy.where(wsum > 0, (v*w).sum(axis=1) / wsum, 0)
+            out[rows,c:c+factor] = numpy.where(w > 0, avg[:,None], 0)
+    return out
+
+
+def fxengine(signals, antennas, pols=['xx','yy'], LFFT=64, overlap=1, pfb=False, sample_rate=None, include_auto=True, gain_correct=True, chans=None, flagged=None, delay_cal=None, dtype=None):
+    """
+    Run the F- and X-engines on a collection of signals for all of the requested
+    polarization products.  Returns a three-element tuple of:
+     * a dictionary of baseline lists, keyed by polarization product,
+     * the channel frequencies in Hz, and
+     * a dictionary of visibility arrays (baseline x channel), keyed by
+       polarization product.
+       
+    If `chans` is provided only those channels are cross-multiplied and 
+    returned.  If `flagged` is provided the baselines for which it is True are
+    skipped.  If `delay_cal` is provided the per-input delays, in seconds, are
+    removed in the F-engine.  `dtype` sets the complex type that the spectra 
+    are cross-multiplied in.
+    """
+    
+    freq, signalsF, validF = fengine(signals, antennas, LFFT=LFFT, overlap=overlap, pfb=pfb, sample_rate=sample_rate, gain_correct=gain_correct, delay_cal=delay_cal, dtype=dtype)
+    if chans is not None:
+        freq = freq[chans]
+    blList, vis = xengine(signalsF, validF, antennas, pols=pols, include_auto=include_auto, chans=chans, flagged=flagged)
+    return blList, freq, vis
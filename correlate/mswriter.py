@@ -0,0 +1,314 @@
+"""
+Measurement set writer for the correlator output.  This builds on
+lsl.writer.measurementset.Ms but writes the main table with a single put per
+column rather than one put per column for every integration and band.  The
+DATA, FLAG, and FLAG_CATEGORY columns have a fixed shape and are stored with
+the TiledColumnStMan using tiles that hold every channel and polarization for
+a small block of rows.  Within each integration and band the autocorrelations
+are written first, as a contiguous block of rows, followed by the cross-
+correlations in packed baseline order.  This matches how the downstream 
+scripts read the data, either in chunks of rows or only the rows of the 
+autocorrelations, so that a read only touches the tiles for the rows it 
+needs.  The main table is written one integration at a time so that only the
+visibilities for that integration are held in memory in the table order.
+
+Data sets can also be given per-channel weights, as with the FITS-IDI writer.
+Visibilities with a weight of zero are flagged in the FLAG column, rows where
+everything is flagged are also flagged in FLAG_ROW, and the WEIGHT column is
+set to the mean weight of each polarization.
+"""
+
+import math
+import ephem
+import numpy
+
+from lsl import astro
+from lsl.writer import measurementset
+
+try:
+    from casacore.tables import table, tableutil
+except ImportError:
+    # measurementset.Ms will raise an error when a TiledMs is created
+    pass
+
+
+#: Target size in bytes for a DATA column tile
+TILE_SIZE = 128*1024
+
+
+def get_tile_shape(nstokes, nchan, nrow, itemsize=8, tile_size=TILE_SIZE):
+    """
+    Return the tile shape, in casacore (polarization, channel, row) order, for
+    a column with `nrow` rows of nchan x nstokes items that are `itemsize`
+    bytes each.  Each tile holds all of the channels and polarizations for as
+    many rows as fit in `tile_size` bytes.
+    """
+    
+    nrowTile = tile_size // (nstokes*nchan*itemsize)
+    nrowTile = max([1, min([nrow, nrowTile])])
+    return [nstokes, nchan, nrowTile]
+
+
+def get_row_order(dataSet, mapper):
+    """
+    Given a data set and the stand ID to antenna index mapper, return the order
+    to write its baselines in:  the autocorrelations followed by the cross-
+    correlations, both in packed baseline order.
+    """
+    
+    order = dataSet.argsort(mapper=mapper, shift=16)
+    auto = numpy.array([a1.stand.id == a2.stand.id for a1,a2 in dataSet.baselines], dtype=bool)
+    return numpy.concatenate([order[auto[order]], order[~auto[order]]])
+
+
+class TiledMs(measurementset.Ms):
+    """
+    Class for storing visibility data and writing the data, along with array
+    geometry, frequency setup, etc., to a CASA measurement set whose DATA,
+    FLAG, and FLAG_CATEGORY columns are tiled by row.
+    """
+    
+    def add_data_set(self, obsTime, intTime, baselines, visibilities, weights=None, pol='XX', source='z'):
+        """
+        Create a UVData object to store a collection of visibilities for the
+        specified TAI MJD time.  `weights` is an optional baseline x channel 
+        array of weights for the visibilities.
+        """
+        
+        measurementset.Ms.add_data_set(self, obsTime, intTime, baselines, visibilities, pol=pol, source=source)
+        self.data[-1].weights = weights
+        
+    def _write_main_table(self):
+        """
+        Write the main table.
+        """
+        
+        # Main
+        
+        nBand = len(self.freq)
+        
+        arrayGeo = astro.rect_posn(*self.array[0]['center'])
+        arrayGeo = astro.get_geo_from_rect(arrayGeo)
+        
+        obs = ephem.Observer()
+        obs.lat = arrayGeo.lat * numpy.pi/180
+        obs.lon = arrayGeo.lng * numpy.pi/180
+        obs.elev = arrayGeo.elv * numpy.pi/180
+        obs.pressure = 0
+        
+        mapper = self.array[0]['mapper']
+        
+        # Figure out how big the table is going to be.  All of the data sets
+        # share the same baselines.
+        nBL = len(self.data[0].baselines)
+        nInt = len([d for d in self.data if d.pol == self.stokes[0]])
+        nRow = nInt*nBand*nBL
+        tileShape = get_tile_shape(self.nStokes, self.nChan, nRow)
+        
+        col1  = tableutil.makearrcoldesc('UVW', 0.0, 1,
+                                         comment='Vector with uvw coordinates (in meters)',
+                                         keywords={'QuantumUnits':['m','m','m'],
+                                                   'MEASINFO':{'type':'uvw', 'Ref':'ITRF'}
+                                                   })
+        col2  = tableutil.makearrcoldesc('FLAG', False, 2, shape=[self.nChan, self.nStokes],
+                                         datamanagertype='TiledColumnStMan', datamanagergroup='TiledFlag',
+                                         comment='The data flags, array of bools with same shape as data')
+        col3  = tableutil.makearrcoldesc('FLAG_CATEGORY', False, 3, shape=[1, self.nChan, self.nStokes],
+                                         datamanagertype='TiledColumnStMan', datamanagergroup='TiledFlagCategory',
+                                         comment='The flag category, NUM_CAT flags for each datum',
+                                         keywords={'CATEGORY':['',]})
+        col4  = tableutil.makearrcoldesc('WEIGHT', 1.0, 1,
+                                         valuetype='float',
+                                         comment='Weight for each polarization spectrum')
+        col5  = tableutil.makearrcoldesc('SIGMA', 9999., 1,
+                                         valuetype='float',
+                                         comment='Estimated rms noise for channel with unity bandpass response')
+        col6  = tableutil.makescacoldesc('ANTENNA1', 0,
+                                         comment='ID of first antenna in interferometer')
+        col7  = tableutil.makescacoldesc('ANTENNA2', 0,
+                                         comment='ID of second antenna in interferometer')
+        col8  = tableutil.makescacoldesc('ARRAY_ID', 0,
+                                         comment='ID of array or subarray')
+        col9  = tableutil.makescacoldesc('DATA_DESC_ID', 0,
+                                         comment='The data description table index')
+        col10 = tableutil.makescacoldesc('EXPOSURE', 0.0,
+                                         comment='he effective integration time',
+                                         keywords={'QuantumUnits':['s',]})
+        col11 = tableutil.makescacoldesc('FEED1', 0,
+                                         comment='The feed index for ANTENNA1')
+        col12 = tableutil.makescacoldesc('FEED2', 0,
+                                         comment='The feed index for ANTENNA2')
+        col13 = tableutil.makescacoldesc('FIELD_ID', 0,
+                                         comment='Unique id for this pointing')
+        col14 = tableutil.makescacoldesc('FLAG_ROW', False,
+                                         comment='Row flag - flag all data in this row if True')
+        col15 = tableutil.makescacoldesc('INTERVAL', 0.0,
+                                         comment='The sampling interval',
+                                         keywords={'QuantumUnits':['s',]})
+        col16 = tableutil.makescacoldesc('OBSERVATION_ID', 0,
+                                         comment='ID for this observation, index in OBSERVATION table')
+        col17 = tableutil.makescacoldesc('PROCESSOR_ID', -1,
+                                         comment='Id for backend processor, index in PROCESSOR table')
+        col18 = tableutil.makescacoldesc('SCAN_NUMBER', 1,
+                                         comment='Sequential scan number from on-line system')
+        col19 = tableutil.makescacoldesc('STATE_ID', -1,
+                                         comment='ID for this observing state')
+        col20 = tableutil.makescacoldesc('TIME', 0.0,
+                                         comment='Modified Julian Day',
+                                         keywords={'QuantumUnits':['s',],
+                                                   'MEASINFO':{'type':'epoch', 'Ref':'UTC'}
+                                                   })
+        col21 = tableutil.makescacoldesc('TIME_CENTROID', 0.0,
+                                         comment='Modified Julian Day',
+                                         keywords={'QuantumUnits':['s',],
+                                                   'MEASINFO':{'type':'epoch', 'Ref':'UTC'}
+                                                   })
+        col22 = tableutil.makearrcoldesc("DATA", 0j, 2, shape=[self.nChan, self.nStokes],
+                                         valuetype='complex',
+                                         datamanagertype='TiledColumnStMan', datamanagergroup='TiledData',
+                                         comment='The data column')
+        
+        desc = tableutil.maketabdesc([col1, col2, col3, col4, col5, col6, col7, col8, col9,
+                                      col10, col11, col12, col13, col14, col15, col16,
+                                      col17, col18, col19, col20, col21, col22])
+        dminfo = tableutil.makedminfo(desc, {'TiledData': {'DEFAULTTILESHAPE': numpy.int32(tileShape)},
+                                             'TiledFlag': {'DEFAULTTILESHAPE': numpy.int32(tileShape)},
+                                             'TiledFlagCategory': {'DEFAULTTILESHAPE': numpy.int32(tileShape[:2]+[1,]+tileShape[2:])}})
+        tb = table("%s" % self.basename, desc, nrow=nRow, dminfo=dminfo, ack=False)
+        
+        # Sort the data with the autocorrelations first and build the antenna 
+        # lists
+        order = get_row_order(self.data[0], mapper)
+        ant1List = numpy.array([mapper.index(self.data[0].baselines[o][0].stand.id) for o in order], dtype=numpy.int32)
+        ant2List = numpy.array([mapper.index(self.data[0].baselines[o][1].stand.id) for o in order], dtype=numpy.int32)
+        
+        # Fill in the columns for all of the integrations and bands
+        uvwList = numpy.zeros((nRow, 3), dtype=numpy.float64)
+        intTimeList = numpy.zeros(nRow, dtype=numpy.float64)
+        timeList = numpy.zeros(nRow, dtype=numpy.float64)
+        sourceList = numpy.zeros(nRow, dtype=numpy.int32)
+        ddList = numpy.zeros(nRow, dtype=numpy.int32)
+        scanList = numpy.zeros(nRow, dtype=numpy.int32)
+        weightList = numpy.ones((nRow, self.nStokes), dtype=numpy.float32)
+        flagRowList = numpy.zeros(nRow, dtype=bool)
+        
+        # Visibilities and flags for one integration across all bands
+        nRowInt = nBand*nBL
+        matrix = numpy.zeros((nRowInt, self.nChan, self.nStokes), dtype=numpy.complex64)
+        flags = numpy.zeros((nRowInt, self.nChan, self.nStokes), dtype=bool)
+        
+        i = 0
+        s = 1
+        _sourceTable = []
+        for dataSet in self.data:
+            # Deal with defininig the values of the new data set
+            if dataSet.pol == self.stokes[0]:
+                ## Figure out the new date/time for the observation
+                utc = astro.taimjd_to_utcjd(dataSet.obsTime)
+                
+                ## Update the observer so we can figure out where the source is
+                obs.date = utc - astro.DJD_OFFSET
+                if dataSet.source == 'z':
+                    ### Zenith pointings
+                    equ = astro.equ_posn( obs.sidereal_time()*180/numpy.pi, obs.lat*180/numpy.pi )
+                    
+                    ### format 'source' name based on local sidereal time
+                    raHms = astro.deg_to_hms(equ.ra)
+                    (tsecs, secs) = math.modf(raHms.seconds)
+                    name = "ZA%02d%02d%02d%01d" % (raHms.hours, raHms.minutes, int(secs), int(tsecs * 10.0))
+                else:
+                    ### Real-live sources (ephem.Body instances)
+                    name = dataSet.source.name
+                    
+                ## Update the source ID
+                try:
+                    sourceID = _sourceTable.index(name)
+                except ValueError:
+                    _sourceTable.append(name)
+                    sourceID = _sourceTable.index(name)
+                    
+                ## Compute the uvw coordinates of all baselines
+                if dataSet.source == 'z':
+                    HA = 0.0
+                    dec = equ.dec
+                else:
+                    HA = (obs.sidereal_time() - dataSet.source.ra) * 12/numpy.pi
+                    dec = dataSet.source.dec * 180/numpy.pi
+                uvwCoords = dataSet.get_uvw(HA, dec, obs)
+                
+                ## Fill in the metadata for each band
+                for j in range(nBand):
+                    rows = slice(i+j*nBL, i+(j+1)*nBL)
+                    uvwList[rows,:] = uvwCoords[order,:]
+                    intTimeList[rows] = dataSet.intTime
+                    timeList[rows] = (utc - astro.MJD_OFFSET)*86400 + dataSet.intTime/2.0
+                    sourceList[rows] = sourceID
+                    ddList[rows] = j
+                    scanList[rows] = s
+                    
+            # Save the visibility data in the right order
+            k = self.stokes.index(dataSet.pol)
+            for j in range(nBand):
+                matrix[j*nBL:(j+1)*nBL,:,k] = dataSet.visibilities[order,j*self.nChan:(j+1)*self.nChan]
+                if dataSet.weights is not None:
+                    weights = dataSet.weights[order,j*self.nChan:(j+1)*self.nChan]
+                    flags[j*nBL:(j+1)*nBL,:,k] = weights <= 0
+                    weightList[i+j*nBL:i+(j+1)*nBL,k] = weights.mean(axis=1)
+                    
+            # Write out the integration once all of the polarizations have 
+            # been added and move on
+            if dataSet.pol == self.stokes[-1]:
+                tb.putcol('DATA', matrix, i, nRowInt)
+                tb.putcol('FLAG', flags, i, nRowInt)
+                tb.putcol('FLAG_CATEGORY', flags.reshape(nRowInt, 1, self.nChan, self.nStokes), i, nRowInt)
+                flagRowList[i:i+nRowInt] = flags.all(axis=(1,2))
+                matrix[...] = 0
+                flags[...] = False
+                
+                i += nRowInt
+                s += 1
+                
+        del matrix, flags
+        
+        tb.putcol('UVW', uvwList)
+        tb.putcol('WEIGHT', weightList)
+        tb.putcol('SIGMA', numpy.ones((nRow, self.nStokes), dtype=numpy.float32)*9999)
+        tb.putcol('ANTENNA1', numpy.tile(ant1List, nRow//nBL))
+        tb.putcol('ANTENNA2', numpy.tile(ant2List, nRow//nBL))
+        tb.putcol('ARRAY_ID', numpy.zeros(nRow, dtype=numpy.int32))
+        tb.putcol('DATA_DESC_ID', ddList)
+        tb.putcol('EXPOSURE', intTimeList)
+        tb.putcol('FEED1', numpy.zeros(nRow, dtype=numpy.int32))
+        tb.putcol('FEED2', numpy.zeros(nRow, dtype=numpy.int32))
+        tb.putcol('FIELD_ID', sourceList)
+        tb.putcol('FLAG_ROW', flagRowList)
+        tb.putcol('INTERVAL', intTimeList)
+        tb.putcol('OBSERVATION_ID', numpy.zeros(nRow, dtype=numpy.int32))
+        tb.putcol('PROCESSOR_ID', numpy.zeros(nRow, dtype=numpy.int32) - 1)
+        tb.putcol('SCAN_NUMBER', scanList)
+        tb.putcol('STATE_ID', numpy.zeros(nRow, dtype=numpy.int32) - 1)
+        tb.putcol('TIME', timeList)
+        tb.putcol('TIME_CENTROID', timeList)
+        
+        tb.flush()
+        tb.close()
+        
+        # Data description
+        
+        col1 = tableutil.makescacoldesc('FLAG_ROW', False,
+                                        comment='Flag this row')
+        col2 = tableutil.makescacoldesc('POLARIZATION_ID', 0,
+                                        comment='Pointer to polarization table')
+        col3 = tableutil.makescacoldesc('SPECTRAL_WINDOW_ID', 0,
+                                        comment='Pointer to spectralwindow table')
+        
+        desc = tableutil.maketabdesc([col1, col2, col3])
+        tb = table("%s/DATA_DESCRIPTION" % self.basename, desc, nrow=nBand, ack=False)
+        
+        for i in range(nBand):
+            tb.putcell('FLAG_ROW', i, False)
+            tb.putcell('POLARIZATION_ID', i, 0)
+            tb.putcell('SPECTRAL_WINDOW_ID', i, i)
+            
+        tb.flush()
+        tb.close()
@@ -0,0 +1,113 @@
+"""
+Wall time, CPU time, and peak memory instrumentation for the correlator.  Each
+measurement is a record of the stage name, the sub-integration it belongs to
+(-1 for stages that cover the whole capture), the process ID, the wall and CPU
+times in seconds, and the peak resident set size of the process in bytes.  The
+records for a capture can be saved as either a JSON or a CSV sidecar to the
+output file.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import contextlib
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+#: Fields in each record
+FIELDS = ('stage', 'section', 'pid', 'wall', 'cpu', 'peak_rss')
+
+
+def get_peak_rss():
+    """
+    Return the peak resident set size of the current process in bytes or -1
+    if it is not available.
+    """
+    
+    if resource is None:
+        return -1
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        # Linux reports kB, macOS reports bytes
+        peak *= 1024
+    return peak
+
+
+class StageTimer(object):
+    """
+    Class for collecting wall time, CPU time, and peak RSS records for the
+    stages of the correlator.
+    """
+    
+    def __init__(self):
+        self.records = []
+        
+    @contextlib.contextmanager
+    def stage(self, name, section=-1):
+        """
+        Context manager that adds a record for the code it wraps.
+        """
+        
+        t0, c0 = time.time(), time.process_time()
+        try:
+            yield
+        finally:
+            self.records.append({'stage': name, 'section': section, 'pid': os.getpid(),
+                                 'wall': time.time() - t0, 'cpu': time.process_time() - c0,
+                                 'peak_rss': get_peak_rss()})
+        
+    def extend(self, records):
+        """
+        Add a list of records, e.g., from a worker process.
+        """
+        
+        self.records.extend(records)
+        
+    def get_total(self, name, field='wall'):
+        """
+        Return the sum of `field` over all records for the stage `name`.
+        """
+        
+        return sum([r[field] for r in self.records if r['stage'] == name])
+        
+    def get_peak_rss(self):
+        """
+        Return the largest peak RSS in bytes of any of the records.
+        """
+        
+        return max([r['peak_rss'] for r in self.records] + [-1,])
+        
+    def save(self, filename, info={}):
+        """
+        Save the records to `filename`.  If the filename ends in '.csv' the
+        records are written as a CSV table, otherwise they are written as JSON
+        along with the dictionary `info` and the per-stage totals.
+        """
+        
+        if os.path.splitext(filename)[1] == '.csv':
+            with open(filename, 'w') as fh:
+                writer = csv.DictWriter(fh, fieldnames=FIELDS)
+                writer.writeheader()
+                for record in self.records:
+                    writer.writerow(record)
+        else:
+            stages = []
+            for record in self.records:
+                if record['stage'] not in stages:
+                    stages.append(record['stage'])
+            totals = {}
+            for name in stages:
+                totals[name] = {'wall': self.get_total(name, 'wall'),
+                                'cpu': self.get_total(name, 'cpu'),
+                                'peak_rss': max([r['peak_rss'] for r in self.records if r['stage'] == name])}
+            
+            output = dict(info)
+            output['totals'] = totals
+            output['records'] = self.records
+            with open(filename, 'w') as fh:
+                json.dump(output, fh, indent=2)
@@ -0,0 +1,180 @@
+"""
+Memory-bounded access to TBW captures.  Rather than decoding an entire capture
+with lsl.reader.ldp.TBWFile.read(), the frames of a capture are indexed once
+and then time sections are read for only the digitizers that are needed into
+a single re-used buffer.
+"""
+
+import math
+import struct
+import numpy
+
+from lsl.reader import tbw, errors
+
+
+# Number of frames per stand in a TBW capture
+FRAMES_PER_CAPTURE = 30000
+
+# TBW frame header - sync word, frame count, second count, TBW ID, unassigned,
+# and the time tag at the start of the payload
+_HEADER = struct.Struct('>4sIIHHQ')
+_SYNC_WORD = b'\xde\xc0\xde\x5c'
+
+
+def index_capture(fh, nstand, nframe=FRAMES_PER_CAPTURE):
+    """
+    Given an open file handle positioned at the start of a TBW capture, read
+    through the capture and return a three-element tuple of:
+     * the time of the first frame in the capture,
+     * the number of samples per frame, and
+     * a stand x frame count array of file offsets (-1 if a frame is missing).
+    Only the frame headers are read and the payloads are skipped over.
+    
+    The file handle is left at the end of the capture.
+    """
+    
+    offsets = numpy.zeros((nstand, nframe), dtype=numpy.int64) - 1
+    
+    # Find the end of the file so that a truncated last frame is skipped
+    start = fh.tell()
+    fh.seek(0, 2)
+    end = fh.tell()
+    fh.seek(start)
+    
+    first = None
+    spf = None
+    for i in range(nstand*nframe):
+        offset = fh.tell()
+        if offset + tbw.FRAME_SIZE > end:
+            break
+        sync, count, second, tbw_id, _, timetag = _HEADER.unpack(fh.read(_HEADER.size))
+        if sync != _SYNC_WORD:
+            raise errors.SyncError(location=offset)
+        fh.seek(tbw.FRAME_SIZE - _HEADER.size, 1)
+        
+        stand = (tbw_id & 1023) - 1
+        count = (count & 0xFFFFFF) - 1
+        if 0 <= stand < nstand and 0 <= count < nframe:
+            offsets[stand,count] = offset
+        if first is None or timetag < first[0]:
+            first = (timetag, offset)
+        if spf is None:
+            spf = 1200 if (tbw_id >> 14) & 1 else 400
+            
+    # Decode the earliest frame to get its time
+    t = None
+    if first is not None:
+        stop = fh.tell()
+        fh.seek(first[1])
+        t = tbw.read_frame(fh).time
+        fh.seek(stop)
+        
+    return t, spf, offsets
+
+
+def get_section_size(ninput, nsample, LFFT, npol=2, nchan=None, max_memory=None, spf=400, nsec=8, itemsize=8, index_size=0, fixed=None, per_sample=None):
+    """
+    Determine how many samples to correlate at a time so that the peak memory
+    usage of the correlator stays below `max_memory` bytes.  The estimate
+    includes the int16 read buffer, the F-engine output and the re-ordered
+    copies of it used by the X-engine as well as the visibility accumulators.
+    Returns a two-element tuple of the number of sections and the section size
+    in samples, which is always a multiple of both the frame size `spf` and the
+    FFT window length 2*LFFT so that no partial windows are dropped.  The number
+    of sections includes a shorter final section for any whole windows left
+    over; see get_sections().  `nchan` is the number of channels that are 
+    cross-multiplied, which defaults to LFFT.  `itemsize` is the size in bytes 
+    of the complex type used by the X-engine.  `index_size` is the size in 
+    bytes of the frame index from index_capture(), which is held for the whole
+    capture and is counted against the budget.
+    
+    For other uses of the F-engine output `fixed` and `per_sample` replace the 
+    estimates of the bytes held for the whole capture (other than the index) 
+    and of the bytes needed per input per sample.
+    
+    If `max_memory` is None the capture is split into about `nsec` sections.
+    """
+    
+    block = spf*2*LFFT // math.gcd(spf, 2*LFFT)
+    nblock = max([1, nsample // block])
+    if max_memory is None:
+        secsize = max([1, nblock // max([1, nsec])])*block
+    else:
+        if nchan is None:
+            nchan = LFFT
+        nstand = ninput // 2
+        nbl = nstand*(nstand+1)//2
+        if fixed is None:
+            fixed = 2*npol*nbl*nchan*itemsize + 256*nstand*nstand*itemsize
+        fixed += index_size
+        if per_sample is None:
+            per_sample = 2 + 4 + 2*(itemsize//2)*nchan//LFFT
+        per_sample *= ninput
+        
+        max_samples = (max_memory - fixed) // per_sample
+        if max_samples < block:
+            raise RuntimeError("Memory budget of %i B is too small, at least %i B are needed" % (max_memory, fixed + per_sample*block))
+        secsize = min([nblock, max_samples // block])*block
+        
+    return len(get_sections(nsample, secsize, LFFT)), secsize
+
+
+def get_sections(nsample, secsize, LFFT):
+    """
+    Given the number of samples in a capture, the section size from
+    get_section_size(), and the FFT length, return a list of the (start, stop)
+    sample ranges of the sections.  The last section is shorter than the others
+    if the capture is not a whole number of sections but it always covers a
+    whole number of FFT windows.  Any samples left over after the last whole
+    window are not used.
+    """
+    
+    nsample = (nsample // (2*LFFT))*(2*LFFT)
+    return [(start, min([start+secsize, nsample])) for start in range(0, nsample, secsize)]
+
+
+def read_section(fh, offsets, toKeep, start, stop, spf, out=None):
+    """
+    Read samples [start, stop) for the digitizers in `toKeep` from a TBW capture
+    indexed with index_capture() and return them as a digitizer x sample array.
+    If `out` is provided the data are written into it rather than a new array.
+    Missing frames are filled with zeros.
+    """
+    
+    f0, f1 = start // spf, (stop + spf - 1) // spf
+    nsamp = stop - start
+    if out is None:
+        out = numpy.zeros((len(toKeep), nsamp), dtype=numpy.int16)
+    else:
+        out = out[:,:nsamp]
+        
+    # Map each stand to the buffer rows (and polarizations) that it feeds
+    rows = {}
+    for i,d in enumerate(toKeep):
+        try:
+            rows[d // 2].append((i, d % 2))
+        except KeyError:
+            rows[d // 2] = [(i, d % 2),]
+            
+    # Figure out which frames we need and read them in file order
+    needed = []
+    for stand in rows:
+        for count in range(f0, f1):
+            offset = offsets[stand,count]
+            if offset < 0:
+                for i,p in rows[stand]:
+                    out[i,max([0, count*spf-start]):min([nsamp, (count+1)*spf-start])] = 0
+                continue
+            needed.append((offset, stand, count))
+    needed.sort()
+    
+    for offset,stand,count in needed:
+        fh.seek(offset)
+        frame = tbw.read_frame(fh)
+        
+        s0, s1 = count*spf - start, (count+1)*spf - start
+        d0, d1 = max([0, -s0]), spf - max([0, s1 - nsamp])
+        for i,p in rows[stand]:
+            out[i,s0+d0:s0+d1] = frame.payload.data[p,d0:d1]
+            
+    return out
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""
+Write a synthetic 12-bit TBW file that can be read with lsl.reader.ldp.TBWFile
+(and LWA1DataFile).  The data are Gaussian noise for each digitizer with an
+optional set of tones that are common to all digitizers.  This is useful for
+benchmarking and testing the correlator without access to real LWA1 data.
+"""
+
+import copy
+import time
+import numpy
+import argparse
+
+from lsl.common.dp import fS
+from lsl.misc import parser as aph
+
+import reader
+
+
+#: TBW frame layout (12-bit data)
+FRAME_DTYPE = numpy.dtype([('sync_word',    '<u4'),
+                           ('frame_count',  '>u4'),
+                           ('second_count', '>u4'),
+                           ('tbw_id',       '>u2'),
+                           ('unassigned',   '>u2'),
+                           ('timetag',      '>u8'),
+                           ('payload',      'u1', (1200,))])
+
+#: Samples per 12-bit TBW frame
+SAMPLES_PER_FRAME = 400
+
+
+def get_station(station, nstand):
+    """
+    Given a Station instance, return a copy of it that only contains the
+    antennas connected to the first `nstand` digitizer pairs.
+    """
+    
+    station = copy.copy(station)
+    station.antennas = sorted([a for a in station.antennas if a.digitizer <= 2*nstand], key=lambda x: x.digitizer)
+    return station
+
+
+def pack_frames(data, count, start_tag, first_stand=1):
+    """
+    Given a digitizer x sample array of int16 data, the frame count of the
+    first sample, and the time tag of the start of the capture, return a 
+    frame x stand array of frames with FRAME_DTYPE.  The first two rows of
+    `data` are the X and Y polarizations of stand `first_stand`, the next two
+    are for the stand after that, and so on.
+    """
+    
+    nstand = data.shape[0] // 2
+    nframe = data.shape[1] // SAMPLES_PER_FRAME
+    
+    frames = numpy.zeros((nframe, nstand), dtype=FRAME_DTYPE)
+    frames['sync_word'] = 0x5CDEC0DE
+    frames['frame_count'] = (count + numpy.arange(nframe))[:,None]
+    frames['tbw_id'] = (1<<15) | (first_stand + numpy.arange(nstand))[None,:]
+    frames['timetag'] = (start_tag + (count - 1 + numpy.arange(nframe, dtype=numpy.int64))*SAMPLES_PER_FRAME)[:,None]
+    
+    # 12-bit two's complement with X and Y interleaved every 1.5 bytes
+    data = (data.astype(numpy.int32) & 0xFFF).reshape(nstand, 2, nframe, SAMPLES_PER_FRAME)
+    x = data[:,0,:,:].transpose(1,0,2)
+    y = data[:,1,:,:].transpose(1,0,2)
+    payload = frames['payload'].reshape(nframe, nstand, SAMPLES_PER_FRAME, 3)
+    payload[...,0] = x >> 4
+    payload[...,1] = ((x & 15) << 4) | (y >> 8)
+    payload[...,2] = y & 255
+    
+    return frames
+
+
+def write_tbw(filename, nstand, ncapture=1, noise=16.0, tones=[], amplitude=8.0, start_time=None, seed=None, frames_per_block=1000):
+    """
+    Write a synthetic TBW file with `ncapture` captures for `nstand` digitizer
+    pairs.  Each digitizer gets Gaussian noise with a standard deviation of
+    `noise` counts plus a tone of `amplitude` counts at each frequency in
+    `tones` (in Hz) that is common to all digitizers.  `start_time` is the
+    time of the first capture as seconds since the UNIX epoch and defaults to
+    now.
+    
+    Within each capture the frames are written out one stand at a time, which
+    is the order that TBWFile expects when it looks for the stands in a file.
+    """
+    
+    rng = numpy.random.default_rng(seed)
+    if start_time is None:
+        start_time = time.time()
+        
+    with open(filename, 'wb') as fh:
+        for c in range(ncapture):
+            # Captures are spaced by a minute
+            start_tag = int(round((start_time + 60.0*c)*fS))
+            
+            for stand in range(1, nstand+1):
+                for count in range(1, reader.FRAMES_PER_CAPTURE+1, frames_per_block):
+                    nframe = min([frames_per_block, reader.FRAMES_PER_CAPTURE+1-count])
+                    
+                    data = rng.normal(scale=noise, size=(2, nframe*SAMPLES_PER_FRAME))
+                    if len(tones) > 0:
+                        t = ((count - 1)*SAMPLES_PER_FRAME + numpy.arange(nframe*SAMPLES_PER_FRAME)) / fS
+                        for f in tones:
+                            data += amplitude*numpy.cos(2*numpy.pi*f*t)
+                    data = numpy.clip(numpy.round(data), -2048, 2047).astype(numpy.int16)
+                    
+                    pack_frames(data, count, start_tag, first_stand=stand).tofile(fh)
+                    
+    return reader.FRAMES_PER_CAPTURE*nstand*ncapture
+
+
+def main(args):
+    nframe = write_tbw(args.filename, args.nstand, ncapture=args.ncapture, noise=args.noise,
+                       tones=[f*1e6 for f in args.tones], amplitude=args.amplitude, seed=args.seed)
+    print("Wrote %i frames (%i stands, %i captures) to '%s'" % (nframe, args.nstand, args.ncapture, args.filename))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='write a synthetic TBW file of noise and tones',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str,
+                        help='filename to write')
+    parser.add_argument('-n', '--nstand', type=aph.positive_int, default=16,
+                        help='number of digitizer pairs to write')
+    parser.add_argument('-c', '--ncapture', type=aph.positive_int, default=1,
+                        help='number of captures to write')
+    parser.add_argument('--noise', type=aph.positive_float, default=16.0,
+                        help='standard deviation of the noise in counts')
+    parser.add_argument('--tones', type=aph.positive_float, nargs='*', default=[38.0, 74.0],
+                        help='frequencies in MHz of tones common to all digitizers')
+    parser.add_argument('--amplitude', type=aph.positive_float, default=8.0,
+                        help='amplitude of the tones in counts')
+    parser.add_argument('--seed', type=int,
+                        help='random number generator seed')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""
+Given a collection of TBW files, compute the power spectrum of every digitizer
+in every capture without forming any cross-products.  The spectra are saved to
+.npz files with the same layout as stationMaster.py so that they can be used by
+get_antenna_flags.py and get_connected_gain.py.
+"""
+
+import os
+import sys
+import time
+import numpy
+import argparse
+
+from lsl.reader.ldp import LWA1DataFile, TBWFile
+from lsl.common.progress import ProgressBar
+from lsl.misc import parser as aph
+
+import engine
+import reader
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import station_cache
+
+
+def process_file(filename, station, LFFT=4096, pfb=False, max_memory=2*1024**3):
+    """
+    Given a TBW filename and a Station instance, compute the power spectra for
+    each digitizer in each capture and return a three-element tuple of the
+    observation date, the frequencies in Hz, and a capture x digitizer x channel
+    array of spectra.
+    """
+    
+    antennas = station.antennas
+    nStand = len(antennas) // 2
+    
+    idf = LWA1DataFile(filename)
+    if not isinstance(idf, TBWFile):
+        raise RuntimeError("File '%s' does not appear to be a valid TBW file" % os.path.basename(filename))
+        
+    date = idf.get_info('start_time').datetime
+    sample_rate = idf.get_info('sample_rate')
+    nSets = idf.get_info('nframe') // (reader.FRAMES_PER_CAPTURE*nStand)
+    
+    # Order the digitizers to match the antenna list
+    toKeep = [a.digitizer-1 for a in antennas]
+    
+    freq = engine.get_frequencies(LFFT, sample_rate)
+    masterSpectra = numpy.zeros((nSets, len(antennas), LFFT), dtype=numpy.float32)
+    for s in range(nSets):
+        t, spf, offsets = reader.index_capture(idf.fh, nStand)
+        endOfCapture = idf.fh.tell()
+        
+        # Work out a section size that fits in memory - per sample that is the
+        # int16 buffer, the complex64 spectra, and the float32 real**2, imag**2,
+        # and power temporaries in engine.autospec()
+        nSample = reader.FRAMES_PER_CAPTURE*spf
+        _, secSize = reader.get_section_size(len(toKeep), nSample, LFFT, max_memory=max_memory, spf=spf, 
+                                             index_size=offsets.nbytes, fixed=masterSpectra.nbytes, 
+                                             per_sample=2 + 4 + 3*2)
+        buffer = numpy.empty((len(toKeep), secSize), dtype=numpy.int16)
+        
+        # Average over all of the windows that were used, including those in
+        # the shorter last section
+        nWindow = numpy.zeros(len(toKeep), dtype=numpy.float64)
+        for start,stop in reader.get_sections(nSample, secSize, LFFT):
+            section = reader.read_section(idf.fh, offsets, toKeep, start, stop, spf, out=buffer)
+            _, signalsF, validF = engine.fengine(section, antennas, LFFT=LFFT, pfb=pfb, sample_rate=sample_rate, gain_correct=False)
+            nValid = validF.sum(axis=1)
+            masterSpectra[s,:,:] += engine.autospec(signalsF, validF)*nValid[:,None]
+            nWindow += nValid
+            del signalsF, validF
+        masterSpectra[s,:,:] /= numpy.maximum(nWindow, 1)[:,None]
+        
+        idf.fh.seek(endOfCapture)
+        
+    idf.close()
+    
+    return date, freq, masterSpectra
+
+
+def main(args):
+    # Initial file type check
+    filenames = args.filename
+    if filenames[0][-4:] == '.txt':
+        ## File list - load and replace filenames
+        with open(filenames[0], 'r') as fh:
+            filelist = fh.read()
+        filenames = filelist.split('\n')
+        if filenames[-1] == '':
+            filenames = filenames[:-1]
+            
+    # Setup the LWA station information
+    station, info = station_cache.load_station_info(args.metadata)
+    
+    max_memory = int(args.max_memory*1024**3)
+    
+    pb = ProgressBar(max=len(filenames))
+    sys.stdout.write(pb.show()+'\r')
+    sys.stdout.flush()
+    
+    wallTime = time.time()
+    for filename in filenames:
+        outname = os.path.basename(filename)
+        outname, _ = os.path.splitext(outname)
+        outname += '.npz'
+        
+        date, freq, masterSpectra = process_file(filename, station, LFFT=args.fft_length, pfb=args.pfb, max_memory=max_memory)
+        numpy.savez(outname, date=str(date).encode(), freq=freq, masterSpectra=masterSpectra,
+                    standMapper=info['stand'])
+                    
+        pb.inc()
+        sys.stdout.write(pb.show()+'\r')
+        sys.stdout.flush()
+        
+    sys.stdout.write(pb.show()+'\r')
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+    print("->  Wall Time: %.3f s (%.3f s per file)" % ((time.time()-wallTime), (time.time()-wallTime)/len(filenames)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='compute per-digitizer power spectra for TBW files',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str, nargs='+',
+                        help='filename(s) to process or a .txt file list')
+    parser.add_argument('-m', '--metadata', type=str,
+                        help='name of SSMIF or metadata tarball file to use for mappings')
+    parser.add_argument('-l', '--fft-length', type=aph.positive_int, default=4096,
+                        help='set FFT length')
+    parser.add_argument('-p', '--pfb', action='store_true',
+                        help='enabled the PFB on the F-engine')
+    parser.add_argument('-M', '--max-memory', type=aph.positive_float, default=2.0,
+                        help='memory budget in GB')
+    args = parser.parse_args()
+    main(args)
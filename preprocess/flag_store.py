@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+
+"""
+Compact store for the antenna, baseline, and channel flags of a night so that
+they do not need to be passed between stages as text files.  The store is a
+directory that contains:
+ * capture.npy - name of each capture, e.g., the measurement set basename,
+ * mjd.npy - MJD of each capture,
+ * stand.npy - stand IDs that the baseline flags refer to,
+ * size.npy - number of inputs (digitizers) and channels,
+ * antenna.npy - capture x input bit-packed uint8 array of antenna flags,
+ * baseline.npy - capture x stand pair bit-packed uint8 array of baseline flags
+                  for the stand pairs (i,j) with j>i, and
+ * channel.npy - capture x channel bit-packed uint8 array of channel flags.
+The flag arrays are memory-mapped so that querying a capture, or the union
+of several captures, only reads those rows.
+
+The store is built from the antenna_flags.txt, baseline_flags.txt, and
+*_channel_flags.txt files by running this as a script.  It can also be created
+empty for a list of captures, with the number of channels set by -n, and then
+filled in by get_antenna_flags.py, get_baseline_flags.py, and
+get_channel_flags.py as they run.
+
+This module also holds the readers for those flag files that are shared by the
+correlator and the calibration scripts.
+"""
+
+import os
+import re
+import shutil
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+def get_nbyte(nbit):
+    """
+    Return the number of bytes needed to hold `nbit` packed bits.
+    """
+    
+    return (nbit + 7) // 8
+
+
+def get_pair_index(nstand, i, j):
+    """
+    Return the position of the stand pair(s) (i,j) with j>i in the bit-packed
+    baseline flags for `nstand` stands.
+    """
+    
+    return i*nstand - i*(i+1)//2 + (j-i-1)
+
+
+def get_capture_name(filename):
+    """
+    Return the name of the capture in a store for a correlator output or a
+    measurement set, e.g., 'name_1' for name.FITS_1, name.ms_1, or name_1.ms.
+    """
+    
+    name = os.path.basename(filename.rstrip('/'))
+    mtch = re.match(r'^(.*)\.(?:FITS|ms)_(\d+)$', name)
+    if mtch is not None:
+        return f"{mtch.group(1)}_{mtch.group(2)}"
+    return os.path.splitext(name)[0]
+
+
+def create(path, captures, stands, ninput, nchan, mjd=None, overwrite=False):
+    """
+    Create a new, empty store in the directory `path` for the given capture
+    names, stand IDs, number of inputs, and number of channels and return it
+    as a writable FlagStore instance.
+    """
+    
+    if os.path.exists(path):
+        if not overwrite:
+            raise RuntimeError(f"Output store '{path}' already exists")
+        shutil.rmtree(path)
+    os.mkdir(path)
+    
+    ncapture = len(captures)
+    nstand = len(stands)
+    if mjd is None:
+        mjd = [0,]*ncapture
+        
+    np.save(os.path.join(path, 'capture.npy'), np.array(captures))
+    np.save(os.path.join(path, 'mjd.npy'), np.array(mjd, dtype=np.int64))
+    np.save(os.path.join(path, 'stand.npy'), np.array(stands, dtype=np.int32))
+    np.save(os.path.join(path, 'size.npy'), np.array([ninput, nchan], dtype=np.int64))
+    for name,nbit in (('antenna', ninput), ('baseline', nstand*(nstand-1)//2), ('channel', nchan)):
+        flags = open_memmap(os.path.join(path, name+'.npy'), mode='w+', dtype=np.uint8,
+                            shape=(ncapture, get_nbyte(nbit)))
+        del flags
+        
+    return FlagStore(path, readonly=False)
+
+
+def is_store(path):
+    """
+    Return if `path` looks like a store written by create().
+    """
+    
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'antenna.npy'))
+
+
+class FlagStore(object):
+    """
+    Class for access to a store written by create().  The index columns
+    (capture, mjd, and stand) are loaded into memory and the bit-packed flags
+    are memory-mapped.
+    
+    Captures can be given either by index or by name.  All of the query
+    methods return unpacked boolean arrays that are True for flagged values.
+    """
+    
+    def __init__(self, path, readonly=True):
+        self.path = path
+        self.readonly = readonly
+        
+        self.captures = np.load(os.path.join(path, 'capture.npy'))
+        self.mjd = np.load(os.path.join(path, 'mjd.npy'))
+        self.stands = np.load(os.path.join(path, 'stand.npy'))
+        self.ninput, self.nchan = [int(v) for v in np.load(os.path.join(path, 'size.npy'))]
+        
+        mode = 'r' if readonly else 'r+'
+        self.antenna = np.load(os.path.join(path, 'antenna.npy'), mmap_mode=mode)
+        self.baseline = np.load(os.path.join(path, 'baseline.npy'), mmap_mode=mode)
+        self.channel = np.load(os.path.join(path, 'channel.npy'), mmap_mode=mode)
+        
+        self._index = {str(name): i for i,name in enumerate(self.captures)}
+        self._stand_index = {int(s): i for i,s in enumerate(self.stands)}
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, type, value, tb):
+        self.close()
+        
+    @property
+    def ncapture(self):
+        return self.captures.size
+        
+    @property
+    def nstand(self):
+        return self.stands.size
+        
+    def get_index(self, capture):
+        """
+        Return the index of a capture given by name or index.  Raises a
+        KeyError if the name is not in the store.
+        """
+        
+        if isinstance(capture, (int, np.integer)):
+            return int(capture)
+        return self._index[capture]
+        
+    def _get_rows(self, captures):
+        """
+        Convert a capture, a list of captures, or None (all captures) into an
+        index or an array of indices.
+        """
+        
+        if captures is None:
+            return slice(None)
+        if isinstance(captures, (str, int, np.integer)):
+            return self.get_index(captures)
+        return np.array([self.get_index(c) for c in captures], dtype=np.int64)
+        
+    def _query(self, packed, captures, nbit):
+        """
+        Return the unpacked flags for a capture or the union of the flags of
+        several captures.
+        """
+        
+        rows = self._get_rows(captures)
+        packed = packed[rows]
+        if packed.ndim == 2:
+            packed = np.bitwise_or.reduce(packed, axis=0)
+        return np.unpackbits(packed, count=nbit, bitorder='little').astype(bool)
+        
+    def get_antenna_flags(self, captures=None):
+        """
+        Return an input boolean array of the antenna flags for a capture, a
+        list of captures, or all captures (None).  Multiple captures are
+        combined by taking the union of their flags.
+        """
+        
+        return self._query(self.antenna, captures, self.ninput)
+        
+    def get_channel_flags(self, captures=None, nchan=None):
+        """
+        Return a channel boolean array of the channel flags for a capture, a
+        list of captures, or all captures (None).  If `nchan` is given the
+        array is trimmed or padded with unflagged channels to that length.
+        """
+        
+        flags = self._query(self.channel, captures, self.nchan)
+        if nchan is not None:
+            flags = np.concatenate([flags, np.zeros(max([0, nchan-flags.size]), dtype=bool)])[:nchan]
+        return flags
+        
+    def get_baseline_flags(self, captures=None, stands=None):
+        """
+        Return a stand x stand symmetric boolean array of the baseline flags for
+        a capture, a list of captures, or all captures (None).  If `stands` is
+        given the array is for those stand IDs, in that order, with any that are
+        not in the store left unflagged.
+        """
+        
+        nstand = self.nstand
+        flagged = self._query(self.baseline, captures, nstand*(nstand-1)//2)
+        mask = np.zeros((nstand, nstand), dtype=bool)
+        i, j = np.triu_indices(nstand, k=1)
+        mask[i,j] = mask[j,i] = flagged
+        
+        if stands is not None:
+            index = np.array([self._stand_index.get(int(s), -1) for s in stands], dtype=np.int64)
+            valid = index >= 0
+            out = np.zeros((index.size, index.size), dtype=bool)
+            out[np.ix_(valid, valid)] = mask[np.ix_(index[valid], index[valid])]
+            mask = out
+        return mask
+        
+    def get_baseline_pairs(self, captures=None):
+        """
+        Return a list of the flagged (stand, stand) ID pairs for a capture, a
+        list of captures, or all captures (None).
+        """
+        
+        mask = self.get_baseline_flags(captures)
+        i, j = np.where(np.triu(mask, k=1))
+        return [(int(self.stands[a]), int(self.stands[b])) for a,b in zip(i, j)]
+        
+    def _set(self, packed, captures, flags, nbit, union=True):
+        """
+        Pack a boolean array and store it for a capture, a list of captures, or
+        all captures (None), either OR'ing it with the existing flags or
+        replacing them.
+        """
+        
+        if self.readonly:
+            raise RuntimeError(f"Store '{self.path}' is read-only")
+        flags = np.asarray(flags, dtype=bool)
+        if flags.size != nbit:
+            raise ValueError(f"Expected {nbit} flags, got {flags.size}")
+            
+        rows = self._get_rows(captures)
+        flags = np.packbits(flags, bitorder='little')
+        if union:
+            packed[rows] |= flags
+        else:
+            packed[rows] = flags
+            
+    def set_antenna_flags(self, captures, inputs, union=True):
+        """
+        Flag the given input indices (a list of indices or an input boolean
+        array) for a capture, a list of captures, or all captures (None).
+        """
+        
+        flags = np.zeros(self.ninput, dtype=bool)
+        flags[inputs] = True
+        self._set(self.antenna, captures, flags, self.ninput, union=union)
+        
+    def set_channel_flags(self, captures, chans, union=True):
+        """
+        Flag the given channels (a list of channel numbers or a channel boolean
+        array) for a capture, a list of captures, or all captures (None).
+        Channels beyond the end of the store are ignored.
+        """
+        
+        flags = np.zeros(self.nchan, dtype=bool)
+        chans = np.asarray(chans)
+        if chans.dtype == bool:
+            chans = np.where(chans)[0]
+        flags[chans[chans < self.nchan]] = True
+        self._set(self.channel, captures, flags, self.nchan, union=union)
+        
+    def set_baseline_flags(self, captures, pairs, union=True):
+        """
+        Flag the given (stand, stand) ID pairs for a capture, a list of
+        captures, or all captures (None).  Pairs with stands that are not in
+        the store are ignored.
+        """
+        
+        nstand = self.nstand
+        flags = np.zeros(nstand*(nstand-1)//2, dtype=bool)
+        for s1,s2 in pairs:
+            try:
+                i, j = self._stand_index[int(s1)], self._stand_index[int(s2)]
+            except KeyError:
+                continue
+            if i == j:
+                continue
+            i, j = min([i, j]), max([i, j])
+            flags[get_pair_index(nstand, i, j)] = True
+        self._set(self.baseline, captures, flags, nstand*(nstand-1)//2, union=union)
+        
+    def flush(self):
+        """
+        Write any changes to the flags to disk.
+        """
+        
+        if not self.readonly:
+            for packed in (self.antenna, self.baseline, self.channel):
+                packed.flush()
+                
+    def close(self):
+        """
+        Flush any changes and release the memory-maps.
+        """
+        
+        if self.antenna is not None:
+            self.flush()
+        self.antenna = self.baseline = self.channel = None
+
+
+def load_text_flags(filename):
+    """
+    Load a comma-separated flag file and return a list of its entries.
+    """
+    
+    with open(filename, 'r') as fh:
+        flags = fh.read()
+    flags = flags.strip().split(',')
+    if flags[-1] == '':
+        flags = flags[:-1]
+    return flags
+
+
+def parse_channel_flags(flags):
+    """
+    Convert a list of 'spw:chan' or 'spw:start~stop' channel flags from a
+    *_channel_flags.txt file into a list of channel numbers.
+    """
+    
+    chans = []
+    for f in flags:
+        f = f.split(':', 1)[-1]
+        if f.find('~') != -1:
+            start, stop = f.split('~', 1)
+            chans.extend(range(int(start, 10), int(stop, 10)+1))
+        else:
+            chans.append(int(f, 10))
+    return chans
+
+
+def parse_baseline_flags(flags):
+    """
+    Convert a list of 'LWAxxx~LWAyyy' baseline flags from a baseline_flags.txt
+    file into a list of (stand, stand) ID pairs.
+    """
+    
+    pairs = []
+    for f in flags:
+        s1, s2 = f.split('~', 1)
+        pairs.append((int(s1.replace('LWA', ''), 10), int(s2.replace('LWA', ''), 10)))
+    return pairs
+
+
+def load_antenna_flags(filename):
+    """
+    Load an antenna_flags.txt file from get_antenna_flags.py and return a list
+    of the flagged antenna indices.
+    """
+    
+    return [int(f, 10) for f in load_text_flags(filename)]
+
+
+def load_channel_flags(filename):
+    """
+    Load a *_channel_flags.txt file from get_channel_flags.py and return a list
+    of the flagged channel numbers.
+    """
+    
+    return parse_channel_flags(load_text_flags(filename))
+
+
+def load_baseline_flags(filename):
+    """
+    Load a baseline_flags.txt file from get_baseline_flags.py and return a list
+    of the flagged (stand, stand) ID pairs.
+    """
+    
+    return parse_baseline_flags(load_text_flags(filename))
+
+
+def main(args):
+    import station_cache
+    
+    # Station information for the inputs and stands
+    station, info = station_cache.load_station_info(args.metadata)
+    stands = np.unique(info['stand'])
+    ninput = info['stand'].size
+    
+    # Captures and their channel flags
+    captures = args.capture
+    if captures[0][-4:] == '.txt':
+        ## File list - load and replace captures
+        with open(captures[0], 'r') as fh:
+            filelist = fh.read()
+        captures = filelist.split('\n')
+        if captures[-1] == '':
+            captures = captures[:-1]
+    captures = [get_capture_name(filename) for filename in captures]
+    chan_flags = {}
+    for capture in captures:
+        flagname = capture+'_channel_flags.txt'
+        if os.path.exists(flagname):
+            chan_flags[capture] = load_channel_flags(flagname)
+        else:
+            print(f"No channel flags for {capture}")
+            
+    nchan = args.nchan
+    if nchan is None:
+        nchan = max([max(chans)+1 for chans in chan_flags.values() if len(chans) > 0] + [0,])
+        
+    if args.mjd is not None:
+        mjd = [args.mjd,]*len(captures)
+    else:
+        mjd = []
+        for capture in captures:
+            mtch = re.match(r'^(\d{5})_', capture)
+            mjd.append(int(mtch.group(1), 10) if mtch is not None else 0)
+            
+    store = create(args.output, captures, stands, ninput, nchan, mjd=mjd, overwrite=args.force)
+    for capture,chans in chan_flags.items():
+        store.set_channel_flags(capture, chans)
+        
+    # Night-wide antenna and baseline flags
+    if args.antenna_flags is not None:
+        inputs = load_antenna_flags(args.antenna_flags)
+        store.set_antenna_flags(None, inputs)
+        print(f"Loaded {len(inputs)} antenna flags from '{os.path.basename(args.antenna_flags)}'")
+    if args.baseline_flags is not None:
+        pairs = load_baseline_flags(args.baseline_flags)
+        store.set_baseline_flags(None, pairs)
+        print(f"Loaded {len(pairs)} baseline flags from '{os.path.basename(args.baseline_flags)}'")
+        
+    print(f"Stored flags for {store.ncapture} captures of {store.ninput} inputs, {store.nstand} stands, and {store.nchan} channels")
+    store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='build a flag store from the antenna, baseline, and channel flag text files',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('capture', type=str, nargs='+',
+                        help='capture(s)/measurement set(s) to store the *_channel_flags.txt flags of or a .txt file list')
+    parser.add_argument('-o', '--output', type=str, default='flags.store',
+                        help='name of the store directory to write')
+    parser.add_argument('-m', '--metadata', type=str,
+                        help='name of SSMIF or metadata tarball file to use for the inputs and stands')
+    parser.add_argument('-a', '--antenna-flags', type=str,
+                        help='antenna_flags.txt file from get_antenna_flags.py')
+    parser.add_argument('-b', '--baseline-flags', type=str,
+                        help='baseline_flags.txt file from get_baseline_flags.py')
+    parser.add_argument('-n', '--nchan', type=int,
+                        help='number of channels; the default is set by the highest channel flagged')
+    parser.add_argument('-d', '--mjd', type=int,
+                        help='MJD of the night; the default is taken from the capture names')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='overwrite an existing store')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,105 @@
+"""
+Vectorized antenna and capture flagging for stationMaster.py spectra.  The
+antenna status values follow the SSMIF convention of 3 for good, 2 for suspect,
+and 1 for bad.
+"""
+
+import numpy as np
+
+
+# Default channel range to flag on
+FLAG_CHANS = (1066, 3552)
+
+
+def flag_antennas(spec, median_spec, chans=FLAG_CHANS, threshold=3.0, max_bad=0.25):
+    """
+    Given a ... x input x channel array of spectra and a matching ... x channel
+    array of median spectra, return a ... x input array of good/bad flags for
+    each input.  An input is bad if more than `max_bad` of the channels in
+    `chans` are more than `threshold` dB from the median.
+    """
+    
+    nchan = chans[1] - chans[0]
+    spec = 10*np.log10(spec[...,chans[0]:chans[1]])
+    median_spec = 10*np.log10(median_spec[...,chans[0]:chans[1]])
+    
+    nbad = (np.abs(spec - median_spec[...,None,:]) > threshold).sum(axis=-1)
+    status = np.where(nbad > max_bad*nchan, 1, 3).astype(np.uint8)
+    return status
+
+
+def flag_pairs(status):
+    """
+    Given a ... x input array of flags where the inputs are ordered X, Y, X, Y,
+    ..., mark both polarizations of a stand as at most suspect if either of
+    them is not good.  Returns a new array of flags.
+    """
+    
+    status = status.copy()
+    pairs = status.reshape(status.shape[:-1]+(-1, 2))
+    bad_pair = (pairs != 3).any(axis=-1)
+    pairs[bad_pair] = np.minimum(pairs[bad_pair], 2)
+    return status
+
+
+def flag_spectra(spec, chans=FLAG_CHANS, threshold=3.0, max_bad=0.25):
+    """
+    Given a ... x input x channel array of spectra, flag each input against the
+    median over all inputs and then flag pairs.  Returns a ... x input array of
+    flags.
+    """
+    
+    median_spec = np.median(spec, axis=-2)
+    status = flag_antennas(spec, median_spec, chans=chans, threshold=threshold, max_bad=max_bad)
+    return flag_pairs(status)
+
+
+def group_by_mjd(mjd):
+    """
+    Given an array of MJDs for a set of captures, return a three-element tuple
+    of:
+     * the index of the day each capture is in,
+     * the position of each capture within its day, and
+     * the number of captures on each day.
+    The captures within a day are counted in the order that they are given.
+    """
+    
+    _, group = np.unique(mjd, return_inverse=True)
+    counts = np.bincount(group)
+    
+    order = np.argsort(group, kind='stable')
+    starts = np.cumsum(counts) - counts
+    position = np.empty(group.size, dtype=np.int64)
+    position[order] = np.arange(group.size) - np.repeat(starts, counts)
+    return group, position, counts
+
+
+def find_bad_captures(mjd, power, nsigma=3.0):
+    """
+    Given arrays of the MJD and the median power of each capture, fit a linear
+    trend in power to the captures of each day and return a boolean array of
+    the captures that are more than `nsigma` from the trend.
+    """
+    
+    group, x, counts = group_by_mjd(mjd)
+    x = x.astype(np.float64)
+    n = counts.astype(np.float64)
+    
+    # Least squares line for each day
+    sx = np.bincount(group, weights=x)
+    sy = np.bincount(group, weights=power)
+    sxx = np.bincount(group, weights=x*x)
+    sxy = np.bincount(group, weights=x*power)
+    den = n*sxx - sx*sx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(den != 0, (n*sxy - sx*sy) / den, 0.0)
+    intercept = (sy - slope*sx) / n
+    
+    # Outliers about the trend
+    resid = power - (slope[group]*x + intercept[group])
+    mean = np.bincount(group, weights=resid) / n
+    resid -= mean[group]
+    std = np.sqrt(np.bincount(group, weights=resid**2) / n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bad = np.abs(resid) > nsigma*std[group]
+    return bad
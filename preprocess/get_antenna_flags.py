@@ -3,164 +3,145 @@
 """
 Given a collection of .npz files from stationMaster.py, average all together in
 time and come up with a set of good/bad/suspect flags that can be used to update
-the SSMIF.
+the SSMIF.  The files are decoded and reduced in parallel without first being
+consolidated.  They can also be given as a store created with spectra_store.py.
+The flags for each input in each capture are also saved to
+antenna_flags_by_capture.npz so that antennas that fail part way through the
+season can be followed.  If a flag store from flag_store.py is given the
+antenna flags are also added to every capture in it.
 """
 
-import os
 import sys
+import argparse
 import numpy as np
 
 from lsl.common.progress import ProgressBarPlus
 
-from matplotlib import pyplot as plt
+import flagging
+import plotting
+import flag_store
+import spectra_store
 
 
-def flag(spec, median_spec, chans=[1066,3552]):
+def _process(block):
     """
-    Given a stand/pol x channel array of data and a median spectrum, create a
-    set of good/bad flags for each antenna.
+    Given a capture x input x channel block of spectra, return a three-element
+    tuple of the input x channel sum over the captures, the median power of
+    each capture, and the capture x input flags.
     """
     
-    nchan = chans[1] - chans[0]
-    spec = 10*np.log10(spec[:,chans[0]:chans[1]])
-    median_spec = 10*np.log10(median_spec[chans[0]:chans[1]])
-    
-    status = [3,]*spec.shape[0]
-    for i in range(spec.shape[0]):
-        # Flag the channel for that stand if it is more than 3 dB off the median
-        bad = np.where(np.abs(spec[i,:] - median_spec) > 3)[0]
-        if len(bad) > 0.25*nchan:
-            status[i] = 1
-        spec[i,bad] = np.nan
-        
-        # If the flattened spectrum deviates by more than 1.75 sigma, flag the channel
-        # spec[i,:] -= median_spec
-        # mean = np.nanmean(spec[i,:])
-        # std = np.nanstd(spec[i,:])
-        # 
-        # bad = np.where((np.abs(spec[i,:]) - mean)/std > 1.75)[0]
-        # if len(bad) > 0.1*nchan:
-        #     if status[i] == 3:
-        #         status[i] = 2
-                
-    return status
+    power = np.median(block.reshape(block.shape[0], -1), axis=1)
+    return block.sum(axis=0, dtype=np.float64), power, flagging.flag_spectra(block)
 
 
 def main(args):
-    # Initial file type check
-    if args[0][-4:] == '.txt':
-        ## File list - load and replace args
-        with open(args[0], 'r') as fh:
-            filelist = fh.read()
-        args = filelist.split('\n')
-        if args[-1] == '':
-            args = args[:-1]
-            
-    # Load the data
-    pb = ProgressBarPlus(max=len(args))
+    # Open the store or the files
+    store = spectra_store.open_store(args.filename)
+    filenames = list(store.filename)
+    freq = store.freq
+    
+    # Load the data in blocks that fit in the memory budget - sum the spectra, find the median power of each capture,
+    # and flag the inputs in each capture
+    pb = ProgressBarPlus(max=store.ncapture)
     sys.stdout.write(pb.show()+'\r')
     sys.stdout.flush()
     
-    med_power = []
-    for filename in args:
-        data = np.load(filename)
-        freq, spec = data['freq'][...], data['masterSpectra'][0,...]
-        
-        try:
-            mean_spec += spec
-        except NameError:
-            mean_spec = spec*1.0
-            
-        mjd = os.path.basename(filename)
-        mjd = mjd.split('_', 1)[0]
-        mjd = int(mjd, 10)
-        med_power.append([mjd, np.median(spec)])
-        
-        data.close()
-        
-        pb.inc()
-        sys.stdout.write(pb.show()+'\r')
-        sys.stdout.flush()
+    chunk_size = store.get_chunk_size(int(args.max_memory*1024**3), workers=args.workers)
+    sum_spec = np.zeros((store.ninput, store.nchan), dtype=np.float64)
+    med_power = np.zeros(store.ncapture, dtype=np.float64)
+    capture_status = np.zeros((store.ncapture, store.ninput), dtype=np.uint8)
+    for captures,(part,power,status) in store.map_chunks(_process, chunk_size=chunk_size, workers=args.workers, pb=pb):
+        sum_spec += part
+        med_power[captures] = power
+        capture_status[captures] = status
         
     sys.stdout.write(pb.show()+'\r')
     sys.stdout.write('\n')
     sys.stdout.flush()
     
     # Process the file median power to identify bad TBW captures
-    try:
-        os.remove('bad_captures.txt')
-    except OSError:
-        pass
-        
-    med_power = np.array(med_power)
-    fig = plt.figure()
-    ax = fig.gca()
-    for mjd in np.unique(med_power[:,0]):
-        ## Find all captures on this day and fit a simple linear trend to the data
-        valid = np.where(med_power[:,0] == mjd)[0]
-        run_fit = np.polyfit(np.arange(len(valid)), med_power[valid,1], 1)
-        
-        ## Find outliers at +/- 3 sigma
-        med_power_detrened = med_power[valid,1] - np.polyval(run_fit, np.arange(len(valid)))
-        run_mean = np.mean(med_power_detrened)
-        run_std = np.std(med_power_detrened)
-        
-        ## Flag the outliers
-        bad = np.where(np.abs(med_power_detrened - run_mean)/run_std > 3)[0]
-        ax.scatter(mjd+np.arange(len(valid))/len(valid), med_power[valid,1], marker='o')
-        ax.scatter((mjd+np.arange(len(valid))/len(valid))[bad], med_power[valid[bad],1], marker='x')
-        
-        ## Save the bad captures to a file
-        with open('bad_captures.txt', 'a') as fh:
-            for b in bad:
-                fh.write(args[valid[b]]+'\n')
-                
-    plt.show()
+    bad = flagging.find_bad_captures(store.mjd, med_power)
+    group, position, counts = flagging.group_by_mjd(store.mjd)
+    day = store.mjd + position / counts[group]
+    
+    with open('bad_captures.txt', 'w') as fh:
+        for b in np.where(bad)[0]:
+            fh.write(filenames[b]+'\n')
+    print(f"Found {bad.sum()} bad captures out of {store.ncapture}")
     
     # Compute the median spectrum
-    spec = mean_spec / len(args)
+    spec = sum_spec / store.ncapture
     med = np.median(spec, axis=0)
     
-    # Flag
-    status = flag(spec, med)
+    # Flag, including pairs where one element is bad
+    status = flagging.flag_pairs(flagging.flag_antennas(spec[None,...], med[None,...])[0])
     
-    # Flag pairs where one element is bad
-    for i in range(0, len(status), 2):
-        sx = status[i+0]
-        sy = status[i+1]
-        if sx != 3 or sy != 3:
-            status[i+0] = min([status[i+0], 2])
-            status[i+1] = min([status[i+1], 2])
-            
     # Report
-    print('  Good:   ', len(list(filter(lambda x: x == 3, status))))
-    print('  Suspect:', len(list(filter(lambda x: x == 2, status))))
-    print('  Bad:    ', len(list(filter(lambda x: x == 1, status))))
+    print('  Good:   ', (status == 3).sum())
+    print('  Suspect:', (status == 2).sum())
+    print('  Bad:    ', (status == 1).sum())
+    
+    good_captures = ~bad
+    always_good = (capture_status[good_captures] == 3).all(axis=0)
+    print('  Good in every capture:', always_good.sum())
+    
+    # Final files
+    with open('antenna_flags.txt', 'w') as fh:
+        for i,l in enumerate(status):
+            if l != 3:
+                fh.write(f"{i},")
+                
+    np.savez('antenna_flags_by_capture.npz', filename=store.filename, mjd=store.mjd, 
+             status=capture_status, bad_capture=bad, season_status=status)
+    store.close()
+    
+    if args.flag_store is not None:
+        with flag_store.FlagStore(args.flag_store, readonly=False) as flags:
+            if flags.ninput != status.size:
+                raise RuntimeError(f"Flag store '{args.flag_store}' has {flags.ninput} inputs, expected {status.size}")
+            flags.set_antenna_flags(None, status != 3)
+        print(f"Added {(status != 3).sum()} antenna flags to '{args.flag_store}'")
     
     # Plots
-    fig = plt.figure()
+    plotter = plotting.Plotter(batch=args.batch, prefix='antenna_flags_')
+    
+    fig = plotter.figure('capture_power')
+    ax = fig.gca()
+    ax.scatter(day, med_power, c=store.mjd, marker='o')
+    ax.scatter(day[bad], med_power[bad], c='k', marker='x')
+    ax.set_xlabel('MJD')
+    ax.set_ylabel('Median Power [arb]')
+    
+    fig = plotter.figure('median')
     ax = fig.gca()
     ax.plot(freq[1:]/1e6, 10*np.log10(med[1:]))
     ax.set_title('Median')
-    plt.draw()
     
     for s in (3, 2, 1):
-        fig = plt.figure()
+        fig = plotter.figure(f"status{s}")
         ax = fig.gca()
         for i,l in enumerate(status):
             if l != s:
                 continue
             ax.plot(freq[1:]/1e6, 10*np.log10(spec[i,1:]))
         ax.set_title(f"Status: {s}")
-        plt.draw()
-    plt.show()
-    
-    # Final file
-    with open('antenna_flags.txt', 'w') as fh:
-        for i,l in enumerate(status):
-            if l != 3:
-                fh.write(f"{i},")
+    plotter.show()
 
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    parser = argparse.ArgumentParser(
+        description='find bad antennas and TBW captures from stationMaster.py spectra',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str, nargs='+',
+                        help='.npz file(s), a .txt file list, or a store from spectra_store.py')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of processes/threads to load the spectra with')
+    parser.add_argument('-M', '--max-memory', type=float, default=1.0,
+                        help='maximum memory in GB to use for the spectra being reduced')
+    parser.add_argument('-s', '--flag-store', type=str,
+                        help='flag store from flag_store.py to add the antenna flags to')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='run without a display and save the plots to PNG files')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,64 @@
+"""
+Deferred matplotlib support for the analysis scripts.  matplotlib is only
+imported when the first figure is made.  In batch mode the non-interactive
+Agg backend is used and the figures are saved to PNG files instead of being
+shown so that the scripts never block.
+"""
+
+import os
+
+
+class Plotter(object):
+    """
+    Class for making named figures that are either shown interactively or,
+    in batch mode, saved to <prefix><name>.png.
+    """
+    
+    def __init__(self, batch=False, prefix=''):
+        self.batch = batch
+        self.prefix = prefix
+        self._plt = None
+        self._figures = []
+        
+    @property
+    def plt(self):
+        """
+        The matplotlib.pyplot module, imported the first time it is needed.
+        """
+        
+        if self._plt is None:
+            import matplotlib
+            if self.batch:
+                matplotlib.use('Agg')
+            from matplotlib import pyplot
+            self._plt = pyplot
+        return self._plt
+        
+    def figure(self, name):
+        """
+        Create and return a new figure that is saved as `name` in batch mode.
+        """
+        
+        fig = self.plt.figure()
+        self._figures.append((name, fig))
+        return fig
+        
+    def show(self):
+        """
+        Show all of the figures made since the last call or, in batch mode,
+        save them to files and close them.  Returns the list of filenames
+        written.
+        """
+        
+        outnames = []
+        if self.batch:
+            for name,fig in self._figures:
+                outname = f"{self.prefix}{name}.png"
+                fig.savefig(outname)
+                self.plt.close(fig)
+                outnames.append(outname)
+                print(f"Saved plot to '{os.path.basename(outname)}'")
+        elif len(self._figures) > 0:
+            self.plt.show()
+        self._figures = []
+        return outnames
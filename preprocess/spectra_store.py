@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+"""
+Consolidate a collection of .npz files from stationMaster.py into a single
+store that can be memory-mapped.  The store is a directory that contains:
+ * spectra.npy - capture x input x channel float32 array of the first
+                 integration in each file's masterSpectra,
+ * freq.npy - channel frequencies in Hz,
+ * date.npy - observation date string of each capture,
+ * mjd.npy - MJD of each capture, and
+ * filename.npy - name of the .npz file each capture came from.
+The captures are stored contiguously so that reading a range of captures for
+a range of channels only touches that part of the file.
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from numpy.lib.format import open_memmap
+
+from lsl.common.progress import ProgressBarPlus
+
+
+# MJD of the UNIX epoch
+MJD_UNIX_EPOCH = 40587
+
+
+def load_filelist(filenames):
+    """
+    Given a list of filenames, return the list of .npz files to use.  If the
+    first filename ends in .txt it is treated as a file list.
+    """
+    
+    if filenames[0][-4:] == '.txt':
+        ## File list - load and replace filenames
+        with open(filenames[0], 'r') as fh:
+            filelist = fh.read()
+        filenames = filelist.split('\n')
+        if filenames[-1] == '':
+            filenames = filenames[:-1]
+    return filenames
+
+
+def get_mjd(filename, date):
+    """
+    Given a stationMaster.py filename and the date stored in that file, return
+    the MJD of the observation.  The MJD is taken from the leading field of
+    the filename if it is there, otherwise from the date.
+    """
+    
+    mjd = os.path.basename(filename)
+    mjd = mjd.split('_', 1)[0]
+    try:
+        return int(mjd, 10)
+    except ValueError:
+        date = datetime.strptime(date.split(None, 1)[0].replace('/', '-'), '%Y-%m-%d')
+        return (date - datetime(1970, 1, 1)).days + MJD_UNIX_EPOCH
+
+
+# Per-process memory-maps of the stores being written by ingest()
+_SPECTRA = {}
+
+
+def _load_date(data):
+    """
+    Return the date string stored in a stationMaster.py .npz file.
+    """
+    
+    date = data['date'].item()
+    try:
+        date = date.decode()
+    except AttributeError:
+        pass
+    return date
+
+
+def _ingest_file(task):
+    """
+    Given a three-element tuple of the capture index, the .npz filename, and
+    the store path, copy the spectra from the file into the store and return a
+    three-element tuple of the capture index, the date, and the MJD.
+    """
+    
+    i, filename, path = task
+    
+    try:
+        spectra = _SPECTRA[path]
+    except KeyError:
+        spectra = np.load(os.path.join(path, 'spectra.npy'), mmap_mode='r+')
+        _SPECTRA[path] = spectra
+        
+    with np.load(filename) as data:
+        spec = data['masterSpectra'][0,...]
+        if spec.shape != spectra.shape[1:]:
+            raise RuntimeError(f"Spectra in '{filename}' have shape {spec.shape}, expected {spectra.shape[1:]}")
+        spectra[i,...] = spec
+        date = _load_date(data)
+        
+    return i, date, get_mjd(filename, date)
+
+
+def ingest(filenames, path, overwrite=False, workers=1):
+    """
+    Given a list of .npz files from stationMaster.py, write a new store to the
+    directory `path` and return it as a SpectraStore instance.  The files are
+    decompressed and copied into the store by a pool of `workers` processes, 
+    each of which only holds the capture it is working on in memory.
+    """
+    
+    if os.path.exists(path):
+        if not overwrite:
+            raise RuntimeError(f"Output store '{path}' already exists")
+        shutil.rmtree(path)
+    os.mkdir(path)
+    
+    # Use the first file to set up the store
+    with np.load(filenames[0]) as data:
+        freq = data['freq'][...]
+        shape = data['masterSpectra'].shape[1:]
+    spectra = open_memmap(os.path.join(path, 'spectra.npy'), mode='w+', dtype=np.float32,
+                          shape=(len(filenames),)+shape)
+    del spectra
+    
+    pb = ProgressBarPlus(max=len(filenames))
+    sys.stdout.write(pb.show()+'\r')
+    sys.stdout.flush()
+    
+    dates, mjds = [None,]*len(filenames), [None,]*len(filenames)
+    tasks = [(i, filename, path) for i,filename in enumerate(filenames)]
+    if workers > 1:
+        pool = Pool(processes=workers)
+        results = pool.imap_unordered(_ingest_file, tasks, chunksize=4)
+    else:
+        pool = None
+        results = map(_ingest_file, tasks)
+    try:
+        for i,date,mjd in results:
+            dates[i] = date
+            mjds[i] = mjd
+            
+            pb.inc()
+            sys.stdout.write(pb.show()+'\r')
+            sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _SPECTRA.pop(path, None)
+        
+    sys.stdout.write(pb.show()+'\r')
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+    
+    np.save(os.path.join(path, 'freq.npy'), freq)
+    np.save(os.path.join(path, 'date.npy'), np.array(dates))
+    np.save(os.path.join(path, 'mjd.npy'), np.array(mjds, dtype=np.int64))
+    np.save(os.path.join(path, 'filename.npy'), np.array(filenames))
+    
+    return SpectraStore(path)
+
+
+def is_store(path):
+    """
+    Return if `path` looks like a store written by ingest().
+    """
+    
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'spectra.npy'))
+
+
+class SpectraStore(object):
+    """
+    Class for read-only access to a store written by ingest().  The index
+    columns (freq, date, mjd, and filename) are loaded into memory and the
+    spectra are memory-mapped.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        
+        self.freq = np.load(os.path.join(path, 'freq.npy'))
+        self.date = np.load(os.path.join(path, 'date.npy'))
+        self.mjd = np.load(os.path.join(path, 'mjd.npy'))
+        self.filename = np.load(os.path.join(path, 'filename.npy'))
+        self.spectra = np.load(os.path.join(path, 'spectra.npy'), mmap_mode='r')
+        self.shape = self.spectra.shape
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, type, value, tb):
+        self.close()
+        
+    @property
+    def ncapture(self):
+        return self.shape[0]
+        
+    @property
+    def ninput(self):
+        return self.shape[1]
+        
+    @property
+    def nchan(self):
+        return self.shape[2]
+        
+    def get_channels(self, freq_min=None, freq_max=None):
+        """
+        Return a slice that selects the channels between `freq_min` and
+        `freq_max` in Hz.
+        """
+        
+        start, stop = 0, self.nchan
+        if freq_min is not None:
+            start = np.searchsorted(self.freq, freq_min, side='right')
+        if freq_max is not None:
+            stop = np.searchsorted(self.freq, freq_max, side='left')
+        return slice(int(start), int(stop))
+        
+    def get_captures(self, mjd):
+        """
+        Return the indices of the captures on the given MJD.
+        """
+        
+        return np.where(self.mjd == mjd)[0]
+        
+    def get_chunk_size(self, max_memory, workers=1, chans=slice(None)):
+        """
+        Return the number of captures per block for map_chunks() that keeps 
+        the float32 blocks held by `workers` workers within `max_memory` bytes.
+        """
+        
+        nchan = len(range(self.nchan)[chans])
+        size = max_memory // (workers*self.ninput*nchan*4)
+        return int(min([max([size, 1]), self.ncapture]))
+        
+    def read(self, captures=slice(None), chans=slice(None), inputs=slice(None), dtype=np.float64):
+        """
+        Read the spectra for the given captures, inputs, and channels and
+        return them as a capture x input x channel array of type `dtype`.  Each
+        of these can be a slice or an array of indices.  If `captures` is a 
+        single index an input x channel array is returned.
+        """
+        
+        if isinstance(captures, (int, np.integer)):
+            return self.read(slice(captures, captures+1), chans=chans, inputs=inputs, dtype=dtype)[0]
+            
+        # Index the memory-map once - with basic slices if we can, otherwise
+        # with an open mesh so that only the selected elements are copied
+        index = (captures, inputs, chans)
+        if not all([isinstance(sel, slice) for sel in index]):
+            index = np.ix_(*[np.arange(n)[sel] if isinstance(sel, slice) else np.asarray(sel) 
+                             for sel,n in zip(index, self.spectra.shape)])
+        return np.asarray(self.spectra[index], dtype=dtype)
+        
+    def iter_chunks(self, chunk_size=64, chans=slice(None), inputs=slice(None)):
+        """
+        Generator that yields two-element tuples of the capture slice and the
+        spectra for blocks of `chunk_size` captures.
+        """
+        
+        for start in range(0, self.ncapture, chunk_size):
+            captures = slice(start, min([start+chunk_size, self.ncapture]))
+            yield captures, self.read(captures, chans=chans, inputs=inputs)
+            
+    def map_chunks(self, func, chunk_size=64, workers=1, chans=slice(None), pb=None):
+        """
+        Generator that streams through the store in blocks of `chunk_size` 
+        captures on a pool of `workers` threads and yields two-element tuples of
+        the capture slice and the result of func(block) for each block, in 
+        order.  The blocks are float32 and at most `workers` of them are held in
+        memory at once.  If `pb` is provided it is updated as each block is 
+        processed.
+        """
+        
+        def _map(start):
+            captures = slice(start, min([start+chunk_size, self.ncapture]))
+            return captures, func(self.read(captures, chans=chans, dtype=np.float32))
+            
+        starts = list(range(0, self.ncapture, chunk_size))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for i in range(0, len(starts), workers):
+                for captures,result in pool.map(_map, starts[i:i+workers]):
+                    if pb is not None:
+                        pb.inc(captures.stop-captures.start)
+                        sys.stdout.write(pb.show()+'\r')
+                        sys.stdout.flush()
+                        
+                    yield captures, result
+                    
+    def close(self):
+        """
+        Release the memory-map.
+        """
+        
+        self.spectra = None
+
+
+def _map_files(task):
+    """
+    Given a four-element tuple of a list of .npz filenames, the input x channel
+    shape of their spectra, the channel selection, and a function, decode the
+    spectra from the files into a capture x input x channel float32 array and
+    return func(block).  If the function is None the array is returned.
+    """
+    
+    filenames, shape, chans, func = task
+    
+    block = None
+    for j,filename in enumerate(filenames):
+        with np.load(filename) as data:
+            spec = data['masterSpectra'][0,...]
+        if spec.shape != shape:
+            raise RuntimeError(f"Spectra in '{filename}' have shape {spec.shape}, expected {shape}")
+        spec = spec[:,chans]
+        if block is None:
+            block = np.empty((len(filenames),)+spec.shape, dtype=np.float32)
+        block[j,...] = spec
+        
+    if func is not None:
+        block = func(block)
+    return block
+
+
+class SpectraFiles(SpectraStore):
+    """
+    Class that provides the same interface as SpectraStore for a list of .npz
+    files from stationMaster.py so that they can be used without first being
+    ingested into a store.  The dates and MJDs are loaded when the files are
+    opened and the spectra are decoded from the files as they are read.
+    """
+    
+    def __init__(self, filenames):
+        self.path = None
+        self.spectra = None
+        
+        with np.load(filenames[0]) as data:
+            self.freq = data['freq'][...]
+            shape = data['masterSpectra'].shape[1:]
+        self.shape = (len(filenames),)+shape
+        
+        dates = []
+        for filename in filenames:
+            with np.load(filename) as data:
+                dates.append(_load_date(data))
+        self.date = np.array(dates)
+        self.mjd = np.array([get_mjd(filename, date) for filename,date in zip(filenames, dates)], dtype=np.int64)
+        self.filename = np.array(filenames)
+        
+    def read(self, captures=slice(None), chans=slice(None), inputs=slice(None), dtype=np.float64):
+        """
+        Read the spectra for the given captures, inputs, and channels from the
+        files and return them as a capture x input x channel array of type 
+        `dtype`.  Each of these can be a slice or an array of indices.  If 
+        `captures` is a single index an input x channel array is returned.
+        """
+        
+        if isinstance(captures, (int, np.integer)):
+            return self.read(slice(captures, captures+1), chans=chans, inputs=inputs, dtype=dtype)[0]
+            
+        block = _map_files((self.filename[captures], self.shape[1:], chans, None))
+        return np.asarray(block[:,inputs], dtype=dtype)
+        
+    def map_chunks(self, func, chunk_size=64, workers=1, chans=slice(None), pb=None):
+        """
+        Generator that decodes the files in blocks of `chunk_size` captures on
+        a pool of `workers` processes and yields two-element tuples of the 
+        capture slice and the result of func(block) for each block, in order.
+        `func` is called in the worker processes so that only its result is
+        sent back and it needs to be a module-level function.  If `pb` is 
+        provided it is updated as each block is processed.
+        """
+        
+        starts = list(range(0, self.ncapture, chunk_size))
+        tasks = [(self.filename[start:start+chunk_size], self.shape[1:], chans, func) for start in starts]
+        if workers > 1:
+            pool = Pool(processes=min([workers, len(tasks)]))
+            results = pool.imap(_map_files, tasks)
+        else:
+            pool = None
+            results = map(_map_files, tasks)
+        try:
+            for start,result in zip(starts, results):
+                captures = slice(start, min([start+chunk_size, self.ncapture]))
+                if pb is not None:
+                    pb.inc(captures.stop-captures.start)
+                    sys.stdout.write(pb.show()+'\r')
+                    sys.stdout.flush()
+                    
+                yield captures, result
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+
+def open_store(filenames):
+    """
+    Given a list of command line arguments, return a SpectraStore instance.  If
+    the first argument is a store it is opened directly.  Otherwise, the
+    arguments are treated as a list of .npz files (or a .txt file list) that 
+    are read directly through a SpectraFiles instance.
+    """
+    
+    if is_store(filenames[0]):
+        return SpectraStore(filenames[0])
+        
+    return SpectraFiles(load_filelist(filenames))
+
+
+def main(args):
+    filenames = load_filelist(args.filename)
+    print(f"Ingesting {len(filenames)} files into '{args.output}'")
+    store = ingest(filenames, args.output, overwrite=args.force, workers=args.workers)
+    print(f"Stored {store.ncapture} captures of {store.ninput} inputs x {store.nchan} channels")
+    print(f"MJDs: {store.mjd.min()} to {store.mjd.max()} ({len(np.unique(store.mjd))} unique)")
+    store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='consolidate stationMaster.py .npz files into a single memory-mappable store',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str, nargs='+',
+                        help='.npz file(s) to ingest or a .txt file list')
+    parser.add_argument('-o', '--output', type=str, default='spectra.store',
+                        help='name of the store directory to write')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='overwrite an existing store')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of processes to decompress the .npz files with')
+    args = parser.parse_args()
+    main(args)
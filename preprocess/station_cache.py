@@ -0,0 +1,136 @@
+"""
+Cache of parsed LWA station metadata.  Parsing a SSMIF or a metadata tarball
+is slow compared to the work that many of the per-file scripts do, so the
+parsed station is pickled to a cache directory keyed by the SHA-256 hash of
+the file contents (and the LSL version) the first time it is loaded.  Along
+with the station, the cache holds arrays that are indexed by antenna:
+ * digitizer - digitizer number,
+ * stand - stand ID,
+ * pol - polarization,
+ * arx_id - ARX board ID,
+ * arx_channel - ARX channel number,
+ * combined_status - combined antenna/FEE status, and
+ * xyz - x, y, and z stand positions in meters.
+
+The cache directory defaults to ~/.cache/lwa_station_cache and can be changed
+with the LWA_STATION_CACHE environment variable.
+"""
+
+import os
+import pickle
+import hashlib
+import tempfile
+import numpy as np
+
+from lsl.common import stations, metabundle
+from lsl.version import version as lsl_version
+
+
+# Cache location
+CACHE_DIR = os.environ.get('LWA_STATION_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'lwa_station_cache'))
+
+# Version of the cache entries - bump this if the contents change
+CACHE_VERSION = 1
+
+# Per-process copy of the entries that have already been loaded
+_LOADED = {}
+
+
+def get_hash(filename, apply_sdm=True):
+    """
+    Return the SHA-256 hash of a SSMIF or metadata tarball along with the
+    version information that the parsed station depends on.
+    """
+    
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024**2), b''):
+            h.update(block)
+    h.update(f"{CACHE_VERSION}:{lsl_version}:{apply_sdm}".encode())
+    return h.hexdigest()
+
+
+def get_antenna_arrays(station):
+    """
+    Given a Station instance, return a dictionary of the per-antenna arrays
+    that are stored in the cache.
+    """
+    
+    antennas = station.antennas
+    info = {}
+    info['digitizer'] = np.array([a.digitizer for a in antennas], dtype=np.int32)
+    info['stand'] = np.array([a.stand.id for a in antennas], dtype=np.int32)
+    info['pol'] = np.array([a.pol for a in antennas], dtype=np.int32)
+    info['arx_id'] = np.array([str(a.arx.id) for a in antennas])
+    info['arx_channel'] = np.array([a.arx.channel for a in antennas], dtype=np.int32)
+    info['combined_status'] = np.array([a.combined_status for a in antennas], dtype=np.int32)
+    info['xyz'] = np.array([(a.stand.x, a.stand.y, a.stand.z) for a in antennas], dtype=np.float64)
+    return info
+
+
+def _parse(filename, apply_sdm=True):
+    """
+    Parse a SSMIF or metadata tarball and return a Station instance.
+    """
+    
+    try:
+        station = stations.parse_ssmif(filename)
+    except ValueError:
+        station = metabundle.get_station(filename, apply_sdm=apply_sdm)
+    return station
+
+
+def load_station_info(filename=None, apply_sdm=True, cache_dir=CACHE_DIR):
+    """
+    Load the LWA station information from a SSMIF or metadata tarball and
+    return a two-element tuple of the Station instance and the dictionary of
+    per-antenna arrays from get_antenna_arrays().  If `filename` is None, LWA1
+    is used.  Parsed files are cached in `cache_dir` so that later calls with
+    the same file contents only need to unpickle them.
+    """
+    
+    if filename is None:
+        station = stations.lwa1
+        return station, get_antenna_arrays(station)
+        
+    key = get_hash(filename, apply_sdm=apply_sdm)
+    try:
+        return _LOADED[key]
+    except KeyError:
+        pass
+        
+    cachename = os.path.join(cache_dir, key+'.pkl')
+    entry = None
+    try:
+        with open(cachename, 'rb') as fh:
+            entry = pickle.load(fh)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        pass
+        
+    if entry is None:
+        station = _parse(filename, apply_sdm=apply_sdm)
+        entry = (station, get_antenna_arrays(station))
+        
+        # Write to a temporary file first so that concurrent readers never see
+        # a partial entry
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tempname = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(entry, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tempname, cachename)
+        except OSError as e:
+            print(f"WARNING: cannot cache station information in '{cache_dir}': {str(e)}")
+            
+    _LOADED[key] = entry
+    return entry
+
+
+def load_station(filename=None, apply_sdm=True, cache_dir=CACHE_DIR):
+    """
+    Load the LWA station information from a SSMIF or metadata tarball through
+    the cache and return a Station instance.  If `filename` is None, LWA1 is
+    used.
+    """
+    
+    return load_station_info(filename, apply_sdm=apply_sdm, cache_dir=cache_dir)[0]
@@ -6,14 +6,16 @@ Visualize the delays in a .dcal measurement set created by two_point_selfcal.py
 
 import os
 import sys
+import argparse
 import numpy as np
 from casacore.tables import table
 
-from matplotlib import pyplot as plt
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocess'))
+import plotting
 
 
 def main(args):
-    filename = args[0]
+    filename = args.filename
     dcalname = filename.replace('.gcal', '.dcal')
     gcalname = filename.replace('.dcal', '.gcal')
     
@@ -35,26 +37,37 @@ def main(args):
     mean = np.mean(gai[good])
     gai[bad] = mean
     
-    fig = plt.figure()
+    basename = os.path.basename(filename)
+    basename, _ = os.path.splitext(basename)
+    plotter = plotting.Plotter(batch=args.batch, prefix=basename+'_')
+    
+    fig = plotter.figure('delay')
     ax = fig.gca()
     ax.scatter(ant, dly[:,0,0], marker='o', label='X')
     ax.scatter(ant, dly[:,0,1], marker='o', label='Y')
     ax.set_xlabel('Antenna Number')
     ax.set_ylabel('Delay [ns]')
     fig.legend(loc=0)
-    plt.draw()
     
-    fig = plt.figure()
+    fig = plotter.figure('gain')
     ax = fig.gca()
     ax.scatter(ant, gai[:,0,0], marker='o', label='X')
     ax.scatter(ant, gai[:,0,1], marker='o', label='Y')
     ax.set_xlabel('Antenna Number')
     ax.set_ylabel('Gain [arb]')
     fig.legend(loc=0)
-    plt.draw()
     
-    plt.show()
+    plotter.show()
 
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    parser = argparse.ArgumentParser(
+        description='plot the delays and gains from two_point_selfcal.py',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str,
+                        help='.dcal or .gcal table to plot')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='run without a display and save the plots to PNG files')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,135 @@
+"""
+Put the script directories on the path so that the tests can import the
+modules in them the same way that the scripts do.
+
+Most of the correlator code is numpy-only but the modules import lsl when
+they are loaded.  The `engine`, `reader`, and `simulate` fixtures load the
+modules with the real lsl if it is installed and otherwise with minimal
+stand-ins for the parts of lsl that are imported so that the numpy-only
+functions can still be tested.  Anything that needs the compiled parts of lsl,
+e.g., engine.fengine(), is tested in test_simulate_tbw.py, which is skipped
+without lsl.
+"""
+
+import os
+import sys
+import types
+import importlib
+import contextlib
+
+import numpy as np
+import pytest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for _name in ('preprocess', 'correlate'):
+    sys.path.insert(0, os.path.join(_ROOT, _name))
+
+
+try:
+    import lsl.correlator._core
+    import lsl.reader.tbw
+    _HAVE_LSL = True
+except ImportError:
+    _HAVE_LSL = False
+
+
+def _pol_to_pols(pol):
+    # Same mapping as lsl.correlator.fx.pol_to_pols
+    return [0 if p in ('X', 'R') else 1 for p in pol.upper()]
+
+
+class _SyncError(Exception):
+    def __init__(self, location=None):
+        self.location = location
+
+
+class _EOFError(Exception):
+    pass
+
+
+def _read_tbw_frame(fh):
+    """
+    Read and decode a 12-bit TBW frame in the layout that
+    simulateTBW.pack_frames() writes.
+    """
+    
+    raw = fh.read(1224)
+    if len(raw) < 1224:
+        raise _EOFError()
+    timetag = int.from_bytes(raw[16:24], 'big')
+    
+    b = np.frombuffer(raw, dtype=np.uint8, offset=24).reshape(400, 3).astype(np.int16)
+    data = np.array([(b[:,0] << 4) | (b[:,1] >> 4), ((b[:,1] & 15) << 8) | b[:,2]])
+    data -= (data & 0x800) << 1
+    return types.SimpleNamespace(time=timetag/196e6, payload=types.SimpleNamespace(data=data))
+
+
+def _get_standins():
+    """
+    Return a dictionary of stand-in modules, keyed by name, for the parts of
+    lsl that the correlator modules import.
+    """
+    
+    attrs = {'lsl': {},
+             'lsl.common': {},
+             'lsl.common.constants': {'c': 299792458.0},
+             'lsl.common.dp': {'fS': 196e6},
+             'lsl.correlator': {},
+             'lsl.correlator._core': {},
+             'lsl.correlator.fx': {'pol_to_pols': _pol_to_pols},
+             'lsl.misc': {},
+             'lsl.misc.parser': {},
+             'lsl.reader': {},
+             'lsl.reader.errors': {'SyncError': _SyncError, 'EOFError': _EOFError},
+             'lsl.reader.tbw': {'FRAME_SIZE': 1224, 'read_frame': _read_tbw_frame}}
+             
+    modules = {}
+    for name,values in attrs.items():
+        modules[name] = types.ModuleType(name)
+        modules[name].__dict__.update(values)
+    for name,module in modules.items():
+        if '.' in name:
+            parent, child = name.rsplit('.', 1)
+            setattr(modules[parent], child, module)
+    return modules
+
+
+@contextlib.contextmanager
+def _lsl_standins():
+    """
+    Context manager that makes the lsl stand-ins importable if lsl is not
+    installed.  Everything imported inside of it is removed from sys.modules
+    on exit so that the stand-ins do not leak into other tests.
+    """
+    
+    if _HAVE_LSL:
+        yield
+        return
+        
+    before = set(sys.modules)
+    sys.modules.update(_get_standins())
+    try:
+        yield
+    finally:
+        for name in set(sys.modules) - before:
+            del sys.modules[name]
+
+
+def _load(name):
+    with _lsl_standins():
+        return importlib.import_module(name)
+
+
+@pytest.fixture(scope='session')
+def engine():
+    return _load('engine')
+
+
+@pytest.fixture(scope='session')
+def reader():
+    return _load('reader')
+
+
+@pytest.fixture(scope='session')
+def simulate():
+    return _load('simulateTBW')
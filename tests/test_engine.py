@@ -0,0 +1,157 @@
+"""
+Tests for the numpy parts of the correlator engine in correlate/engine.py.
+"""
+
+import types
+import numpy as np
+import pytest
+
+
+def _get_antennas(nstand):
+    # X and Y inputs of each stand, in that order, as the Antenna list is
+    return [types.SimpleNamespace(pol=p, stand=types.SimpleNamespace(id=s+1, x=3.0*s, y=-2.0*s, z=0.1*s))
+            for s in range(nstand) for p in (0, 1)]
+
+
+def _naive_xengine(signalsF, validF, antennas, pol, chans, chan_valid=None):
+    # One baseline, channel, and window at a time
+    pol1, pol2 = [0 if p == 'x' else 1 for p in pol]
+    in1 = [i for i,a in enumerate(antennas) if a.pol == pol1]
+    in2 = [i for i,a in enumerate(antennas) if a.pol == pol2]
+    if chan_valid is None:
+        chan_valid = np.ones(signalsF.shape[:2], dtype=bool)
+        
+    vis = []
+    for a in range(len(in1)):
+        for b in range(a, len(in1)):
+            i, j = in1[a], in2[b]
+            row = np.zeros(len(chans), dtype=np.complex128)
+            both = validF[i] & validF[j]
+            for k,c in enumerate(chans):
+                if chan_valid[i,c] and chan_valid[j,c]:
+                    row[k] = (signalsF[i,c,both]*signalsF[j,c,both].conj()).sum()
+            vis.append(row / max([1, both.sum()]))
+    return np.array(vis)
+
+
+@pytest.fixture
+def spectra():
+    rng = np.random.default_rng(1)
+    nstand, nchan, nwin = 5, 12, 20
+    signalsF = rng.normal(size=(2*nstand, nchan, nwin)) + 1j*rng.normal(size=(2*nstand, nchan, nwin))
+    validF = rng.random((2*nstand, nwin)) > 0.2
+    return signalsF, validF, _get_antennas(nstand)
+
+
+def test_xengine_matches_naive(engine, spectra):
+    signalsF, validF, antennas = spectra
+    pols = ['xx', 'xy', 'yx', 'yy']
+    chans = np.array([0, 3, 4, 5, 9, 11])
+    
+    blList, vis = engine.xengine(signalsF, validF, antennas, pols=pols, chans=chans, chunk_size=4)
+    for pol in pols:
+        assert len(blList[pol]) == len(vis[pol]) == 15
+        np.testing.assert_allclose(vis[pol], _naive_xengine(signalsF, validF, antennas, pol, chans), rtol=1e-12)
+        
+    # Baselines are (i,j) with j>=i, as lsl.correlator.uvutils.get_baselines()
+    i, j = np.triu_indices(5)
+    for pol in pols:
+        assert [(a1.stand.id, a2.stand.id) for a1,a2 in blList[pol]] == list(zip(i+1, j+1))
+
+
+def test_xengine_flagged_and_chan_valid(engine, spectra):
+    signalsF, validF, antennas = spectra
+    chans = np.arange(signalsF.shape[1])
+    flagged = engine.get_baseline_flags(antennas, [(2, 4), (5, 1)])
+    chan_valid = np.ones(signalsF.shape[:2], dtype=bool)
+    chan_valid[3,[2, 7]] = False
+    
+    blList, vis = engine.xengine(signalsF, validF, antennas, pols=['xy'], flagged=flagged, chan_valid=chan_valid)
+    assert flagged.sum() == 2
+    assert (2, 4) not in [(a1.stand.id, a2.stand.id) for a1,a2 in blList['xy']]
+    
+    ref = _naive_xengine(signalsF, validF, antennas, 'xy', chans, chan_valid=chan_valid)
+    np.testing.assert_allclose(vis['xy'], ref[~flagged], rtol=1e-12)
+    np.testing.assert_allclose(engine.fill_baselines(vis['xy'], flagged)[flagged], 0)
+
+
+def test_spectral_kurtosis(engine):
+    rng = np.random.default_rng(2)
+    ninput, nchan, nwin = 4, 16, 4000
+    signalsF = (rng.normal(size=(ninput, nchan, nwin)) + 1j*rng.normal(size=(ninput, nchan, nwin))).astype(np.complex64)
+    validF = np.ones((ninput, nwin), dtype=bool)
+    validF[2,:1000] = False
+    
+    # A steady tone is strongly sub-Gaussian and a burst is strongly super-Gaussian
+    signalsF[1,5,:] = 10*np.exp(2j*np.pi*rng.random(nwin))
+    signalsF[3,9,:100] *= 30
+    
+    sk, M = engine.spectral_kurtosis(signalsF, validF)
+    assert np.array_equal(M, validF.sum(axis=1))
+    
+    # Reference - one input and channel at a time
+    for i in range(ninput):
+        for c in range(nchan):
+            p = np.abs(signalsF[i,c,validF[i]].astype(np.complex128))**2
+            m = p.size
+            ref = (m+1)/(m-1) * (m*(p**2).sum()/p.sum()**2 - 1)
+            assert np.isclose(sk[i,c], ref, rtol=1e-5)
+            
+    flags = engine.get_sk_flags(sk, M, sigma=5.0)
+    assert list(zip(*np.where(flags))) == [(1, 5), (3, 9)]
+    assert sk[1,5] < 1 < sk[3,9]
+
+
+def test_average_channels(engine):
+    rng = np.random.default_rng(3)
+    vis = (rng.normal(size=(6, 23)) + 1j*rng.normal(size=(6, 23))).astype(np.complex64)
+    weights = (rng.random((6, 23)) > 0.3).astype(np.float32)
+    weights[2,4:8] = 0
+    
+    avg, wsum = engine.average_channels(vis, 4, weights=weights)
+    assert avg.shape == wsum.shape == (6, 5)
+    assert avg.dtype == vis.dtype
+    for b in range(6):
+        for k in range(5):
+            v, w = vis[b,4*k:4*k+4], weights[b,4*k:4*k+4]
+            assert np.isclose(wsum[b,k], w.sum())
+            assert np.isclose(avg[b,k], (v*w).sum()/w.sum() if w.sum() > 0 else 0, rtol=1e-5)
+    assert avg[2,1] == 0 and wsum[2,1] == 0
+    
+    # Without weights it is a plain mean and a channel weight array broadcasts
+    avg, wsum = engine.average_channels(vis, 4)
+    np.testing.assert_allclose(avg, vis[:,:20].reshape(6, 5, 4).mean(axis=2), rtol=1e-5)
+    assert (wsum == 4).all()
+    avg, wsum = engine.average_channels(vis, 4, weights=weights[0])
+    assert np.array_equal(wsum, np.broadcast_to(weights[0,:20].reshape(5, 4).sum(axis=1), (6, 5)))
+    np.testing.assert_allclose(engine.average_frequencies(np.arange(23.0), 4), [1.5, 5.5, 9.5, 13.5, 17.5])
+
+
+def test_smearing_average(engine):
+    rng = np.random.default_rng(4)
+    vis = rng.normal(size=(4, 10)) + 1j*rng.normal(size=(4, 10))
+    weights = np.ones(vis.shape, dtype=np.float32)
+    weights[2,[1, 7]] = 0
+    factors = np.array([1, 3, 3, 10])
+    
+    out = engine.smearing_average(vis, factors, weights=weights)
+    assert np.array_equal(out[0], vis[0])
+    for b in (1, 2, 3):
+        for c in range(0, 10, factors[b]):
+            v, w = vis[b,c:c+factors[b]], weights[b,c:c+factors[b]]
+            np.testing.assert_allclose(out[b,c:c+factors[b]], np.where(w > 0, (v*w).sum()/w.sum(), 0))
+
+
+def test_smearing_factors(engine):
+    lengths = np.array([0.0, 10.0, 100.0, 1000.0])
+    chan_width, tolerance, max_factor = 25e3, 0.01, 64
+    
+    factors = engine.get_smearing_factors(lengths, chan_width, tolerance, max_factor)
+    assert factors[0] == max_factor
+    assert (np.diff(factors) <= 0).all() and (factors >= 1).all()
+    
+    # Largest factor that stays within the tolerance
+    tau = lengths / 299792458.0
+    for f,t in zip(factors, tau):
+        assert 1 - np.sinc(f*chan_width*t) <= tolerance or f == 1
+        assert f == max_factor or 1 - np.sinc((f+1)*chan_width*t) > tolerance
@@ -0,0 +1,82 @@
+"""
+Tests for the bit-packed flag store in preprocess/flag_store.py.
+"""
+
+import numpy as np
+import pytest
+
+import flag_store
+
+
+CAPTURES = ['night_1', 'night_2', 'night_3']
+STANDS = [3, 7, 12, 40, 258]
+NINPUT = 13
+NCHAN = 37
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = flag_store.create(str(tmp_path / 'flags'), CAPTURES, STANDS, NINPUT, NCHAN, mjd=[60000, 60000, 60001])
+    yield store
+    store.close()
+
+
+def test_pair_index_matches_triu():
+    nstand = len(STANDS)
+    i, j = np.triu_indices(nstand, k=1)
+    assert np.array_equal(flag_store.get_pair_index(nstand, i, j), np.arange(i.size))
+
+
+@pytest.mark.parametrize('filename,name', [('/data/night.FITS_1', 'night_1'),
+                                           ('night.ms_12', 'night_12'),
+                                           ('/data/night_3.ms/', 'night_3')])
+def test_capture_name(filename, name):
+    assert flag_store.get_capture_name(filename) == name
+
+
+def test_pack_unpack(store, tmp_path):
+    rng = np.random.default_rng(11)
+    antenna = rng.random((len(CAPTURES), NINPUT)) > 0.5
+    channel = rng.random((len(CAPTURES), NCHAN)) > 0.5
+    for c,capture in enumerate(CAPTURES):
+        store.set_antenna_flags(capture, antenna[c], union=False)
+        store.set_channel_flags(capture, channel[c], union=False)
+        store.set_baseline_flags(capture, [(STANDS[c], STANDS[c+1])], union=False)
+    store.close()
+    
+    with flag_store.FlagStore(str(tmp_path / 'flags')) as store:
+        for c,capture in enumerate(CAPTURES):
+            assert np.array_equal(store.get_antenna_flags(capture), antenna[c])
+            assert np.array_equal(store.get_channel_flags(capture), channel[c])
+            assert store.get_baseline_pairs(capture) == [(STANDS[c], STANDS[c+1])]
+            
+            mask = store.get_baseline_flags(capture)
+            assert np.array_equal(mask, mask.T)
+            assert mask.sum() == 2
+            
+        with pytest.raises(RuntimeError):
+            store.set_antenna_flags(0, [0])
+            
+            
+def test_union(store):
+    store.set_antenna_flags('night_1', [0, 5])
+    store.set_antenna_flags('night_2', [5, 12])
+    store.set_antenna_flags('night_2', [1])
+    assert list(np.where(store.get_antenna_flags('night_2'))[0]) == [1, 5, 12]
+    assert list(np.where(store.get_antenna_flags(['night_1', 'night_2']))[0]) == [0, 1, 5, 12]
+    assert list(np.where(store.get_antenna_flags())[0]) == [0, 1, 5, 12]
+    assert not store.get_antenna_flags('night_3').any()
+    
+    store.set_channel_flags(None, [2, NCHAN+4])
+    store.set_channel_flags(2, [30])
+    assert list(np.where(store.get_channel_flags([0, 2]))[0]) == [2, 30]
+    assert store.get_channel_flags(0, nchan=NCHAN+8).size == NCHAN+8
+    
+    store.set_baseline_flags('night_1', [(12, 3), (7, 999)])
+    store.set_baseline_flags('night_3', [(40, 258), (40, 40)])
+    assert store.get_baseline_pairs() == [(3, 12), (40, 258)]
+    mask = store.get_baseline_flags(['night_1', 'night_3'], stands=[258, 40, 5])
+    assert np.array_equal(mask, [[False, True, False], [True, False, False], [False, False, False]])
+    
+    store.set_antenna_flags('night_2', [3], union=False)
+    assert list(np.where(store.get_antenna_flags('night_2'))[0]) == [3]
@@ -0,0 +1,41 @@
+"""
+Tests for the vectorized capture flagging in preprocess/flagging.py.
+"""
+
+import numpy as np
+
+import flagging
+
+
+def test_find_bad_captures_matches_polyfit():
+    rng = np.random.default_rng(7)
+    
+    # Three days of interleaved captures with a different trend on each
+    mjd = rng.permutation(np.repeat([60000, 60001, 60002], [40, 25, 60]))
+    power = np.zeros(mjd.size)
+    spikes = []
+    for day,slope in zip((60000, 60001, 60002), (0.5, -2.0, 0.1)):
+        sel = np.where(mjd == day)[0]
+        power[sel] = 100 + slope*np.arange(sel.size) + rng.normal(size=sel.size)
+        spikes.append(sel[sel.size//2])
+    power[spikes] += 20
+    
+    bad = flagging.find_bad_captures(mjd, power, nsigma=3.0)
+    
+    # Reference - np.polyfit for each day with the captures in the order given
+    expected = np.zeros(mjd.size, dtype=bool)
+    for day in np.unique(mjd):
+        sel = np.where(mjd == day)[0]
+        x = np.arange(sel.size)
+        resid = power[sel] - np.polyval(np.polyfit(x, power[sel], 1), x)
+        resid -= resid.mean()
+        expected[sel] = np.abs(resid) > 3.0*resid.std()
+        
+    assert np.array_equal(bad, expected)
+    assert bad[spikes].all()
+
+
+def test_find_bad_captures_single_capture_day():
+    mjd = np.array([60000, 60001, 60001, 60001])
+    power = np.array([5.0, 1.0, 2.0, 3.0])
+    assert not flagging.find_bad_captures(mjd, power).any()
@@ -0,0 +1,107 @@
+"""
+Tests for the TBW capture indexing and section reading in correlate/reader.py.
+"""
+
+import numpy as np
+import pytest
+
+
+NSTAND = 3
+NFRAME = 10
+MISSING = (1, 4)
+
+
+@pytest.fixture
+def capture(simulate, tmp_path):
+    """
+    Write a capture with the frames in a random order and one frame missing,
+    and return the filename, the data, and what should be read back.
+    """
+    
+    rng = np.random.default_rng(5)
+    data = rng.integers(-2048, 2048, size=(2*NSTAND, NFRAME*400)).astype(np.int16)
+    frames = simulate.pack_frames(data, 1, 123456789).reshape(-1)
+    
+    missing = MISSING[1]*NSTAND + MISSING[0]
+    order = rng.permutation([f for f in range(frames.size) if f != missing])
+    filename = str(tmp_path / 'capture.tbw')
+    with open(filename, 'wb') as fh:
+        frames[order].tofile(fh)
+        fh.write(b'\x00'*100)
+        
+    expected = data.copy()
+    expected[2*MISSING[0]:2*MISSING[0]+2,MISSING[1]*400:(MISSING[1]+1)*400] = 0
+    return filename, data, expected
+
+
+def test_index_capture(reader, capture):
+    filename, data, expected = capture
+    with open(filename, 'rb') as fh:
+        t, spf, offsets = reader.index_capture(fh, NSTAND, nframe=NFRAME)
+        assert fh.tell() == (NSTAND*NFRAME - 1)*1224
+    assert spf == 400
+    assert offsets.shape == (NSTAND, NFRAME)
+    assert (offsets < 0).sum() == 1 and offsets[MISSING] < 0
+    assert sorted(offsets[offsets >= 0]) == list(range(0, (NSTAND*NFRAME - 1)*1224, 1224))
+
+
+def test_index_capture_sync_error(reader, capture):
+    filename, data, expected = capture
+    with open(filename, 'rb') as fh:
+        raw = bytearray(fh.read())
+    raw[3*1224] = 0
+    with open(filename, 'wb') as fh:
+        fh.write(raw)
+        
+    with open(filename, 'rb') as fh:
+        with pytest.raises(reader.errors.SyncError):
+            reader.index_capture(fh, NSTAND, nframe=NFRAME)
+
+
+@pytest.mark.parametrize('toKeep,start,stop', [(list(range(2*NSTAND)), 0, NFRAME*400),
+                                               ([5, 0, 3], 150, 2050),
+                                               ([2], 1600, 2000),
+                                               ([3, 2], 1999, 2001)])
+def test_read_section(reader, capture, toKeep, start, stop):
+    filename, data, expected = capture
+    with open(filename, 'rb') as fh:
+        _, spf, offsets = reader.index_capture(fh, NSTAND, nframe=NFRAME)
+        section = reader.read_section(fh, offsets, toKeep, start, stop, spf)
+        assert np.array_equal(section, expected[toKeep,start:stop])
+        
+        # Re-using a buffer that already has something in it
+        out = np.full((len(toKeep), NFRAME*400), 7, dtype=np.int16)
+        section = reader.read_section(fh, offsets, toKeep, start, stop, spf, out=out)
+        assert np.array_equal(section, expected[toKeep,start:stop])
+        assert np.shares_memory(section, out)
+
+
+@pytest.mark.parametrize('LFFT,max_memory', [(64, None), (3920, None), (3920, 4*1024**3), (4096, 1024**3)])
+def test_get_sections(reader, LFFT, max_memory):
+    nsample = reader.FRAMES_PER_CAPTURE*400
+    nsec, secsize = reader.get_section_size(64, nsample, LFFT, nchan=LFFT//2, max_memory=max_memory)
+    sections = reader.get_sections(nsample, secsize, LFFT)
+    assert len(sections) == nsec
+    assert secsize % 400 == 0 and secsize % (2*LFFT) == 0
+    
+    # Contiguous, whole windows, and only the last one can be short
+    starts, stops = np.array(sections).T
+    assert starts[0] == 0 and np.array_equal(starts[1:], stops[:-1])
+    assert ((stops - starts) % (2*LFFT) == 0).all()
+    assert ((stops - starts)[:-1] == secsize).all() and 0 < stops[-1] - starts[-1] <= secsize
+    assert 0 <= nsample - stops[-1] < 2*LFFT
+
+
+def test_get_section_size_memory(reader):
+    nsample = reader.FRAMES_PER_CAPTURE*400
+    for max_memory in (64*1024**2, 256*1024**2):
+        nsec, secsize = reader.get_section_size(64, nsample, 64, max_memory=max_memory)
+        smaller = reader.get_section_size(64, nsample, 64, max_memory=max_memory//2)[1]
+        assert smaller < secsize
+        assert secsize % 3200 == 0
+        
+        # The index counts against the budget
+        assert reader.get_section_size(64, nsample, 64, max_memory=max_memory, index_size=max_memory//4)[1] < secsize
+        
+    with pytest.raises(RuntimeError):
+        reader.get_section_size(64, nsample, 64, max_memory=4*1024**2)
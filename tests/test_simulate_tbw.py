@@ -0,0 +1,69 @@
+"""
+Round-trip test of the correlator: synthetic frames from simulateTBW.py are read
+back with reader.py and correlated with engine.py, and the visibilities are
+compared with lsl.correlator.fx.FXMaster.
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('lsl.correlator.fx')
+pytest.importorskip('lsl.reader.tbw')
+
+from lsl.common import stations
+from lsl.common.dp import fS
+from lsl.correlator.fx import FXMaster
+
+import reader
+import engine
+import simulateTBW
+
+
+NSTAND = 4
+NFRAME = 24
+
+
+@pytest.fixture
+def capture(tmp_path):
+    rng = np.random.default_rng(3)
+    nsamp = NFRAME*simulateTBW.SAMPLES_PER_FRAME
+    t = np.arange(nsamp) / fS
+    data = rng.normal(scale=16.0, size=(2*NSTAND, nsamp)) + 8.0*np.cos(2*np.pi*38e6*t)
+    data = np.clip(np.round(data), -2048, 2047).astype(np.int16)
+    
+    # Frames are written one stand at a time, as write_tbw() does
+    frames = simulateTBW.pack_frames(data, 1, int(1.7e9*fS))
+    filename = str(tmp_path / 'sim.tbw')
+    frames.T.tofile(filename)
+    return filename, data
+
+
+def test_reader_round_trip(capture):
+    filename, data = capture
+    with open(filename, 'rb') as fh:
+        t, spf, offsets = reader.index_capture(fh, NSTAND, nframe=NFRAME)
+        assert spf == simulateTBW.SAMPLES_PER_FRAME
+        assert (offsets >= 0).all()
+        
+        section = reader.read_section(fh, offsets, list(range(2*NSTAND)), 0, data.shape[1], spf)
+        assert np.array_equal(section, data)
+        
+        section = reader.read_section(fh, offsets, [5, 0, 2], 150, 2050, spf)
+        assert np.array_equal(section, data[[5, 0, 2],150:2050])
+
+
+@pytest.mark.parametrize('pol', ['xx', 'yy', 'xy'])
+def test_engine_matches_fxmaster(capture, pol):
+    filename, data = capture
+    antennas = simulateTBW.get_station(stations.lwa1, NSTAND).antennas
+    with open(filename, 'rb') as fh:
+        _, spf, offsets = reader.index_capture(fh, NSTAND, nframe=NFRAME)
+        section = reader.read_section(fh, offsets, [a.digitizer-1 for a in antennas], 0, data.shape[1], spf)
+        
+    blList, freq, vis = engine.fxengine(section, antennas, pols=[pol], LFFT=64, sample_rate=fS, include_auto=True)
+    refList, refFreq, refVis = FXMaster(section, antennas, LFFT=64, include_auto=True, sample_rate=fS,
+                                        pol=pol.upper(), gain_correct=True, return_baselines=True)
+    
+    assert [(a1.digitizer, a2.digitizer) for a1,a2 in blList[pol]] == [(a1.digitizer, a2.digitizer) for a1,a2 in refList]
+    assert np.allclose(freq, refFreq)
+    np.testing.assert_allclose(vis[pol], refVis, rtol=1e-4, atol=1e-5*np.abs(refVis).max())